@@ -0,0 +1,168 @@
+# grouped enhancer-enhancer distance analysis (see enhancer_enhancer_clustering_plots.ipynb)
+# tables contain one row per promoter-enhancer pair: promoter pixel coordinates (z_1, y_1, x_1),
+# enhancer pixel coordinates (z_2, y_2, x_2) and the promoter-enhancer distance in µm (distance_um)
+#
+# instead of a groupby-apply with one least squares solve, distance matrix or pair loop per group, the table is
+# sorted by group once and all groups are processed together: pixel sizes via batched normal equations,
+# enhancer pairs via concatenated upper triangle indices of all groups
+
+import numpy as np
+import pandas as pd
+
+
+GROUP_COLUMNS = ["fov", "gene", "celltype"]
+
+
+# table sorted by group (and promoter distance within groups, -> enhancer index = neighbor rank)
+# returns sorted table (new index), start row and size of each group
+def sort_by_group(df, group_columns=GROUP_COLUMNS, distance_column="distance_um"):
+
+    df = df.dropna(subset=group_columns).sort_values(list(group_columns) + [distance_column], kind="stable")
+    df = df.reset_index(drop=True)
+
+    group_id = df.groupby(list(group_columns), sort=False).ngroup().to_numpy()
+    sizes = np.bincount(group_id)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    return df, starts, sizes
+
+
+# pixel size (zyx, µm) of each group from promoter-enhancer pixel vectors and distances in µm:
+# least squares solution of (pixel vectors)^2 x = distances^2, pixel size = sqrt(x)
+# all groups are solved at once via the normal equations, rank-deficient groups via lstsq (as before)
+def group_pixel_sizes(df, starts, sizes, distance_column="distance_um"):
+
+    pixel_vectors = df[[f"{d}_2" for d in "zyx"]].to_numpy(float) - df[[f"{d}_1" for d in "zyx"]].to_numpy(float)
+    a = pixel_vectors**2
+    b = df[distance_column].to_numpy(float)**2
+
+    ata = np.add.reduceat(a[:, :, np.newaxis] * a[:, np.newaxis, :], starts)
+    atb = np.add.reduceat(a * b[:, np.newaxis], starts)
+
+    x = np.empty((len(starts), 3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        well_posed = (sizes >= 3) & (np.linalg.cond(ata) < 1 / np.finfo(float).eps)
+    x[well_posed] = np.linalg.solve(ata[well_posed], atb[well_posed, :, np.newaxis])[..., 0]
+
+    for g in np.flatnonzero(~well_posed):
+        rows = slice(starts[g], starts[g] + sizes[g])
+        x[g] = np.linalg.lstsq(a[rows], b[rows], rcond=None)[0]
+
+    with np.errstate(invalid='ignore'):
+        return x**(1/2)
+
+
+# enhancer coordinates in µm of a table sorted by group
+def enhancer_coordinates_um(df, starts, sizes, distance_column="distance_um"):
+    pixel_sizes = group_pixel_sizes(df, starts, sizes, distance_column)
+    return df[[f"{d}_2" for d in "zyx"]].to_numpy(float) * np.repeat(pixel_sizes, sizes, axis=0)
+
+
+# row indices (i, j) with i < j of all pairs within each group (groups in order, pairs like itertools.combinations)
+# and the group of each pair
+def group_pairs(starts, sizes):
+
+    pairs_i, pairs_j, pair_groups = [], [], []
+    for size in np.unique(sizes):
+        groups = np.flatnonzero(sizes == size)
+        i, j = np.triu_indices(size, k=1)
+        pairs_i.append((starts[groups, np.newaxis] + i).ravel())
+        pairs_j.append((starts[groups, np.newaxis] + j).ravel())
+        pair_groups.append(np.repeat(groups, len(i)))
+
+    pairs_i, pairs_j, pair_groups = map(np.concatenate, (pairs_i, pairs_j, pair_groups))
+
+    # pairs of groups of the same size were collected together -> back to group order
+    order = np.argsort(pair_groups, kind="stable")
+    return pairs_i[order], pairs_j[order], pair_groups[order]
+
+
+# mean promoter-enhancer and mean enhancer-enhancer distance per group
+# (promoter_enhancer_meandist, enhancer_enhancer_meandist columns, indexed by group)
+def mean_group_distances(df, group_columns=GROUP_COLUMNS, distance_column="distance_um"):
+
+    df, starts, sizes = sort_by_group(df, group_columns, distance_column)
+    coords = enhancer_coordinates_um(df, starts, sizes, distance_column)
+
+    i, j, pair_groups = group_pairs(starts, sizes)
+    enhancer_distances = np.linalg.norm(coords[i] - coords[j], axis=1)
+
+    n_pairs = np.bincount(pair_groups, minlength=len(starts))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        enhancer_meandist = np.bincount(pair_groups, weights=enhancer_distances, minlength=len(starts)) / n_pairs
+
+    index = pd.MultiIndex.from_frame(df.loc[starts, group_columns]) if len(group_columns) > 1 else pd.Index(df.loc[starts, group_columns[0]])
+    return pd.DataFrame({
+        "promoter_enhancer_meandist": np.add.reduceat(df[distance_column].to_numpy(float), starts) / sizes,
+        "enhancer_enhancer_meandist": enhancer_meandist,
+    }, index=index)
+
+
+# all enhancer pairs within each group with their distance and distances to the promoter
+# enhancer indices are ranks by promoter distance within the group, same columns as promoter_distance_df in the notebook
+def enhancer_pair_distances(df, group_columns=GROUP_COLUMNS, distance_column="distance_um"):
+
+    df, starts, sizes = sort_by_group(df, group_columns, distance_column)
+    coords = enhancer_coordinates_um(df, starts, sizes, distance_column)
+    promoter_distances = df[distance_column].to_numpy(float)
+
+    i, j, pair_groups = group_pairs(starts, sizes)
+    group_start = starts[pair_groups]
+
+    pair_df = pd.DataFrame({
+        "enhancer_idx_1": i - group_start,
+        "enhancer_idx_2": j - group_start,
+        "enhancer_dist_um": np.linalg.norm(coords[i] - coords[j], axis=1),
+        "promoter_dist_1_um": promoter_distances[i],
+        "promoter_dist_2_um": promoter_distances[j],
+    })
+    for column in group_columns:
+        pair_df[column] = df[column].to_numpy()[i]
+
+    # index restarts in each group (like concatenating per-group tables)
+    n_pairs = sizes * (sizes - 1) // 2
+    pair_df.index = np.arange(len(pair_df)) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+
+    # avg distance to promoter of enhancer pair
+    pair_df["promoter_dist_avg"] = pair_df[["promoter_dist_1_um", "promoter_dist_2_um"]].mean(axis=1)
+
+    # maximal possible distance (assuming they are on opposite sides of promoter)
+    pair_df["max_dist"] = pair_df[["promoter_dist_1_um", "promoter_dist_2_um"]].sum(axis=1)
+    # minimal possible distance (assuming they are on same side of promoter)
+    pair_df["min_dist"] = (pair_df["promoter_dist_1_um"] - pair_df["promoter_dist_2_um"]).abs()
+
+    # normalize enhancer-enhancer dist as fraction of maximum possible distance
+    pair_df["enhancer_dist_norm"] = pair_df["enhancer_dist_um"] / pair_df["max_dist"]
+
+    return pair_df
+
+
+# table (sorted by group) with nearest / mean / median distance of each enhancer to the others
+def enhancer_neighbor_distances(df, group_columns=GROUP_COLUMNS, distance_column="distance_um"):
+
+    df, starts, sizes = sort_by_group(df, group_columns, distance_column)
+    coords = enhancer_coordinates_um(df, starts, sizes, distance_column)
+
+    # both directions of every pair, sorted by enhancer -> distances to the others in contiguous segments
+    i, j, _ = group_pairs(starts, sizes)
+    rows, distances = np.concatenate([i, j]), np.tile(np.linalg.norm(coords[i] - coords[j], axis=1), 2)
+    order = np.lexsort((distances, rows))
+    rows, distances = rows[order], distances[order]
+
+    n_others = np.repeat(sizes - 1, sizes)
+    segment_starts = np.concatenate([[0], np.cumsum(n_others)[:-1]])
+    has_others = n_others > 0
+
+    df["enhancer_nearest_um"] = np.nan
+    df["enhancer_mean_um"] = np.nan
+    df["enhancer_median_um"] = np.nan
+
+    if has_others.any():
+        seg = segment_starts[has_others]
+        n = n_others[has_others]
+        df.loc[has_others, "enhancer_nearest_um"] = distances[seg]
+        df.loc[has_others, "enhancer_mean_um"] = np.add.reduceat(distances, seg) / n
+        # median of the sorted segments: middle element or mean of the two middle elements
+        df.loc[has_others, "enhancer_median_um"] = (distances[seg + (n - 1) // 2] + distances[seg + n // 2]) / 2
+
+    return df
@@ -0,0 +1,152 @@
+# batched Monte-Carlo power analysis for differences in distance distributions
+# (vectorized version of simulate_distance_pairs / power_simulation in power_analysis_distance_distributions.ipynb)
+#
+# all replicates of a parameter combination are simulated at once as (n_sims, N, dimensionality) arrays and
+# the Mann-Whitney U test is computed for all replicates with one (row-wise) ranking
+# grid cells are run in parallel processes, each with its own random generator spawned from one seed
+# -> results only depend on the seed, not on the number of workers
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+from scipy.stats import norm, rankdata
+
+
+# Maxwell scale parameter for a given mean distance (https://en.wikipedia.org/wiki/Maxwell%E2%80%93Boltzmann_distribution)
+def maxwell_scale(mean):
+    return mean * np.sqrt(np.pi) / np.sqrt(2**3)
+
+
+# random unit vectors, shape + (dimensionality, )
+def random_unit_vectors(rng, shape, dimensionality=3):
+    v = rng.standard_normal(tuple(shape) + (dimensionality, ))
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+# n_sims replicates of distance pairs: returns noiseless and noisy distances (n_sims, N) / (n_sims, N2)
+# like simulate_distance_pairs: Maxwell distances in random directions, plus isotropic normal noise
+# with mean bias (in one random direction per replicate)
+def simulate_distance_pairs_batch(rng, n_sims, bias=0, noise_sd=0, mu=100, delta_mu=10, N=1000, dimensionality=3, N2=None):
+
+    if N2 is None:
+        N2 = N
+
+    bias = bias * random_unit_vectors(rng, (n_sims, 1), dimensionality)
+
+    results = []
+    for n, mean in ((N, mu), (N2, mu + delta_mu)):
+
+        # Maxwell distances are the lengths of 3D isotropic normal vectors with sd = scale
+        # -> in 3D, these vectors already have Maxwell lengths in uniformly random directions
+        v = rng.standard_normal((n_sims, n, 3)) * maxwell_scale(mean)
+        d = np.linalg.norm(v, axis=-1)
+        if dimensionality != 3:
+            v = random_unit_vectors(rng, (n_sims, n), dimensionality) * d[..., np.newaxis]
+
+        v_noise = v + bias + rng.standard_normal((n_sims, n, dimensionality)) * noise_sd
+        results.append((d, np.linalg.norm(v_noise, axis=-1)))
+
+    (d1, d1_noise), (d2, d2_noise) = results
+    return d1, d2, d1_noise, d2_noise
+
+
+# two-sided Mann-Whitney U test for each row of x (n, n1) vs y (n, n2)
+# asymptotic p-values with tie and continuity correction (same as scipy.stats.mannwhitneyu for samples > 8)
+def mannwhitneyu_batch(x, y):
+
+    n1, n2 = x.shape[1], y.shape[1]
+    n = n1 + n2
+
+    combined = np.concatenate([x, y], axis=1)
+    order = np.argsort(combined, axis=1)
+    sorted_values = np.take_along_axis(combined, order, axis=1)
+
+    # rank sum of x: positions (1-based) of the values of x in the sorted rows
+    r1 = np.where(order < n1, np.arange(1, n + 1), 0).sum(axis=1).astype(float)
+
+    # rows with ties: average ranks and tie correction (sum of t^3 - t over groups of tied values)
+    tie_term = np.zeros(len(combined))
+    for row in np.flatnonzero((np.diff(sorted_values, axis=1) == 0).any(axis=1)):
+        r1[row] = rankdata(combined[row])[:n1].sum()
+        t = np.unique(sorted_values[row], return_counts=True)[1]
+        tie_term[row] = (t**3 - t).sum()
+
+    u1 = r1 - n1 * (n1 + 1) / 2
+    u = np.maximum(u1, n1 * n2 - u1)
+
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (u - n1 * n2 / 2 - 0.5) / sigma
+
+    return u1, np.clip(2 * norm.sf(z), 0, 1)
+
+
+# p-values and mean noise-induced distance changes of n_sims replicates (like power_simulation)
+# replicates are simulated in batches of batch_size to bound memory
+def power_simulation_batch(n_sims, bias, noise_sd, mu, delta_mu, N, N2=None, dimensionality=3, rng=None, batch_size=100):
+
+    # Maxwell distribution is not defined for mean distances < 0, return dummy result
+    if mu < 0 or mu + delta_mu < 0:
+        return np.ones(n_sims), np.zeros(n_sims)
+
+    rng = np.random.default_rng(rng)
+
+    pvals, mean_diffs = [], []
+    for start in range(0, n_sims, batch_size):
+        d1, d2, d1_noise, d2_noise = simulate_distance_pairs_batch(rng, min(batch_size, n_sims - start), bias, noise_sd,
+                                                                   mu, delta_mu, N, dimensionality, N2)
+        mean_diffs.append(np.concatenate([d1_noise - d1, d2_noise - d2], axis=1).mean(axis=1))
+        pvals.append(mannwhitneyu_batch(d1_noise, d2_noise)[1])
+
+    return np.concatenate(pvals), np.concatenate(mean_diffs)
+
+
+# names and values of the two parameters with multiple values in a parameter dict
+def grid_parameters(simulation_parameters):
+
+    if not np.sum([not np.isscalar(v) for v in simulation_parameters.values()]) == 2:
+        raise ValueError("provide lists of values for two parameters")
+
+    names = [k for k, v in simulation_parameters.items() if not np.isscalar(v)]
+    values = [simulation_parameters[k] for k in names]
+    return names, values
+
+
+# wrapper for process pool: fraction of significant tests and mean difference for one grid cell
+def _power_grid_cell(task):
+    n_sims, significance_cutoff, params, dimensionality, seed, batch_size = task
+    pvals, mean_diffs = power_simulation_batch(n_sims, dimensionality=dimensionality, rng=np.random.default_rng(seed),
+                                               batch_size=batch_size, **params)
+    return (pvals < significance_cutoff).mean(), mean_diffs.mean()
+
+
+# power for a grid of two parameters (see grid_parameters), n_workers grid cells in parallel
+# returns significance_heatmap and mean_diff_heatmap of shape (len(values_p1), len(values_p2))
+def power_grid(simulation_parameters, n_sims=1_000, significance_cutoff=0.05, dimensionality=3, seed=0,
+               n_workers=None, batch_size=100):
+
+    (name1, name2), (values_p1, values_p2) = grid_parameters(simulation_parameters)
+
+    cells = list(product(range(len(values_p1)), range(len(values_p2))))
+    seeds = np.random.SeedSequence(seed).spawn(len(cells))
+
+    tasks = []
+    for (i, j), cell_seed in zip(cells, seeds):
+        params = {k: v for k, v in simulation_parameters.items() if np.isscalar(v)}
+        params.update({name1: values_p1[i], name2: values_p2[j]})
+        tasks.append((n_sims, significance_cutoff, params, dimensionality, cell_seed, batch_size))
+
+    if n_workers is None or n_workers <= 1:
+        results = list(map(_power_grid_cell, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_power_grid_cell, tasks))
+
+    significance_heatmap = np.zeros((len(values_p1), len(values_p2)))
+    mean_diff_heatmap = np.zeros((len(values_p1), len(values_p2)))
+    for (i, j), (power, mean_diff) in zip(cells, results):
+        significance_heatmap[i, j] = power
+        mean_diff_heatmap[i, j] = mean_diff
+
+    return significance_heatmap, mean_diff_heatmap
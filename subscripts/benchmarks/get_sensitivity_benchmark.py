@@ -0,0 +1,87 @@
+# benchmark of per-cell statistics in get_sensitivity on large synthetic 3D masks:
+# regionprops + per-image merges (previous implementation) vs. bincount on the label array (current)
+# run from the subscripts folder: python benchmarks/get_sensitivity_benchmark.py
+
+import os
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+from skimage.measure import regionprops
+from skimage.morphology import label
+from skimage.segmentation import clear_border
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.spot_analysis import get_sensitivity
+
+
+# random 3D mask with box-shaped cells not touching the border
+def make_mask(shape, n_cells, rng):
+    mask = np.zeros(shape, dtype=np.int32)
+    for cell in range(1, n_cells + 1):
+        start = rng.integers(1, np.array(shape) - np.array(shape) // 4 - 1)
+        end = start + rng.integers(np.array(shape) // 8, np.array(shape) // 4)
+        mask[tuple(slice(s, e) for s, e in zip(start, end))] = cell
+    return mask
+
+
+# per-cell statistics of one image as computed before (regionprops, cross / outer merges)
+def cell_statistics_regionprops(cleared_mask, subset_df):
+    cell = cleared_mask[subset_df['z'].astype(int), subset_df['y'].astype(int), subset_df['x'].astype(int)]
+    subset_df = subset_df.assign(cell=cell)
+
+    img_names_current = pd.DataFrame({'img': subset_df['img'].unique()})
+    cell_df = img_names_current.merge(pd.DataFrame({'cell': np.unique(cleared_mask)}), how='cross')
+    spots = subset_df.groupby(['img', 'cell']).size().reset_index(name='count')
+    cell_df = cell_df.merge(spots, on=['img', 'cell'], how='outer')
+    cell_df['count'] = cell_df['count'].fillna(0)
+
+    cell_sizes = pd.DataFrame([[prop.label, prop.area] for prop in regionprops(cleared_mask)], columns=['cell', 'cell_size'])
+    return cell_df.merge(cell_sizes, on='cell', how='outer')
+
+
+# per-cell statistics of one image via bincount (as in get_sensitivity)
+def cell_statistics_bincount(cleared_mask, subset_df):
+    cell_sizes = np.bincount(cleared_mask.ravel())
+    coords = subset_df[['z', 'y', 'x']].values.astype(int)
+    counts = np.bincount(cleared_mask[tuple(coords.T)], minlength=len(cell_sizes))
+    cells = np.flatnonzero(cell_sizes)
+    return pd.DataFrame({'cell': cells, 'count': counts[cells], 'cell_size': cell_sizes[cells]})
+
+
+def main(shape=(32, 1024, 1024), n_cells=200, n_spots=20_000, n_images=4, seed=0):
+
+    rng = np.random.default_rng(seed)
+    print(f"{n_images} masks of shape {shape}, {n_cells} cells, {n_spots} spots each")
+
+    with TemporaryDirectory() as tmp:
+
+        masks, spots = [], []
+        for i in range(n_images):
+            mask = make_mask(shape, n_cells, rng)
+            np.save(f"{tmp}/img{i}_ch0_seg.npy", {'masks': mask})
+            masks.append(f"{tmp}/img{i}_ch0_seg.npy")
+            spots.append(pd.DataFrame({
+                'img': f"{tmp}/tif/img{i}_ch1.tif", 'channel': 1,
+                'x': rng.uniform(0, shape[2] - 1, n_spots), 'y': rng.uniform(0, shape[1] - 1, n_spots),
+                'z': rng.uniform(0, shape[0] - 1, n_spots), 't': 1, 'c': 1, 'intensity': 1.0}))
+        pd.concat(spots).to_csv(f"{tmp}/spots.csv", index=False)
+
+        # per-cell statistics only (same labelled mask for both)
+        cleared_mask = clear_border(label(np.load(masks[0], allow_pickle=True).item()['masks']))
+        for name, fun in [('regionprops + merges', cell_statistics_regionprops), ('bincount', cell_statistics_bincount)]:
+            start = time.perf_counter()
+            fun(cleared_mask, spots[0])
+            print(f"per-cell statistics, {name}: {time.perf_counter() - start:.3f} s per image")
+
+        # whole stage
+        for n_workers in (None, 2):
+            start = time.perf_counter()
+            get_sensitivity(masks, f"{tmp}/spots.csv", f"{tmp}/spots_per_cell.csv", mask_ending="_seg", n_workers=n_workers)
+            print(f"get_sensitivity, n_workers={n_workers}: {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules in subscripts/utils are imported as utils.<module> (like in the notebooks)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# analysis modules in plots_analyses are imported directly (like in its notebooks)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'plots_analyses'))
@@ -0,0 +1,65 @@
+import json
+import stat
+import sys
+
+import pytest
+
+from utils.spot_detection import detect_spots
+
+
+SETTINGS = """anisotropyCoefficient : 1.0
+RANSAC : RANSAC
+min intensity : 0.0
+max intensity : 1000.0
+SigmaDoG : 1.5
+ThresholdDoG : 0.01
+supportRadius : 3
+InlierRatio : 0.1
+MaxError : 1.5
+intensityThreshold : 0.0
+bsMethod : No background subtraction
+bsMaxError : 0.05
+bsInlierRatio : 0.1
+"""
+
+# stand-in for the ImageJ launcher: records its arguments in the output folder, fails for channel 2
+STUB_FIJI = """#!{python}
+import json, sys
+macro_arguments = sys.argv[-1].split(",")
+out_path, channel = macro_arguments[1], macro_arguments[-1]
+with open(f"{{out_path}}/call_ch{{channel}}.json", "w") as fd:
+    json.dump(sys.argv[1:], fd)
+sys.exit(1 if channel == "2" else 0)
+"""
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    (tmp_path / "tif").mkdir()
+    fiji = tmp_path / "fiji"
+    fiji.write_text(STUB_FIJI.format(python=sys.executable))
+    fiji.chmod(fiji.stat().st_mode | stat.S_IEXEC)
+    for channel in (1, 2):
+        (tmp_path / f"ch{channel}.txt").write_text(SETTINGS)
+    return tmp_path
+
+
+def test_detect_spots_fiji_runs_jobs(dataset):
+    detect_spots(str(dataset), [str(dataset / "ch1.txt")], [1], macro_path="macro.ijm", fiji_path=str(dataset / "fiji"))
+
+    out_path = dataset / "detections"
+    args = json.loads((out_path / "call_ch1.json").read_text())
+    assert args[:3] == ["--headless", "-macro", "macro.ijm"]
+    assert args[3].startswith(f"{dataset}/tif/,")
+
+    manifest = json.loads((out_path / "detection_manifest.json").read_text())
+    assert manifest["n_jobs"] == 1 and manifest["n_failed"] == 0
+
+
+def test_detect_spots_fiji_reports_failed_channels(dataset):
+    with pytest.raises(RuntimeError, match=r"channel\(s\) \[2\]"):
+        detect_spots(str(dataset), [str(dataset / "ch1.txt"), str(dataset / "ch2.txt")], [1, 2],
+                     macro_path="macro.ijm", fiji_path=str(dataset / "fiji"), n_workers=2)
+
+    manifest = json.loads((dataset / "detections" / "detection_manifest.json").read_text())
+    assert [record["success"] for record in manifest["jobs"]] == [True, False]
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from scipy.stats import mannwhitneyu
+
+from power_simulation import mannwhitneyu_batch, power_grid
+
+
+@pytest.mark.parametrize('ties', [False, True])
+def test_mannwhitneyu_batch_matches_scipy(ties):
+    rng = np.random.default_rng(0)
+    x = rng.normal(0, 1, (50, 30))
+    y = rng.normal(0.3, 1, (50, 40))
+    if ties:
+        # coarse values: (almost) every row has ties within and between samples
+        x, y = np.round(x, 1), np.round(y, 1)
+
+    u1, p = mannwhitneyu_batch(x, y)
+
+    for row in range(len(x)):
+        expected = mannwhitneyu(x[row], y[row], alternative='two-sided', method='asymptotic', use_continuity=True)
+        assert u1[row] == pytest.approx(expected.statistic, rel=1e-12)
+        assert p[row] == pytest.approx(expected.pvalue, rel=1e-10)
+
+
+# results only depend on the seed, not on the number of workers
+def test_power_grid_independent_of_workers():
+    parameters = dict(bias=[0, 20], noise_sd=[0, 10, 30], mu=100, delta_mu=10, N=50)
+
+    sequential = power_grid(parameters, n_sims=40, seed=1, n_workers=1, batch_size=16)
+    parallel = power_grid(parameters, n_sims=40, seed=1, n_workers=3, batch_size=16)
+
+    for a, b in zip(sequential, parallel):
+        assert a.shape == (2, 3)
+        np.testing.assert_array_equal(a, b)
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.radial_symmetry import detect_spots_array, parse_rs_parameters
+
+
+PARAMETERS = {
+    'anisotropyCoefficient': '1.3',
+    'RANSAC': 'RANSAC',
+    'min intensity': '0.0',
+    'max intensity': '1200.0',
+    'SigmaDoG': '1.5',
+    'ThresholdDoG': '0.02',
+    'supportRadius': '3',
+    'InlierRatio': '0.1',
+    'MaxError': '1.5',
+    'intensityThreshold': '0.0',
+    'bsMethod': 'No background subtraction',
+    'bsMaxError': '0.05',
+    'bsInlierRatio': '0.1',
+}
+
+
+# gaussian spots (sigma 1.5 in yx, 2 in z) at random subpixel positions on a noisy background
+# spots are placed on a jittered grid so they do not overlap, returns image and zyx positions
+def synthetic_spots(shape=(24, 120, 120), spacing=20, seed=0):
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[tuple(slice(0, s) for s in shape)]
+
+    centers = np.array([[shape[0] / 2, cy, cx]
+                        for cy in range(spacing // 2, shape[1], spacing)
+                        for cx in range(spacing // 2, shape[2], spacing)])
+    centers += rng.uniform(-2, 2, centers.shape) * [2, 1, 1]
+
+    img = rng.normal(200, 5, shape)
+    for cz, cy, cx in centers:
+        img += 800 * np.exp(-((x - cx)**2 / (2 * 1.5**2) + (y - cy)**2 / (2 * 1.5**2) + (z - cz)**2 / (2 * 2.0**2)))
+
+    return img.astype(np.uint16), centers
+
+
+def sorted_spots(df):
+    return df.sort_values(['z', 'y', 'x']).reset_index(drop=True)
+
+
+def test_localization_error():
+    img, centers = synthetic_spots()
+    spots = detect_spots_array(img, PARAMETERS, block_size=(1000, 1000, 1000))
+
+    # every spot is found once, close to its true position
+    distances = np.linalg.norm(spots[['z', 'y', 'x']].values[:, np.newaxis] - centers[np.newaxis], axis=-1)
+    assert len(spots) == len(centers)
+    assert np.array_equal(np.sort(distances.argmin(axis=1)), np.arange(len(centers)))
+    assert distances.min(axis=1).max() < 0.1
+
+
+def test_independent_of_blocks_and_workers():
+    img, _ = synthetic_spots()
+    whole = sorted_spots(detect_spots_array(img, PARAMETERS, block_size=(1000, 1000, 1000)))
+
+    for block_size, n_workers in [((8, 50, 50), None), ((8, 50, 50), 3), ((16, 37, 64), 2)]:
+        tiled = sorted_spots(detect_spots_array(img, PARAMETERS, block_size=block_size, n_workers=n_workers))
+        pd.testing.assert_frame_equal(tiled, whole)
+
+
+def test_empty_intensity_range():
+    with pytest.raises(ValueError, match='max intensity'):
+        parse_rs_parameters(dict(PARAMETERS, **{'max intensity': '0.0'}))
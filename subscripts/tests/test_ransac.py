@@ -0,0 +1,49 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from utils.ransac import estimate_euclidean_batch, estimate_similarity_batch, ransac_transform
+
+
+def random_rigid_problems(n, n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    rotations = Rotation.random(n, random_state=seed).as_matrix()
+    translations = rng.normal(size=(n, 3))
+    src = rng.normal(size=(n, n_points, 3))
+    dst = np.einsum('bij,bmj->bmi', rotations, src) + translations[:, np.newaxis]
+    return src, dst, rotations, translations
+
+
+# minimal sets of 3 points have a rank 2 covariance, the estimate must still be a proper rotation
+def test_three_point_sets_give_rotations():
+    src, dst, rotations, translations = random_rigid_problems(2000, 3)
+
+    for estimate in (estimate_euclidean_batch, estimate_similarity_batch):
+        matrices, valid = estimate(src, dst)
+        assert valid.all()
+        assert (np.linalg.det(matrices[:, :3, :3]) > 0).all()
+        np.testing.assert_allclose(matrices[:, :3, :3], rotations, atol=1e-8)
+        np.testing.assert_allclose(matrices[:, :3, 3], translations, atol=1e-8)
+
+
+def test_collinear_sets_are_invalid():
+    src = np.array([[[0, 0, 0], [1, 1, 1], [2, 2, 2]]], dtype=float)
+    _, valid = estimate_euclidean_batch(src, src + 1)
+    assert not valid.any()
+
+
+def test_ransac_euclidean_with_outliers():
+    rng = np.random.default_rng(1)
+    src, _, rotations, translations = random_rigid_problems(1, 500, seed=1)
+    src = src[0] * 20
+    dst = src @ rotations[0].T + translations[0] + rng.normal(0, 0.01, src.shape)
+    outliers = rng.random(len(src)) < 0.3
+    dst[outliers] += rng.normal(0, 5, (outliers.sum(), 3))
+
+    matrix, inliers = ransac_transform(src, dst, 'euclidean', 3, residual_threshold=0.1, random_state=0)
+    matrix2, inliers2 = ransac_transform(src, dst, 'euclidean', 3, residual_threshold=0.1, random_state=0)
+
+    np.testing.assert_allclose(matrix[:3, :3], rotations[0], atol=1e-3)
+    assert (inliers & outliers).sum() <= 2
+    assert inliers[~outliers].mean() > 0.99
+    np.testing.assert_array_equal(matrix, matrix2)
+    np.testing.assert_array_equal(inliers, inliers2)
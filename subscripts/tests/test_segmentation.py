@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from skimage.measure import label
+
+from utils.segmentation import remove_small_labels, segment_tiled, tile_starts
+
+
+# threshold-based stand-in for cellpose
+def threshold_segmenter(tile):
+    return label(tile > 0.5)
+
+
+# non-touching ellipsoids (yx radius up to max_radius) on a jittered grid
+def ellipsoid_volume(shape=(10, 200, 260), spacing=64, max_radius=26, seed=0):
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[tuple(slice(0, s) for s in shape)]
+    img = np.zeros(shape)
+    for cy in range(spacing // 2, shape[1], spacing):
+        for cx in range(spacing // 2, shape[2], spacing):
+            ry, rx = rng.integers(max_radius // 2, max_radius + 1, size=2)
+            cy_j, cx_j = cy + rng.integers(-3, 4), cx + rng.integers(-3, 4)
+            img[((z - shape[0] / 2) / 4)**2 + ((y - cy_j) / ry)**2 + ((x - cx_j) / rx)**2 <= 1] = 1
+    return img
+
+
+# same partition up to label numbers: every label maps to exactly one label of the other mask
+def assert_same_labelling(a, b):
+    assert np.array_equal(a > 0, b > 0)
+    pairs = np.unique(np.stack([a[a > 0], b[b > 0]]), axis=1)
+    assert len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+def test_tile_starts_cover_axis():
+    starts = tile_starts(500, 150, 40)
+    assert starts[0] == 0 and starts[-1] == 500 - 150
+    assert all(b - a <= 150 - 40 for a, b in zip(starts[:-1], starts[1:]))
+    assert tile_starts(100, 150, 40) == [0]
+
+
+# overlap larger than the cells, smaller than the cells, no tiling
+@pytest.mark.parametrize('tile_shape, overlap', [((10, 100, 100), 60), ((10, 64, 80), 8), ((10, 200, 260), 0)])
+def test_tiled_matches_whole_image(tile_shape, overlap):
+    img = ellipsoid_volume()
+    tiled = segment_tiled(img, threshold_segmenter, tile_shape, overlap)
+
+    whole = threshold_segmenter(img)
+    assert tiled.max() == whole.max()
+    assert_same_labelling(tiled, whole)
+
+
+# min_size is applied after stitching: cells cut by tile borders are not removed
+def test_min_size_after_stitching():
+    img = ellipsoid_volume()
+    whole = threshold_segmenter(img)
+    min_size = int(np.median(np.bincount(whole.ravel())[1:]))
+
+    tiled = segment_tiled(img, threshold_segmenter, (10, 64, 80), 8, min_size=min_size)
+    assert_same_labelling(tiled, remove_small_labels(whole, min_size))
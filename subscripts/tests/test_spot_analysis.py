@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from utils.spot_analysis import add_cell_info, get_sensitivity
+
+
+# spot tables of 2D images have no z column, 2D masks only need yx
+def test_2d_spots_without_z(tmp_path):
+    mask = np.zeros((100, 100), dtype=np.int32)
+    mask[20:40, 20:40] = 1
+    mask[60:80, 50:90] = 2
+    mask_file = tmp_path / 'img0_ch0_seg.npy'
+    np.save(mask_file, {'masks': mask})
+
+    spots = pd.DataFrame({
+        'img': ['/d/tif/img0_ch1.tif'] * 4,
+        'channel': [1] * 4,
+        'x': [30.2, 25.0, 70.7, 5.0],
+        'y': [30.1, 35.5, 70.2, 5.0],
+    })
+    spots.to_csv(tmp_path / 'spots.csv', index=False)
+
+    add_cell_info([str(mask_file)], tmp_path / 'spots.csv', tmp_path / 'cells.csv', mask_ending='_seg')
+    cells = pd.read_csv(tmp_path / 'cells.csv')
+    assert cells['cell'].tolist() == [1, 1, 2]
+
+    get_sensitivity([str(mask_file)], tmp_path / 'spots.csv', tmp_path / 'sensitivity.csv', mask_ending='_seg',
+                    min_cell_size=0)
+    sensitivity = pd.read_csv(tmp_path / 'sensitivity.csv')
+    assert dict(zip(sensitivity['cell'], sensitivity['count'])) == {1: 2, 2: 1}
@@ -0,0 +1,23 @@
+import pandas as pd
+
+from utils.spot_store import list_partitions, read_spots, update_spots, write_spots
+
+
+# images with the same file name in different folders must not share a partition
+def test_same_file_name_in_different_folders(tmp_path):
+    store_file = tmp_path / 'spots.h5'
+    df = pd.DataFrame({
+        'img': ['/a/tif/img0_ch0.tif', '/a/tif/img0_ch0.tif', '/b/tif/img0_ch0.tif'],
+        'channel': [0, 0, 0],
+        'x': [1.0, 2.0, 3.0],
+    })
+    write_spots(store_file, df)
+
+    assert len(list_partitions(store_file)) == 2
+    pd.testing.assert_frame_equal(read_spots(store_file), df)
+
+    only_b = read_spots(store_file, images=['/b/tif/img0_ch0.tif'])
+    assert only_b['x'].tolist() == [3.0]
+
+    update_spots(store_file, lambda d: d.assign(x=d['x'] * 10), images=['/a/tif/img0_ch0.tif'])
+    assert read_spots(store_file)['x'].tolist() == [10.0, 20.0, 3.0]
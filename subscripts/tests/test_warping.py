@@ -0,0 +1,64 @@
+import h5py as h5
+import numpy as np
+import pytest
+from scipy.ndimage import affine_transform
+from scipy.spatial.transform import Rotation
+
+from utils.warping import warp_affine, warp_channels
+
+
+def random_image(shape, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.random(shape) * 4000).astype(dtype)
+
+
+def matrix_3d():
+    matrix = np.eye(4)
+    matrix[:3, :3] = Rotation.from_euler('zyx', [2, 0.5, 0.3], degrees=True).as_matrix() * 1.003
+    matrix[:3, 3] = [0.7, -3.2, 5.5]
+    return matrix
+
+
+def matrix_2d():
+    matrix = np.eye(3)
+    matrix[:2, :2] = Rotation.from_euler('z', 5, degrees=True).as_matrix()[:2, :2]
+    matrix[:2, 2] = [4, -7]
+    return matrix
+
+
+# blocks (smaller than the image, not dividing its shape) give the same result as one full-volume affine_transform
+@pytest.mark.parametrize('order', [0, 1])
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+@pytest.mark.parametrize('shape, matrix', [((20, 90, 70), matrix_3d()), ((90, 70), matrix_2d())])
+def test_blocks_match_full_volume(shape, matrix, dtype, order):
+    img = random_image(shape, dtype)
+    warped = warp_affine(img, matrix, block_shape=(8, 32, 32), order=order)
+    np.testing.assert_array_equal(warped, affine_transform(img, matrix, order=order))
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parallel_executors(executor):
+    img = random_image((20, 90, 70), np.uint16)
+    warped = warp_affine(img, matrix_3d(), block_shape=(8, 32, 32), n_workers=2, executor=executor, max_pending=3)
+    np.testing.assert_array_equal(warped, affine_transform(img, matrix_3d(), order=1))
+
+
+def test_blocks_outside_input_get_cval():
+    matrix = matrix_3d()
+    matrix[:3, 3] += 1000
+    warped = warp_affine(random_image((20, 90, 70), np.uint16), matrix, block_shape=(8, 32, 32), cval=7)
+    assert np.all(warped == 7)
+
+
+def test_warp_channels_to_hdf5(tmp_path):
+    img = random_image((20, 90, 70), np.uint16)
+    out_file = tmp_path / 'warped.h5'
+
+    warped = warp_channels({'ref': img, 'moving': img}, {'moving': matrix_3d()}, out_file=out_file,
+                           block_shape=(8, 32, 32))
+
+    assert warped == {'ref': 'ref', 'moving': 'moving'}
+    with h5.File(out_file, 'r') as fd:
+        assert fd['moving'].chunks == (8, 32, 32)
+        np.testing.assert_array_equal(fd['moving'][()], affine_transform(img, matrix_3d(), order=1))
+        np.testing.assert_array_equal(fd['ref'][()], img)
@@ -0,0 +1,270 @@
+# chromatic aberration estimation by image registration (see chromatic_aberration_estimation_elastix.ipynb)
+# instead of registering all pairs of channels at full resolution, each channel is only registered to a reference
+# channel: first on a downsampled level (2x in yx per level, as in utils.image_store), then refined on finer levels
+# with the moving image pre-aligned by the current estimate
+# transforms between other pairs are composed from the reference transforms, channels are registered in parallel,
+# downsampled levels are cached on disk (keyed by a hash of the image)
+#
+# transforms follow the convention of the notebook: transforms[(ch1, ch2)] maps world coordinates of ch1 to ch2
+# (the result of registering img1 (fixed) and img2 (moving) with elastix)
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.ndimage import affine_transform
+from scipy.spatial.transform import Rotation as R
+
+from calmutils.stitching import translation_matrix
+
+from utils.image_store import downsample_yx
+
+
+############# elastix #################
+
+def elastix_similarity_to_matrix(elastix_parameter_object, ndim=3):
+    if ndim==3:
+        return elastix_similarity_to_matrix_3d(elastix_parameter_object)
+    elif ndim==2:
+        return elastix_similarity_to_matrix_2d(elastix_parameter_object)
+    else:
+        raise ValueError('only 2D/3D similarity transform supported at the moment')
+
+
+def elastix_similarity_to_matrix_2d(elastix_parameter_object):
+
+    # check if we actually have the right type of transform
+    transform_type, = elastix_parameter_object.GetParameter(0, 'Transform')
+    n_parameters, = elastix_parameter_object.GetParameter(0, 'NumberOfParameters')
+
+    if transform_type != 'SimilarityTransform' or int(n_parameters) != 4:
+        raise ValueError('only 2D similarity transform supported at the moment')
+
+    # get center of rotation, NOTE: GetParameter returns tuple of str, map to float
+    cx, cy = map(float, elastix_parameter_object.GetParameter(0, 'CenterOfRotationPoint'))
+    # get rotation quat, translation, scale
+    s, rot, tx, ty = map(float, elastix_parameter_object.GetParameter(0, 'TransformParameters'))
+
+    # build augmented matrices for individual steps
+    # move to center
+    c_mat = np.eye(3)
+    c_mat[:-1, -1] = [cy, cx]
+
+    # move translation
+    t_mat = np.eye(3)
+    t_mat[:-1, -1] = [ty, tx]
+
+    # scale
+    s_mat = np.diag([s, s, 1])
+
+    # rotation
+    r_mat = R.from_euler('zyx', [rot, 0, 0]).as_matrix()
+    # explicitly set bottom row again, otherwise affine_transform complained about it being not exactly 0,0,1
+    r_mat[2] = [0,0,1]
+
+    # final (similarity) transform matrix constructed as in elastix documentation, right-to-left!
+    # add c @ add t @ scale @ r @ sub c
+    mat = c_mat @ t_mat @ s_mat @ r_mat @ np.linalg.inv(c_mat)
+
+    return mat
+
+
+def elastix_similarity_to_matrix_3d(elastix_parameter_object):
+
+    # check if we actually have the right type of transform
+    transform_type, = elastix_parameter_object.GetParameter(0, 'Transform')
+    n_parameters, = elastix_parameter_object.GetParameter(0, 'NumberOfParameters')
+
+    if transform_type != 'SimilarityTransform' or int(n_parameters) != 7:
+        raise ValueError('only 3D similarity transform supported at the moment')
+
+    # get center of rotation, NOTE: GetParameter returns tuple of str, map to float
+    cx, cy, cz = map(float, elastix_parameter_object.GetParameter(0, 'CenterOfRotationPoint'))
+    # get rotation quat, translation, scale
+    qx, qy, qz, tx, ty, tz, s = map(float, elastix_parameter_object.GetParameter(0, 'TransformParameters'))
+
+    # build augmented matrices for individual steps
+    # move to center
+    c_mat = np.eye(4)
+    c_mat[:-1, -1] = [cz, cy, cx]
+
+    # move translation
+    t_mat = np.eye(4)
+    t_mat[:-1, -1] = [tz, ty, tx]
+
+    # scale
+    s_mat = np.diag([s, s, s, 1])
+
+    # rotation
+    r_mat = np.eye(4)
+    r_mat[:3, :3] = R.from_quat([qz, qy, qx, 1]).as_matrix()
+
+    # final (similarity) transform matrix constructed as in elastix documentation, right-to-left!
+    # add c @ add t @ scale @ r @ sub c
+    mat = c_mat @ t_mat @ s_mat @ r_mat @ np.linalg.inv(c_mat)
+
+    return mat
+
+
+def world_coordinate_transform_to_pixel(transform_matrix, pixel_size):
+    pixel_scale_mat = np.diag(list(pixel_size) + [1])
+    mat = np.linalg.inv(pixel_scale_mat) @ transform_matrix @ pixel_scale_mat
+    return mat
+
+
+# similarity transform img1 (fixed) -> img2 (moving) in world coordinates
+# parameter_overrides: dict of elastix parameters to set in the (affine default) parameter map, e.g. {'NumberOfResolutions': ['1']}
+def elastix_registration(img1, img2, pixel_size, parameter_overrides=None):
+
+    # optional dependency, only needed for registration
+    import itk
+
+    # numpy to ITK
+    img_target = img1.astype(np.float32)
+    img_moving = img2.astype(np.float32)
+    img_target = itk.image_from_array(img_target)
+    img_moving = itk.image_from_array(img_moving)
+    # set pixel size to get transform in world coordinate units
+    img_target.SetSpacing(list(pixel_size)[::-1])
+    img_moving.SetSpacing(list(pixel_size)[::-1])
+
+    # construct ITK parameter object
+    elastix_parameters = itk.ParameterObject.New()
+    # add transform, overwrite affine defaults to get similarity
+    similarity_parameter_map = elastix_parameters.GetDefaultParameterMap('affine')
+    similarity_parameter_map['Transform'] = ['SimilarityTransform']
+    similarity_parameter_map['NumberOfSpatialSamples'] = [f'{8192}']
+    for k, v in (parameter_overrides or {}).items():
+        similarity_parameter_map[k] = v
+    elastix_parameters.AddParameterMap(similarity_parameter_map)
+
+    # Call registration function
+    _, estimated_transform_parameters = itk.elastix_registration_method(img_target, img_moving, parameter_object=elastix_parameters)
+
+    return elastix_similarity_to_matrix(estimated_transform_parameters, img1.ndim)
+
+
+############# pyramid #################
+
+# default cache folder name for downsampled levels
+PYRAMID_CACHE_DIR_NAME = "pyramid_cache"
+
+
+def image_hash(img):
+    h = hashlib.sha256()
+    img = np.ascontiguousarray(img)
+    h.update(f"{img.shape}{img.dtype}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+# image (zyx or yx) downsampled level times by 2x in yx
+# cached in cache_dir if given (loaded memory-mapped), key: hash of the full resolution image
+def pyramid_level(img, level, cache_dir=None, key=None):
+
+    if level == 0:
+        return img
+
+    if cache_dir is not None:
+        key = image_hash(img) if key is None else key
+        cache_file = os.path.join(cache_dir, f"{key}_level{level}.npy")
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+
+    # levels are built on the next finer (cached) level
+    downsampled = pyramid_level(img, level - 1, cache_dir, key)
+    downsampled = downsample_yx(np.asarray(downsampled)[np.newaxis] if img.ndim == 2 else np.asarray(downsampled))
+    if img.ndim == 2:
+        downsampled = downsampled[0]
+
+    if cache_dir is not None:
+        # written to a temporary file first (parallel workers may build the same level)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = os.path.join(cache_dir, f"{key}_level{level}.{os.getpid()}.tmp.npy")
+        np.save(tmp_file, downsampled)
+        os.replace(tmp_file, cache_file)
+
+    return downsampled
+
+
+# pixel size of a pyramid level and translation of the level's pixel grid (centers of 2^level blocks)
+# relative to the full resolution grid, in world units
+def pyramid_level_geometry(pixel_size, level):
+    factors = np.ones(len(pixel_size))
+    factors[-2:] = 2**level
+    pixel_size = np.asarray(pixel_size, dtype=float)
+    return pixel_size * factors, (factors - 1) / 2 * pixel_size
+
+
+############# registration to reference #################
+
+# transform fixed -> moving (world coordinates), coarse-to-fine over pyramid levels (e.g. (2, 0)):
+# at each level, the moving image is pre-aligned with the current estimate and the remaining transform is registered
+# register: function (img1, img2, pixel_size, parameter_overrides) -> matrix, e.g. elastix_registration
+# refine_parameter_overrides: used on all but the first level (e.g. a single resolution in elastix)
+def register_multiresolution(fixed, moving, pixel_size, levels=(2, 0), cache_dir=None, register=elastix_registration,
+                             parameter_overrides=None, refine_parameter_overrides=None, order=1):
+
+    transform = np.eye(len(pixel_size) + 1)
+    key_fixed = image_hash(fixed) if cache_dir is not None else None
+    key_moving = image_hash(moving) if cache_dir is not None else None
+
+    for i, level in enumerate(levels):
+
+        fixed_level = np.asarray(pyramid_level(fixed, level, cache_dir, key_fixed))
+        moving_level = np.asarray(pyramid_level(moving, level, cache_dir, key_moving))
+        pixel_size_level, offset = pyramid_level_geometry(pixel_size, level)
+
+        # current estimate in the coordinates of the level (origin at the first level pixel center)
+        shift = translation_matrix(offset)
+        transform_level = np.linalg.inv(shift) @ transform @ shift
+
+        if i > 0:
+            moving_level = affine_transform(moving_level.astype(np.float32),
+                                            world_coordinate_transform_to_pixel(transform_level, pixel_size_level), order=order)
+
+        overrides = parameter_overrides if i == 0 else (refine_parameter_overrides or parameter_overrides)
+        update = register(fixed_level, moving_level, pixel_size_level, overrides)
+        transform = transform @ shift @ update @ np.linalg.inv(shift)
+
+    return transform
+
+
+# wrapper for process pool
+def _register_channel_task(task):
+    channel, fixed, moving, pixel_size, kwargs = task
+    return channel, register_multiresolution(fixed, moving, pixel_size, **kwargs)
+
+
+# transforms between all pairs of channels from registrations of each channel to the reference only
+# images: dict channel name -> image, n_workers channels are registered in parallel
+# returns dict (ch1, ch2) -> matrix for all ordered pairs (ready for corrections.save_transforms)
+def estimate_chromatic_transforms(images, pixel_size, reference_channel, levels=(2, 0), cache_dir=None,
+                                  n_workers=None, register=elastix_registration, parameter_overrides=None,
+                                  refine_parameter_overrides=None):
+
+    kwargs = dict(levels=levels, cache_dir=cache_dir, register=register, parameter_overrides=parameter_overrides,
+                  refine_parameter_overrides=refine_parameter_overrides)
+    tasks = [(ch, images[reference_channel], img, pixel_size, kwargs) for ch, img in images.items() if ch != reference_channel]
+
+    if n_workers is None or n_workers <= 1:
+        results = list(map(_register_channel_task, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_register_channel_task, tasks))
+
+    # reference -> channel and inverse
+    to_channel = {reference_channel: np.eye(len(pixel_size) + 1)}
+    for ch, transform in results:
+        to_channel[ch] = transform
+        print(f'estimated similarity transform between {reference_channel} and {ch}')
+
+    # other pairs via the reference: (ch1 -> reference) then (reference -> ch2)
+    transforms = {}
+    for ch1 in images:
+        for ch2 in images:
+            if ch1 != ch2:
+                transforms[(ch1, ch2)] = to_channel[ch2] @ np.linalg.inv(to_channel[ch1])
+
+    return transforms
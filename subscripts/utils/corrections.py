@@ -1,42 +1,35 @@
+import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from utils.spot_store import read_spot_table, write_spots
+
 
 def augment_coords(coords):
     # helper function to add extra 4th column of 1s so we can just multipy with transform matrix
     return np.hstack((coords, np.ones_like(coords, shape=(len(coords), 1))))
 
-def correct_chrom_shift(in_path,
-                        out_path,
-                        csv_string,
-                        transforms_path,
-                        reference_channel, 
-                        coordinate_column_names_unit=None,
-                        coordinate_column_names_pixel=None,
-                        channel_column_name = 'channel',
-                        pixel_size = None,
-                        channel_aliases = {
-                            '405 CSU-W1': '405-CSU-W1',
-                            '488 CSU-W1': '488-CSU-W1',
-                            '561 CSU-W1': '561 CSU-W1',
-                            '640 CSU-W1': '640 CSU-W1'}
-                       ):
-    
-    ##### formatting and parameters #####
-    # how to name columns that are added to tables
-    column_name_suffix = ''
-    reference_channel_column_name = 'shift_reference_channel'
+# channel renaming used if no aliases are given: name in JSON -> name in coordinate tables
+DEFAULT_CHANNEL_ALIASES = {
+    '405 CSU-W1': '405-CSU-W1',
+    '488 CSU-W1': '488-CSU-W1',
+    '561 CSU-W1': '561 CSU-W1',
+    '640 CSU-W1': '640 CSU-W1'}
+
+# name of the column added to corrected tables
+REFERENCE_CHANNEL_COLUMN_NAME = 'shift_reference_channel'
+
+
+# parse transforms JSON (cached per file, modification time and aliases)
+@lru_cache(maxsize=32)
+def _load_transforms(transforms_path, mtime, channel_aliases):
+
+    channel_aliases = dict(channel_aliases)
 
-    # check if enough information is given, raise Error otherwise
-    if coordinate_column_names_pixel is None and coordinate_column_names_unit is None:
-        raise ValueError('Please specify either pixel or unit columns to transform (or both)')
-    if pixel_size is None and coordinate_column_names_unit is None:
-        raise ValueError('You need to specify pixel size if only pixel coordinates are given')
-      
-    
-    ##### open file and reshape #####
     with open(transforms_path) as fd:
         transform_info = json.load(fd)
 
@@ -52,63 +45,183 @@ def correct_chrom_shift(in_path,
 
         transforms[tuple(channels)] = tr
 
-    in_files = sorted(in_path.glob(csv_string))
-    
-    ##### correct shift #####
-    # make out path if it does not exist already
-    if not out_path.exists():
-        out_path.mkdir()
+    return transforms
+
+
+# dict channel pair -> 4x4 transform matrix from a transforms JSON file (with channel renaming)
+# the file is only parsed again if it was modified
+def load_transforms(transforms_path, channel_aliases=DEFAULT_CHANNEL_ALIASES):
+    return dict(_load_transforms(str(transforms_path), os.path.getmtime(transforms_path), tuple(channel_aliases.items())))
+
+
+# save dict channel pair -> 4x4 transform matrix as transforms JSON (readable by load_transforms / correct_chrom_shift)
+# source_files: list of files or a single file, pixel_size / field_of_view are only saved if given
+def save_transforms(out_file, transforms, channels, source_files, size_unit='micron', z_direction='bottom_to_top',
+                    pixel_size=None, field_of_view=None):
+
+    output = {'channels' : list(channels)}
+    if pixel_size is not None:
+        output['pixel_size'] = [float(p) for p in pixel_size]
+    output['size_unit'] = size_unit
+    output['z_direction'] = z_direction
+    if field_of_view is not None:
+        output['field_of_view'] = [float(f) for f in field_of_view]
+    output['source_file'] = str(source_files) if isinstance(source_files, (str, os.PathLike)) else list(source_files)
+    output['transforms'] = [ {'channels' : list(k), 'parameters': list(np.asarray(v, dtype=float).flat)} for k,v in transforms.items()]
+
+    with open(out_file, 'w') as fd:
+        json.dump(output, fd, indent=1)
 
-    for in_file in in_files:
 
-        df = pd.read_csv(in_file)
+# transform coordinates (n, 3) of spots in different channels in one go
+# channel_idx: (n, ) index of the channel of each spot into matrices (k, 4, 4)
+def apply_channel_transforms(coords, channel_idx, matrices):
 
-        # automatically determine pixel size if both pixel and unit coordinates are present
-        # (we just use the first row, as we can assue it to be the same for every spot)
-        pixel_size_was_none = False
-        if pixel_size is None:
-            pixel_size = (df[coordinate_column_names_unit].values / df[coordinate_column_names_pixel].values)[0]
-            pixel_size_was_none = True
+    # gather the upper 3 rows of the matrix of each spot, (n, 3, 4)
+    matrices = matrices[:, :3][channel_idx]
 
-        dfs = []
-        for ch, dfi in df.groupby(channel_column_name):
+    # matrix @ augmented coordinates, summed in the same order as a matrix product (identical results)
+    coords_transformed = matrices[:, :, 0] * coords[:, 0:1]
+    for j in range(1, coords.shape[1]):
+        coords_transformed += matrices[:, :, j] * coords[:, j:j+1]
+    coords_transformed += matrices[:, :, 3]
 
-            # get the transform from current to reference channel
-            tr = transforms[(ch, reference_channel)]
+    return coords_transformed
+
+
+# correct the chromatic shift of all spots in a table, returns a corrected copy
+# transforms: dict channel pair -> 4x4 matrix (see load_transforms)
+# rows without channel are dropped
+def correct_chrom_shift_table(df,
+                              transforms,
+                              reference_channel,
+                              coordinate_column_names_unit=None,
+                              coordinate_column_names_pixel=None,
+                              channel_column_name='channel',
+                              pixel_size=None):
+
+    # check if enough information is given, raise Error otherwise
+    if coordinate_column_names_pixel is None and coordinate_column_names_unit is None:
+        raise ValueError('Please specify either pixel or unit columns to transform (or both)')
+    if pixel_size is None and coordinate_column_names_unit is None:
+        raise ValueError('You need to specify pixel size if only pixel coordinates are given')
 
-            # get coordinates to transform, 2 options:
-            # 1. if we have unit columns, use those
-            # 2. if we only have pixel columns, use those, multiply with pixel size
-            if coordinate_column_names_unit is not None:
-                coords = augment_coords(dfi[coordinate_column_names_unit].values).T
-            else:
-                coords = augment_coords(dfi[coordinate_column_names_pixel].values * pixel_size).T
+    # automatically determine pixel size if both pixel and unit coordinates are present
+    # (we just use the first row, as we can assue it to be the same for every spot)
+    if pixel_size is None and coordinate_column_names_pixel is not None:
+        pixel_size = (df[coordinate_column_names_unit].values / df[coordinate_column_names_pixel].values)[0]
 
-            # transform
-            coords_transformed = tr @ coords
+    df = df[df[channel_column_name].notna()].copy()
 
-            # add transformed coordinates in world coordinate units
-            if coordinate_column_names_unit is not None:
-                for i, dim_name in enumerate(coordinate_column_names_unit):
-                    dfi[dim_name + column_name_suffix] = coords_transformed[i]
+    # get the transform from every channel to reference channel
+    channel_idx, channels = pd.factorize(df[channel_column_name], sort=True)
+    matrices = np.array([transforms[(ch, reference_channel)] for ch in channels]).reshape(-1, 4, 4)
 
-            # add transformed pixel coordinates
-            if coordinate_column_names_pixel is not None:
-                for i, dim_name in enumerate(coordinate_column_names_pixel):
-                    dfi[dim_name + column_name_suffix] = coords_transformed[i] / pixel_size[i]
+    # get coordinates to transform, 2 options:
+    # 1. if we have unit columns, use those
+    # 2. if we only have pixel columns, use those, multiply with pixel size
+    if coordinate_column_names_unit is not None:
+        coords = df[coordinate_column_names_unit].values
+    else:
+        coords = df[coordinate_column_names_pixel].values * pixel_size
+    coords = np.asarray(coords, dtype=float)
 
-            # add reference channel
-            dfi[reference_channel_column_name] = reference_channel
-            dfs.append(dfi)
+    coords_transformed = apply_channel_transforms(coords, channel_idx, matrices)
 
-        # combine corrected dfs
-        df_corrected = pd.concat(dfs).sort_index()
+    # add transformed coordinates in world coordinate units
+    if coordinate_column_names_unit is not None:
+        for i, dim_name in enumerate(coordinate_column_names_unit):
+            df[dim_name] = coords_transformed[:, i]
 
-        # save
-        out_file = out_path / (in_file.stem + '_shift-corrected.csv')
+    # add transformed pixel coordinates
+    if coordinate_column_names_pixel is not None:
+        for i, dim_name in enumerate(coordinate_column_names_pixel):
+            df[dim_name] = coords_transformed[:, i] / pixel_size[i]
+
+    # add reference channel
+    df[REFERENCE_CHANNEL_COLUMN_NAME] = reference_channel
+
+    return df
+
+
+# correct one file, write <stem>_shift-corrected.csv (or .h5 spot store) to out_path, returns the output file
+def _correct_chrom_shift_file(in_file, out_path, transforms, reference_channel, kwargs, out_format):
+
+    df_corrected = correct_chrom_shift_table(read_spot_table(in_file), transforms, reference_channel, **kwargs)
+
+    out_file = Path(out_path) / (Path(in_file).stem + f'_shift-corrected.{out_format}')
+    if out_format == 'h5':
+        write_spots(out_file, df_corrected, channel_column=kwargs['channel_column_name'])
+    else:
         df_corrected.to_csv(out_file, index=False)
 
-        # reset pixel size so it is read again for the next table
-        if pixel_size_was_none:
-            pixel_size = None   
+    return out_file
+
+
+# wrapper for process pool
+def _correct_chrom_shift_task(task):
+    return _correct_chrom_shift_file(*task)
+
+
+# correct all tables matching csv_string in in_path, optionally with n_workers processes
+# out_format: 'csv' (default) or 'h5' (spot store, see spot_store.py, needs an img column)
+def correct_chrom_shift_batch(in_path,
+                              out_path,
+                              csv_string,
+                              transforms_path,
+                              reference_channel,
+                              coordinate_column_names_unit=None,
+                              coordinate_column_names_pixel=None,
+                              channel_column_name='channel',
+                              pixel_size=None,
+                              channel_aliases=DEFAULT_CHANNEL_ALIASES,
+                              n_workers=None,
+                              out_format='csv'):
+
+    if out_format not in ('csv', 'h5'):
+        raise ValueError(f"Unknown output format '{out_format}', use 'csv' or 'h5'.")
+    if coordinate_column_names_pixel is None and coordinate_column_names_unit is None:
+        raise ValueError('Please specify either pixel or unit columns to transform (or both)')
+    if pixel_size is None and coordinate_column_names_unit is None:
+        raise ValueError('You need to specify pixel size if only pixel coordinates are given')
+
+    # transforms are parsed once for all files
+    transforms = load_transforms(transforms_path, channel_aliases)
+
+    in_files = sorted(Path(in_path).glob(csv_string))
+
+    # make out path if it does not exist already
+    Path(out_path).mkdir(parents=True, exist_ok=True)
+
+    kwargs = dict(coordinate_column_names_unit=coordinate_column_names_unit,
+                  coordinate_column_names_pixel=coordinate_column_names_pixel,
+                  channel_column_name=channel_column_name,
+                  pixel_size=pixel_size)
+    tasks = [(in_file, out_path, transforms, reference_channel, kwargs, out_format) for in_file in in_files]
+
+    if n_workers is None or n_workers <= 1:
+        return [_correct_chrom_shift_task(task) for task in tasks]
+
+    # parsing / formatting of the tables dominates and holds the GIL -> processes
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_correct_chrom_shift_task, tasks))
+
+
+def correct_chrom_shift(in_path,
+                        out_path,
+                        csv_string,
+                        transforms_path,
+                        reference_channel, 
+                        coordinate_column_names_unit=None,
+                        coordinate_column_names_pixel=None,
+                        channel_column_name = 'channel',
+                        pixel_size = None,
+                        channel_aliases = DEFAULT_CHANNEL_ALIASES
+                       ):
 
+    correct_chrom_shift_batch(in_path, out_path, csv_string, transforms_path, reference_channel,
+                              coordinate_column_names_unit=coordinate_column_names_unit,
+                              coordinate_column_names_pixel=coordinate_column_names_pixel,
+                              channel_column_name=channel_column_name,
+                              pixel_size=pixel_size,
+                              channel_aliases=channel_aliases)
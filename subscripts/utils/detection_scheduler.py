@@ -0,0 +1,132 @@
+# runs many RS-FISH (Fiji) detection jobs as concurrent subprocesses
+# each job is one (folder, channel) combination, exit status / output / runtime of every job is recorded
+
+import os
+import json
+import time
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils.spot_detection import create_folder, make_macro_arguments
+
+
+# one detection job: spots in all images of channel in <folder>/<tif_subfolder>, results to <folder>/<out_subfolder>
+DetectionJob = namedtuple("DetectionJob", ["folder", "channel", "settings_file"])
+
+
+# make jobs for all combinations of folders and channels (settings are given per channel)
+def make_detection_jobs(folders, detection_settings, channels):
+    return [DetectionJob(folder, channel, settings_file)
+            for folder in folders
+            for channel, settings_file in zip(channels, detection_settings)]
+
+
+# command line (argument list, no shell) for one job
+# the runtime file is separate for each channel so parallel jobs in the same folder do not overwrite each other
+def make_job_command(job, macro_path, fiji_path, tif_subfolder="tif", out_subfolder="detections/", job_memory_mb=None):
+
+    out_path = f"{job.folder}/{out_subfolder}/"
+    images_path = f"{job.folder}/{tif_subfolder}/"
+    time_file = f"{out_path}/statsDetectionTime_ch{job.channel}.txt"
+
+    command = [fiji_path]
+    # maximum JVM heap of the ImageJ launcher
+    if job_memory_mb is not None:
+        command.append(f"--mem={job_memory_mb}m")
+    command += ["--headless", "-macro", macro_path,
+                make_macro_arguments(images_path, out_path, job.settings_file, job.channel, time_file=time_file)]
+
+    return command
+
+
+# run one job (with retries), returns a record for the manifest
+def run_detection_job(job, command, retries=1, timeout=None):
+
+    attempts = []
+    for attempt in range(retries + 1):
+
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout)
+            returncode, stdout = result.returncode, result.stdout
+        except subprocess.TimeoutExpired as e:
+            returncode, stdout = None, f"timeout after {timeout} s\n{e.stdout or ''}"
+        except OSError as e:
+            returncode, stdout = None, str(e)
+
+        attempts.append({
+            "attempt": attempt,
+            "returncode": returncode,
+            "wall_time_s": time.perf_counter() - start,
+            "stdout": stdout
+        })
+
+        if returncode == 0:
+            break
+
+    return {
+        "folder": job.folder,
+        "channel": job.channel,
+        "settings_file": job.settings_file,
+        "command": command,
+        "success": attempts[-1]["returncode"] == 0,
+        "returncode": attempts[-1]["returncode"],
+        "wall_time_s": sum(a["wall_time_s"] for a in attempts),
+        "attempts": attempts
+    }
+
+
+# run all jobs concurrently and write a run manifest (json) with the result of every job
+# n_workers: maximum number of concurrent Fiji processes
+# memory_budget_mb / job_memory_mb: if both are given, the number of concurrent jobs is limited
+# so that n_concurrent * job_memory_mb <= memory_budget_mb (job_memory_mb is also passed to Fiji as max heap)
+# retries: how often a failed job (non-zero exit status, timeout) is re-run
+def run_detection_jobs(jobs, macro_path, fiji_path,
+                       tif_subfolder="tif",
+                       out_subfolder="detections/",
+                       n_workers=4,
+                       memory_budget_mb=None,
+                       job_memory_mb=None,
+                       retries=1,
+                       timeout=None,
+                       manifest_path=None):
+
+    if memory_budget_mb is not None and job_memory_mb is not None:
+        if job_memory_mb > memory_budget_mb:
+            raise ValueError("Memory of a single job is larger than the memory budget.")
+        n_workers = min(n_workers, memory_budget_mb // job_memory_mb)
+
+    for job in jobs:
+        create_folder(f"{job.folder}/{out_subfolder}/")
+
+    commands = [make_job_command(job, macro_path, fiji_path, tif_subfolder, out_subfolder, job_memory_mb) for job in jobs]
+
+    started = datetime.now().isoformat()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(run_detection_job, job, command, retries, timeout) for job, command in zip(jobs, commands)]
+        records = []
+        for job, future in zip(jobs, futures):
+            record = future.result()
+            records.append(record)
+            status = "done" if record["success"] else f"FAILED (exit status {record['returncode']})"
+            print(f"{job.folder} ch{job.channel}: {status}, {record['wall_time_s']:.1f} s, {len(record['attempts'])} attempt(s)")
+
+    manifest = {
+        "started": started,
+        "wall_time_s": time.perf_counter() - start,
+        "n_workers": n_workers,
+        "n_jobs": len(jobs),
+        "n_failed": sum(not r["success"] for r in records),
+        "jobs": records
+    }
+
+    if manifest_path is not None:
+        create_folder(os.path.dirname(os.path.abspath(manifest_path)))
+        with open(manifest_path, "w") as fd:
+            json.dump(manifest, fd, indent=2)
+
+    return manifest
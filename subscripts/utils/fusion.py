@@ -0,0 +1,290 @@
+# lazy, block-wise fusion of aligned moving fields into target fields (see apply_alignment_to_images.ipynb)
+# instead of pre-loading all moving images and fusing full volumes:
+# 1) only metadata (shape, scan field, world transform) of all fields is collected
+# 2) overlapping moving fields of each target are planned via a KD-tree of field centers (common world frame)
+#    and an exact check of the axis-aligned bounding boxes (like calmutils get_axes_aligned_overlap)
+# 3) each target is fused block by block: for every block only the overlapping region of the planned moving fields
+#    is read from the HDF5 files and resampled (linear interpolation), overlapping fields are averaged
+# results are written block by block to a memory-mapped multichannel ImageJ TIFF (zcyx on disk, as before:
+# target channels followed by fused moving channels), target fields are processed in parallel processes
+
+import re
+import json
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import tifffile
+from h5py import File
+from scipy.ndimage import affine_transform
+from scipy.spatial import KDTree
+from skimage.io import imsave
+
+from utils.image_access import iter_blocks
+from utils.transform_helpers import get_scan_field_metadata_h5, world_coords_for_pixel_spots, world_transform_to_pixel_transform
+from utils.transform_chain import alignment_matrix
+
+
+# metadata of one field (acquisition in an Imspector HDF5 file), pixels are only read when fusing
+# transform: world transform from alignment, coord_origin / coord_center / pixel_size in µm
+FieldInfo = namedtuple('FieldInfo', ['h5_file', 'acquisition_id', 'shape', 'transform', 'coord_origin', 'coord_center', 'pixel_size'])
+
+
+# acquisitions containing include_pattern and not matching exclude_pattern (None: no filter)
+def filter_acquisition_ids(acquisition_ids, include_pattern=None, exclude_pattern=None):
+    if include_pattern is not None:
+        acquisition_ids = [acquisition_id for acquisition_id in acquisition_ids if re.findall(include_pattern, acquisition_id)]
+    if exclude_pattern is not None:
+        acquisition_ids = [acquisition_id for acquisition_id in acquisition_ids if not re.findall(exclude_pattern, acquisition_id)]
+    return acquisition_ids
+
+
+# key of the transform of an acquisition: filename stem plus first level of acquisition id
+# new style (field_X_sted_Y) or old (fieldX_stedY) acquisition ids
+def alignment_image_id(h5_file, acquisition_id):
+    if acquisition_id.split("_")[1].isnumeric():
+        first_acquisition_id = "_".join(acquisition_id.split("_")[:2])
+    else:
+        first_acquisition_id = acquisition_id.split("_")[0]
+    return Path(h5_file).stem + f"_{first_acquisition_id}"
+
+
+# dict image id -> world transform from an alignment parameters JSON file
+def load_alignment_transforms(alignment_params_file):
+    with open(alignment_params_file) as fd:
+        transformation_parameters = json.load(fd)
+    return {img_id: alignment_matrix(transform_list) for img_id, transform_list in transformation_parameters.items()}
+
+
+# shape of an image dataset without singleton axes (like np.array(dataset).squeeze())
+def image_shape(dataset):
+    return tuple(s for s in dataset.shape if s != 1)
+
+
+# read a region (slices for the non-singleton axes) of an image dataset without loading the whole image
+def read_region(dataset, region):
+    region = iter(region)
+    return dataset[tuple(0 if s == 1 else next(region) for s in dataset.shape)]
+
+
+# metadata of all (filtered) fields in the HDF5 files of a raw folder
+def list_fields(raw_folder, transforms, include_pattern=None, exclude_pattern=None):
+
+    fields = []
+    for h5_file in sorted(Path(raw_folder).glob('*.h5')):
+
+        with File(h5_file, 'r') as fd:
+            acquisition_ids = filter_acquisition_ids(list(fd["experiment"].keys()), include_pattern, exclude_pattern)
+            shapes = [image_shape(fd[f"experiment/{acquisition_id}/0/0"]) for acquisition_id in acquisition_ids]
+
+        for acquisition_id, shape in zip(acquisition_ids, shapes):
+            meta = get_scan_field_metadata_h5(h5_file, acquisition_id)
+            coord_origin = world_coords_for_pixel_spots([0, 0, 0], meta)[0] * 1e6
+            coord_center = world_coords_for_pixel_spots(np.array(shape) / 2, meta)[0] * 1e6
+            transform = transforms[alignment_image_id(h5_file, acquisition_id)]
+            fields.append(FieldInfo(str(h5_file), acquisition_id, shape, transform, coord_origin, coord_center, meta.pixel_size * 1e6))
+
+    return fields
+
+
+# corners (8, 3) of an image of given shape after a (4x4) transform
+def _transformed_corners(shape, transform):
+    corners = np.array(list(product(*[(0, s) for s in shape])), dtype=float)
+    return corners @ transform[:3, :3].T + transform[:3, 3]
+
+
+# axis-aligned bounding box (mins, maxs) of an image of given shape after a (4x4) transform
+def transformed_bbox(shape, transform):
+    corners = _transformed_corners(shape, transform)
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+# pixel transform moving -> target for two fields
+def field_pixel_transform(target, moving):
+    combined_tr = np.linalg.inv(target.transform) @ moving.transform
+    return world_transform_to_pixel_transform(combined_tr, target.coord_origin, moving.coord_origin, target.pixel_size, moving.pixel_size)
+
+
+# bounding box of a field in the common world frame (pixels -> µm around the origin -> alignment transform)
+def _world_bbox(field):
+    to_world = field.transform @ np.diag(np.append(field.pixel_size, 1.0))
+    to_world[:3, 3] += (field.transform[:3, :3] @ field.coord_origin)
+    return transformed_bbox(field.shape, to_world)
+
+
+# moving fields overlapping each target field: list (per target) of (moving index, pixel transform moving -> target)
+# candidates are found via a KD-tree of bounding box centers (radius: half bounding box diagonals), then checked exactly
+# fuse_multiple=False: only keep the moving field with the largest overlap
+def plan_fusion(targets, movings, fuse_multiple=True):
+
+    if len(movings) == 0:
+        return [[] for _ in targets]
+
+    def centers_radii(fields):
+        bboxes = [_world_bbox(field) for field in fields]
+        centers = np.array([(mins + maxs) / 2 for mins, maxs in bboxes])
+        radii = np.array([np.linalg.norm(maxs - mins) / 2 for mins, maxs in bboxes])
+        return centers, radii
+
+    target_centers, target_radii = centers_radii(targets)
+    moving_centers, moving_radii = centers_radii(movings)
+    tree = KDTree(moving_centers)
+
+    plans = []
+    for target, center, radius in zip(targets, target_centers, target_radii):
+
+        plan = []
+        max_overlap = 0
+        for idx in sorted(tree.query_ball_point(center, radius + moving_radii.max())):
+
+            transform = field_pixel_transform(target, movings[idx])
+
+            # overlap of axis-aligned transformed moving image with target image
+            mins, maxs = transformed_bbox(movings[idx].shape, transform)
+            mins, maxs = np.maximum(mins, 0), np.minimum(maxs, target.shape)
+            if not all(mins < maxs):
+                continue
+
+            if fuse_multiple:
+                plan.append((idx, transform))
+            elif np.prod(maxs - mins) > max_overlap:
+                max_overlap = np.prod(maxs - mins)
+                plan = [(idx, transform)]
+
+        plans.append(plan)
+
+    return plans
+
+
+# resample one target block from the moving images (datasets) with pixel transforms moving -> target
+# only the source region mapping into the block is read, voxels covered by several images are averaged
+def fuse_block(datasets, shapes, transforms, block, oob_val=-1):
+
+    block_start = np.array([s.start for s in block])
+    block_shape = tuple(s.stop - s.start for s in block)
+
+    fused = np.zeros(block_shape, dtype=np.float32)
+    count = np.zeros(block_shape, dtype=np.uint16)
+
+    for dataset, shape, transform in zip(datasets, shapes, transforms):
+
+        inverse = np.linalg.inv(transform)
+
+        # region of the moving image mapping into the block (with a margin for interpolation)
+        corners = _transformed_corners(np.array(block_shape) - 1, np.eye(4)) + block_start
+        source = corners @ inverse[:3, :3].T + inverse[:3, 3]
+        lo = np.clip(np.floor(source.min(axis=0)).astype(int) - 1, 0, shape)
+        hi = np.clip(np.ceil(source.max(axis=0)).astype(int) + 2, 0, shape)
+        if not all(lo < hi):
+            continue
+
+        crop = read_region(dataset, tuple(slice(l, h) for l, h in zip(lo, hi))).astype(np.float32)
+
+        # target voxel o (relative to block) -> source voxel inverse @ (o + block start), relative to crop
+        offset = inverse[:3, :3] @ block_start + inverse[:3, 3] - lo
+        resampled = affine_transform(crop, inverse[:3, :3], offset, output_shape=block_shape, order=1,
+                                     mode='constant', cval=np.nan)
+
+        valid = ~np.isnan(resampled)
+        fused[valid] += resampled[valid]
+        count[valid] += 1
+
+    fused[count > 0] /= count[count > 0]
+    fused[count == 0] = oob_val
+    return fused
+
+
+# fuse all planned moving fields into one target field, written block by block to out_file
+# (ImageJ TIFF, target channels followed by fused moving channels)
+def fuse_target(target, movings, transforms, out_file, channels_target=(0, ), channels_moving=(0, ),
+                block_shape=(32, 256, 256), oob_val=-1):
+
+    n_channels = len(channels_target) + len(channels_moving)
+    pixel_size = target.pixel_size
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+
+    # ImageJ hyperstacks are stored as zcyx
+    out = tifffile.memmap(out_file, shape=(target.shape[0], n_channels) + tuple(target.shape[1:]), dtype=np.float32,
+                          imagej=True, resolution=(1 / pixel_size[2], 1 / pixel_size[1]),
+                          metadata={'axes': 'ZCYX', 'spacing': pixel_size[0], 'unit': 'micron'})
+
+    moving_files = [File(moving.h5_file, 'r') for moving in movings]
+    try:
+        with File(target.h5_file, 'r') as fd:
+            target_datasets = [fd[f"experiment/{target.acquisition_id}/0/{c}"] for c in channels_target]
+
+            for block in iter_blocks(target.shape, block_shape):
+                out_block = (block[0], slice(None)) + block[1:]
+
+                channels = [read_region(dataset, block).astype(np.float32) for dataset in target_datasets]
+                for c in channels_moving:
+                    datasets = [fd_m[f"experiment/{moving.acquisition_id}/0/{c}"] for fd_m, moving in zip(moving_files, movings)]
+                    channels.append(fuse_block(datasets, [moving.shape for moving in movings], transforms, block, oob_val))
+
+                out[out_block] = np.stack(channels, axis=1)
+    finally:
+        for fd_m in moving_files:
+            fd_m.close()
+
+    out.flush()
+    del out
+
+    return out_file
+
+
+# RGB PNG of the orthogonal projections of all channels of a fused TIFF (read channel by channel)
+def save_fused_projections(fused_file, out_file, pixel_size, color_names=('magenta', 'yellow', 'cyan')):
+
+    from calmutils.color import gray_images_to_rgb_composite
+    from calmutils.misc.visualization import get_orthogonal_projections_8bit
+
+    fused = tifffile.memmap(fused_file, mode='r')
+    projections = [get_orthogonal_projections_8bit(np.asarray(fused[:, c]), pixel_size) for c in range(fused.shape[1])]
+    rgb_projection = (gray_images_to_rgb_composite(projections, color_names=list(color_names)) * 255).astype(np.uint8)
+
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    imsave(out_file, rgb_projection)
+
+
+# wrapper for process pool
+def _fuse_target_task(task):
+    target, movings, transforms, out_file, projections_file, kwargs = task
+    fuse_target(target, movings, transforms, out_file, **kwargs)
+    if projections_file is not None:
+        # NOTE: pixel size in m, like in the notebook
+        save_fused_projections(out_file, projections_file, target.pixel_size * 1e-6)
+    return out_file
+
+
+# align and fuse moving fields into all target fields, n_workers target fields in parallel
+# outputs: <base_path_target>/<out_subdir>/<h5 stem>_<acquisition>_aligned.tif (+ projections in projections_subdir)
+def fuse_aligned_fields(base_path_target, base_path_moving, alignment_params_file, raw_subdir_target='raw',
+                        raw_subdir_moving='raw', include_pattern_target=None, exclude_pattern_target=None,
+                        include_pattern_moving=None, exclude_pattern_moving=None, channels_to_include_target=(0, ),
+                        channels_to_include_moving=(0, ), oob_val=-1, fuse_multiple_moving=True, out_subdir='aligned',
+                        save_projections=True, projections_subdir='vis', block_shape=(32, 256, 256), n_workers=None):
+
+    transforms = load_alignment_transforms(alignment_params_file)
+
+    targets = list_fields(Path(base_path_target) / raw_subdir_target, transforms, include_pattern_target, exclude_pattern_target)
+    movings = list_fields(Path(base_path_moving) / raw_subdir_moving, transforms, include_pattern_moving, exclude_pattern_moving)
+
+    plans = plan_fusion(targets, movings, fuse_multiple_moving)
+
+    kwargs = dict(channels_target=channels_to_include_target, channels_moving=channels_to_include_moving,
+                  block_shape=block_shape, oob_val=oob_val)
+
+    tasks = []
+    for target, plan in zip(targets, plans):
+        name = Path(target.h5_file).stem + f"_{target.acquisition_id}"
+        out_file = Path(base_path_target) / out_subdir / f"{name}_aligned.tif"
+        projections_file = Path(base_path_target) / out_subdir / projections_subdir / f"{name}_aligned_projections.png" if save_projections else None
+        tasks.append((target, [movings[idx] for idx, _ in plan], [transform for _, transform in plan], out_file, projections_file, kwargs))
+
+    if n_workers is None or n_workers <= 1:
+        return [_fuse_target_task(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_fuse_target_task, tasks))
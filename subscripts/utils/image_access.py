@@ -0,0 +1,167 @@
+import os
+from collections import OrderedDict
+from itertools import product
+
+import h5py as h5
+import numpy as np
+import tifffile
+from natsort import natsorted
+
+
+# separator between store file and image name in references to images in a store (see image_store.py)
+STORE_SEPARATOR = "::"
+
+
+# image reference for an image in a store, e.g. "dataset.h5::img1_ch0"
+def store_image_path(store_file, name):
+    return f"{store_file}{STORE_SEPARATOR}{name}"
+
+
+# store file and image name from an image reference
+def split_store_image_path(path):
+    store_file, name = str(path).split(STORE_SEPARATOR, 1)
+    return store_file, name
+
+
+# whether a path is a store file (by extension)
+def is_store_file(path):
+    return str(path).lower().endswith((".h5", ".hdf5"))
+
+
+# whether a path references an image in a store
+def is_store_image_path(path):
+    return STORE_SEPARATOR in str(path)
+
+
+# list of image references in a store (natsorted)
+def list_store_images(store_file):
+    with h5.File(store_file, "r") as fd:
+        return [store_image_path(store_file, name) for name in natsorted(fd.keys())]
+
+
+# image name without folder / store file and extension (e.g. img1_ch0 for .../tif/img1_ch0.tif or images.h5::img1_ch0)
+def image_name(path):
+    if is_store_image_path(path):
+        return split_store_image_path(path)[1]
+    return os.path.basename(str(path)).rsplit(".", 1)[0]
+
+
+# blocks (as slices) covering an image of given shape
+def iter_blocks(shape, block_shape):
+    for starts in product(*[range(0, s, b) for s, b in zip(shape, block_shape)]):
+        yield tuple(slice(start, min(start + b, s)) for start, b, s in zip(starts, block_shape, shape))
+
+
+# lazy, read-only access to a (z)yx TIFF stack or an image in a HDF5 store
+# uses a memory map if the image data is stored contiguously and uncompressed,
+# otherwise reads single z-planes on demand and keeps the most recently used ones in a LRU cache
+# -> memory is bounded by the planes that are actually accessed instead of the whole stack
+# level: resolution level for images in a store (0 = full resolution)
+class LazyStack:
+
+    def __init__(self, path, cache_planes=32, level=0):
+
+        self.path = path
+        self.cache_planes = cache_planes
+        self._cache = OrderedDict()
+        self._memmap = None
+        self._tif = None
+        self._h5 = None
+        self.pixel_size = None
+
+        if is_store_image_path(path):
+            store_file, name = split_store_image_path(path)
+            self._h5 = h5.File(store_file, 'r')
+            dataset = self._h5[f"{name}/{level}"]
+            shape, self.dtype = dataset.shape, dataset.dtype
+            self.pixel_size = dataset.attrs.get("pixel_size")
+            self._read_plane = lambda z: dataset[z] if len(shape) == 3 else dataset[()]
+        else:
+            self._tif = tifffile.TiffFile(path)
+            series = self._tif.series[0]
+            shape, self.dtype = series.shape, series.dtype
+            self._read_plane = lambda z: series.pages[z].asarray()
+
+        if len(shape) not in (2, 3):
+            self.close()
+            raise ValueError(f"Only 2D or 3D images are supported, got shape {shape} for {path}.")
+
+        # 2D images are handled as stacks with a single plane
+        self.shape = tuple(shape) if len(shape) == 3 else (1, ) + tuple(shape)
+        self.ndim = 3
+
+        # memory map TIFFs if possible (uncompressed, contiguous data)
+        if self._tif is not None:
+            try:
+                self._memmap = tifffile.memmap(path, mode='r').reshape(self.shape)
+            except ValueError:
+                self._memmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._cache.clear()
+        self._memmap = None
+        if self._tif is not None:
+            self._tif.close()
+        if self._h5 is not None:
+            self._h5.close()
+
+    # get a single z-plane (cached if not memory mapped)
+    def plane(self, z):
+
+        if self._memmap is not None:
+            return self._memmap[z]
+
+        if z in self._cache:
+            self._cache.move_to_end(z)
+            return self._cache[z]
+
+        plane = np.asarray(self._read_plane(z)).reshape(self.shape[1:])
+        self._cache[z] = plane
+        if len(self._cache) > self.cache_planes:
+            self._cache.popitem(last=False)
+
+        return plane
+
+    # numpy-style slicing, only the z-planes that are touched are read
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), ) * (3 - len(key))
+
+        if self._memmap is not None:
+            return np.asarray(self._memmap[key])
+
+        z_key, yx_key = key[0], key[1:]
+        if isinstance(z_key, (int, np.integer)):
+            return self.plane(z_key if z_key >= 0 else self.shape[0] + z_key)[yx_key]
+
+        return np.stack([self.plane(z)[yx_key] for z in range(self.shape[0])[z_key]])
+
+    # crop cubic ROIs of given radius around integer zyx centers (all ROIs have to be inside the image)
+    # spots are visited sorted by z so neighbouring ROIs re-use cached planes
+    def rois(self, centers, radius):
+
+        size = 2 * radius + 1
+        out = np.empty((len(centers), size, size, size), dtype=self.dtype)
+
+        for i in np.argsort(centers[:, 0], kind='stable'):
+            z, y, x = centers[i]
+            out[i] = self[z-radius:z+radius+1, y-radius:y+radius+1, x-radius:x+radius+1]
+
+        return out
+
+    # maximum projection along z, computed plane by plane
+    def max_projection(self):
+
+        projection = np.array(self.plane(0))
+        for z in range(1, self.shape[0]):
+            np.maximum(projection, self.plane(z), out=projection)
+
+        return projection
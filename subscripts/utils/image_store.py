@@ -0,0 +1,165 @@
+# chunked, compressed multiscale HDF5 store as intermediate image format
+# replaces the one-TIFF-per-image-and-channel "tif" folder: one store file per dataset,
+# one group per image and channel (named like the TIFFs: <name>_ch<channel>) containing
+# datasets "0", "1", ... (full resolution and 2x downsampled levels in yx)
+# with channel name and pixel size (zyx, µm) as attributes
+#
+# images in a store are referenced as "<store file>::<image name>", e.g. "dataset.h5::img1_ch0"
+# (can be opened lazily with utils.image_access.LazyStack)
+# stages reading the store: native spot detection and combine_csv (tif_subfolder = store file, e.g. "images.h5"),
+# subpixel refinement, plot_detections (store_path) and projection.save_projections (file_type 'store')
+
+import os
+import json
+from glob import glob
+
+import h5py as h5
+import numpy as np
+import tifffile
+from natsort import natsorted
+from nd2 import ND2File
+from msr_reader import OBFFile
+
+from utils.resave import iter_nd2_fields
+from utils.image_access import list_store_images
+
+
+# 2x downsampling in y and x (mean of 2x2 blocks, odd last row / column is dropped)
+def downsample_yx(img):
+    z, y, x = img.shape
+    img = img[:, :y - y % 2, :x - x % 2]
+    return img.reshape(z, y // 2, 2, x // 2, 2).mean(axis=(2, 4)).astype(img.dtype)
+
+
+# add one image (zyx) with its downsampled levels to an open store
+def write_store_image(fd, name, img, channel_name=None, pixel_size=None,
+                      n_levels=3, chunks=(16, 256, 256), compression="gzip", compression_opts=4):
+
+    if img.ndim == 2:
+        img = img[np.newaxis]
+
+    group = fd.require_group(name)
+    group.attrs["channel_name"] = "" if channel_name is None else str(channel_name)
+    group.attrs["n_levels"] = n_levels
+
+    level_pixel_size = None if pixel_size is None else np.array(pixel_size, dtype=float)
+    for level in range(n_levels):
+
+        if level > 0:
+            if min(img.shape[1:]) < 2:
+                group.attrs["n_levels"] = level
+                break
+            img = downsample_yx(img)
+            if level_pixel_size is not None:
+                level_pixel_size = level_pixel_size * np.array([1, 2, 2])
+
+        if str(level) in group:
+            del group[str(level)]
+        dataset = group.create_dataset(str(level), data=img, chunks=tuple(min(c, s) for c, s in zip(chunks, img.shape)),
+                                       compression=compression, compression_opts=compression_opts)
+        if level_pixel_size is not None:
+            dataset.attrs["pixel_size"] = level_pixel_size
+
+
+############# readers for raw data, yield (name, channel name, zyx image, pixel size zyx in µm) #################
+
+# Imspector H5 files: all images (acquisitions) and channels
+def iter_h5_images(h5_file_path):
+
+    name = os.path.splitext(os.path.basename(h5_file_path))[0]
+
+    with h5.File(h5_file_path, 'r') as fd:
+        for key in fd['experiment'].keys(): # all images in h5 file
+            metadata = json.loads(fd[f'experiment/{key}/0'].attrs['measurement_meta'])
+
+            # pixel sizes (m) of scan range, if present
+            try:
+                pixel_size = np.array([float(metadata['ExpControl']['scan']['range'][d]['psz']) for d in 'zyx']) * 1e6
+            except (KeyError, TypeError):
+                pixel_size = None
+
+            for channel in range(len(fd[f'experiment/{key}/0/'])): # all channels in image
+                img = np.asarray(fd[f'experiment/{key}/0/{channel}']).squeeze()
+                yield f"{name}_{key}_ch{channel}", str(channel), img, pixel_size
+
+
+# ND2 files: all fields and channels, read field by field
+def iter_nd2_images(nd2_file):
+
+    base_name = os.path.basename(nd2_file).rsplit(".", 1)[0]
+
+    with ND2File(nd2_file) as reader:
+        channel_names = [c.channel.name for c in reader.metadata.channels]
+        pixel_size = np.array(reader.voxel_size()[::-1])
+
+        for field, stacks in iter_nd2_fields(reader):
+            for ch, stack in enumerate(stacks):
+                yield f"{base_name}_field{field}_ch{ch}", channel_names[ch], stack, pixel_size
+
+
+# MSR files: all stacks
+def iter_msr_images(file):
+
+    name = os.path.splitext(os.path.basename(file))[0]
+
+    with OBFFile(file) as f:
+        pixel_sizes = f.pixel_sizes # like sizes, but with pixel sizes (unit: meters)
+
+        for idx in range(0,len(f.shapes)):
+            img = f.read_stack(idx)
+
+            # zyx pixel size only for stacks (2D images have no z size), sizes can be a list (newer msr_reader)
+            # or a dict by dimension name, as in projection.project_msr_streaming
+            pixel_size = None
+            if img.ndim == 3:
+                sizes = pixel_sizes[idx].sizes
+                pixel_size = [sizes[f'ExpControl {d}'] for d in 'ZYX'] if isinstance(sizes, dict) else list(sizes[:3])
+                pixel_size = np.array(pixel_size) * 1e6
+
+            yield f"{name}_ch{idx}", pixel_sizes[idx].name, img, pixel_size
+
+
+# multichannel (zyxc) TIFF files
+def iter_tif_images(tif_file):
+
+    name = os.path.basename(tif_file).rsplit(".", 1)[0]
+    img = tifffile.imread(tif_file)
+
+    for ch in range(img.shape[3]):
+        yield f"{name}_ch{ch}", str(ch), img[:, :, :, ch], None
+
+
+# input files and reader for each type of raw data (same locations as the resave_* functions)
+RAW_READERS = {
+    "h5": ("*.h5", iter_h5_images),
+    "nd2": ("*.nd2", iter_nd2_images),
+    "msr": ("raw/*.msr", iter_msr_images),
+    "tif": ("*.tif", iter_tif_images),
+}
+
+
+# converts all raw files of one type in folder into a single store file (default: <folder>/images.h5)
+# returns the list of image references in the store
+def convert_to_store(folder, raw_type, out_file=None, n_levels=3, chunks=(16, 256, 256),
+                     compression="gzip", compression_opts=4):
+
+    if raw_type not in RAW_READERS:
+        raise ValueError(f"Unknown raw data type '{raw_type}', use one of {list(RAW_READERS)}.")
+
+    if out_file is None:
+        out_file = f"{folder}/images.h5"
+
+    # all raw files (but not the store itself)
+    pattern, reader = RAW_READERS[raw_type]
+    files = natsorted(glob(f"{folder}/{pattern}"))
+    files = [file for file in files if os.path.abspath(file) != os.path.abspath(out_file)]
+
+    with h5.File(out_file, "a") as fd:
+        fd.attrs["source_type"] = raw_type
+        for file in files:
+            for name, channel_name, img, pixel_size in reader(file):
+                write_store_image(fd, name, img, channel_name, pixel_size, n_levels=n_levels, chunks=chunks,
+                                  compression=compression, compression_opts=compression_opts)
+                fd[name].attrs["source_file"] = os.path.abspath(file)
+
+    return list_store_images(out_file)
@@ -0,0 +1,274 @@
+# cached pipeline runner, replaces chains of papermill run_notebook calls
+# a pipeline is a list of stages, each stage is a function of the dataset folder and its parameters
+# with declared inputs and outputs (glob patterns relative to the dataset folder, can contain {parameter} placeholders)
+#
+# a stage is skipped if its outputs exist and the fingerprint of its inputs, parameters and function is the same
+# as in its last successful run (stored in <dataset>/pipeline_cache.json)
+# -> re-running a pipeline only redoes stages whose inputs changed (and, through their outputs, all stages after them)
+# stages of one dataset run in order, independent datasets run in parallel processes
+# paths are always built from the dataset folder, no os.chdir / global state
+
+import os
+import json
+import time
+import hashlib
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from natsort import natsorted
+
+
+# file with the fingerprints of the last successful run of every stage, in each dataset folder
+CACHE_FILE_NAME = "pipeline_cache.json"
+
+# one step of the pipeline: func(dataset, **params) reading inputs, writing outputs (lists of patterns)
+Stage = namedtuple("Stage", ["name", "func", "inputs", "outputs", "params"])
+
+
+def make_stage(name, func, inputs, outputs, **params):
+    return Stage(name, func, list(inputs), list(outputs), params)
+
+
+# all files matching the patterns of a stage (directories are expanded to the files they contain)
+def resolve_paths(dataset, patterns, params):
+
+    files = []
+    for pattern in patterns:
+        pattern = os.path.join(dataset, pattern.format(**params))
+        for path in natsorted(glob(pattern)):
+            if os.path.isdir(path):
+                files += natsorted(os.path.join(root, f) for root, _, fs in os.walk(path) for f in fs)
+            else:
+                files.append(path)
+
+    return files
+
+
+# fingerprint of one file: size and modification time, or sha256 of the contents if hash_contents
+def file_fingerprint(file, hash_contents=False):
+
+    if not hash_contents:
+        stat = os.stat(file)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    h = hashlib.sha256()
+    with open(file, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# fingerprint of a stage in a dataset: function, parameters and all input files
+def stage_fingerprint(dataset, stage, hash_contents=False):
+
+    h = hashlib.sha256()
+    h.update(f"{stage.func.__module__}.{stage.func.__qualname__}".encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+
+    for file in resolve_paths(dataset, stage.inputs, stage.params):
+        h.update(os.path.relpath(file, dataset).encode())
+        h.update(file_fingerprint(file, hash_contents).encode())
+
+    return h.hexdigest()
+
+
+def _load_cache(dataset):
+    cache_file = os.path.join(dataset, CACHE_FILE_NAME)
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as fd:
+        return json.load(fd)
+
+
+# written to a temporary file first so an interrupted run does not leave a broken cache
+def _save_cache(dataset, cache):
+    cache_file = os.path.join(dataset, CACHE_FILE_NAME)
+    with open(cache_file + ".tmp", "w") as fd:
+        json.dump(cache, fd, indent=2)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+# run all stages for one dataset (in order), returns one record (stage, status, wall time, error) per stage
+# status: "done", "skipped" (unchanged), "failed" or "not run" (after a failed stage)
+# force: names of stages to run even if unchanged (or True for all)
+def run_dataset(dataset, stages, force=(), hash_contents=False):
+
+    cache = _load_cache(dataset)
+    records = []
+    failed = False
+
+    for stage in stages:
+
+        record = {"stage": stage.name, "status": "not run", "wall_time_s": 0.0, "error": None}
+        records.append(record)
+        if failed:
+            continue
+
+        start = time.perf_counter()
+        try:
+            if len(stage.inputs) > 0 and len(resolve_paths(dataset, stage.inputs, stage.params)) == 0:
+                raise FileNotFoundError(f"no inputs found for {stage.inputs}")
+
+            fingerprint = stage_fingerprint(dataset, stage, hash_contents)
+            outputs_exist = all(len(resolve_paths(dataset, [pattern], stage.params)) > 0 for pattern in stage.outputs)
+            forced = force is True or stage.name in force
+
+            if not forced and outputs_exist and cache.get(stage.name) == fingerprint:
+                record["status"] = "skipped"
+                continue
+
+            stage.func(dataset, **stage.params)
+
+            missing = [pattern for pattern in stage.outputs if len(resolve_paths(dataset, [pattern], stage.params)) == 0]
+            if len(missing) > 0:
+                raise FileNotFoundError(f"stage did not produce outputs {missing}")
+
+            # fingerprint before running: inputs changed during the run are picked up next time
+            cache[stage.name] = fingerprint
+            _save_cache(dataset, cache)
+            record["status"] = "done"
+
+        except Exception as e:
+            cache.pop(stage.name, None)
+            _save_cache(dataset, cache)
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+            failed = True
+
+        finally:
+            record["wall_time_s"] = time.perf_counter() - start
+
+    return records
+
+
+# wrapper for process pool
+def _run_dataset(task):
+    return run_dataset(*task)
+
+
+# run the pipeline for all datasets (folders), n_workers datasets in parallel
+# returns dict dataset -> stage records (see run_dataset)
+def run_pipeline(datasets, stages, n_workers=None, force=(), hash_contents=False):
+
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names have to be unique, got {names}.")
+
+    tasks = [(dataset, stages, force, hash_contents) for dataset in datasets]
+
+    # records are reported as soon as a dataset is done
+    report = {}
+
+    def collect(results):
+        for dataset, records in zip(datasets, results):
+            report[dataset] = records
+            for record in records:
+                print(f"{dataset} {record['stage']}: {record['status']} ({record['wall_time_s']:.1f} s)")
+                if record["status"] == "failed":
+                    print(record["error"])
+
+    if n_workers is None or n_workers <= 1:
+        collect(map(_run_dataset, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            collect(executor.map(_run_dataset, tasks))
+
+    return report
+
+
+############# stages of the spot detection workflows #################
+# utils modules are imported in the stages, so only the dependencies of the stages that are actually run are needed
+
+def stage_resave_nd2(dataset):
+    from utils.resave import resave_nd2
+    resave_nd2(dataset)
+
+
+def stage_projections(dataset, raw_subfolder="raw", out_subfolder="projections", file_type="nd2", projection_type="max",
+                      intensity_range="auto", auto_range_quantiles=(0.02, 0.9995)):
+    from utils.projection import save_projections
+    in_files = natsorted(glob(f"{dataset}/{raw_subfolder}/*.{file_type}"))
+    save_projections(in_files, f"{dataset}/{out_subfolder}", file_type=file_type, projection_type=projection_type,
+                     intensity_range=intensity_range, auto_range_quantiles=auto_range_quantiles)
+
+
+# spot detection in all channels, combine result tables (incremental) and add sample info
+def stage_detection(dataset, channels, tif_subfolder="tif", out_subfolder="detections", backend="fiji",
+                    macro_path=None, fiji_path=None, sample_info=True):
+    from utils.spot_detection import detect_spots, combine_csv, add_sample_info
+
+    detection_settings = [os.path.normpath(f"{dataset}/{out_subfolder}/ch{c}.txt") for c in channels]
+    kwargs = {k: v for k, v in dict(macro_path=macro_path, fiji_path=fiji_path).items() if v is not None}
+    detect_spots(dataset, detection_settings, channels, tif_subfolder=tif_subfolder, out_subfolder=out_subfolder,
+                 backend=backend, **kwargs)
+
+    combine_csv(dataset, tif_subfolder, out_subfolder, incremental=True)
+    if sample_info:
+        add_sample_info(dataset, info=f"{dataset}/acquisition_info.json", out_subfolder=out_subfolder)
+
+
+def stage_chrom_shift(dataset, transforms_path, reference_channel, pixel_size, channel_aliases,
+                      out_subfolder="detections", spot_file="merge.csv", coordinate_column_names_pixel=("z", "y", "x")):
+    from utils.corrections import correct_chrom_shift_batch
+    correct_chrom_shift_batch(f"{dataset}/{out_subfolder}", f"{dataset}/{out_subfolder}", spot_file, transforms_path,
+                              reference_channel, coordinate_column_names_pixel=list(coordinate_column_names_pixel),
+                              pixel_size=pixel_size, channel_aliases=channel_aliases)
+
+
+# cellpose segmentation on CPU (see segmentation.py), masks are written to <dataset>/<segmentation_subfolder>
+def stage_segmentation(dataset, model, channel=0, tif_subfolder="tif", segmentation_subfolder="segmentation", diameter=120,
+                       min_size=5000, anisotropy=2.3, n_workers=1, n_threads=1, max_memory_mb=4000):
+    from utils.segmentation import segment_files
+    files = natsorted(glob(f"{dataset}/{tif_subfolder}/*_ch{channel}.tif"))
+    segment_files(files, f"{dataset}/{segmentation_subfolder}", model, diameter=diameter, min_size=min_size,
+                  anisotropy=anisotropy, n_workers=n_workers, n_threads=n_threads, max_memory_mb=max_memory_mb)
+
+
+def stage_cell_assignment(dataset, out_subfolder="detections", spot_file="merge_shift-corrected.csv",
+                          out_file="merge_filtered.csv", segmentation_subfolder="segmentation", mask_ending="_seg", filter=True):
+    from utils.spot_analysis import add_cell_info
+    masks = natsorted(glob(f"{dataset}/{segmentation_subfolder}/*.npy"))
+    add_cell_info(masks, f"{dataset}/{out_subfolder}/{spot_file}", f"{dataset}/{out_subfolder}/{out_file}",
+                  filter=filter, mask_ending=mask_ending)
+
+
+def stage_distances(dataset, channels, voxel_size, out_subfolder="detections", spot_file="merge_shift-corrected.csv",
+                    out_file="distances.csv", max_distance=None):
+    from utils.spot_analysis import detect_spot_pairs
+    detect_spot_pairs(f"{dataset}/{out_subfolder}/{spot_file}", f"{dataset}/{out_file}", channels,
+                      voxel_size=voxel_size, max_distance=max_distance)
+
+
+# stages of the pairwise spinning disk workflow (pairwise_analysis_nd2/spinning_disk_spot_detection.ipynb)
+# segmentation_model: segment channel segmentation_channel on CPU (stage_segmentation, parameters in segmentation_params),
+# None: cell segmentation is not included, masks are expected in <dataset>/segmentation
+def spinning_disk_stages(channels, transforms_path, reference_channel, pixel_size, channel_aliases, voxel_size,
+                         out_subfolder="detections", backend="fiji", macro_path=None, fiji_path=None,
+                         segmentation_model=None, segmentation_channel=0, segmentation_params=None):
+
+    detections = f"{out_subfolder}/RadialSymmetry_results_*.csv"
+
+    # after resaving (segments the tifs)
+    segmentation = []
+    if segmentation_model is not None:
+        segmentation.append(make_stage("segmentation", stage_segmentation, ["tif/*_ch{channel}.tif"], ["segmentation/*.npy"],
+                                       model=segmentation_model, channel=segmentation_channel, **(segmentation_params or {})))
+
+    return [
+        make_stage("resave", stage_resave_nd2, ["raw/*.nd2"], ["tif/*.tif"]),
+    ] + segmentation + [
+        make_stage("projections", stage_projections, ["raw/*.nd2"], ["projections/*.png"]),
+        make_stage("detection", stage_detection, ["tif/*.tif", "{out_subfolder}/ch*.txt", "acquisition_info.json"],
+                   ["{out_subfolder}/merge.csv", detections],
+                   channels=channels, out_subfolder=out_subfolder, backend=backend, macro_path=macro_path, fiji_path=fiji_path),
+        make_stage("chrom_shift", stage_chrom_shift, ["{out_subfolder}/merge.csv", transforms_path],
+                   ["{out_subfolder}/merge_shift-corrected.csv"],
+                   transforms_path=transforms_path, reference_channel=reference_channel, pixel_size=pixel_size,
+                   channel_aliases=channel_aliases, out_subfolder=out_subfolder),
+        make_stage("cell_assignment", stage_cell_assignment, ["segmentation/*.npy", "{out_subfolder}/merge_shift-corrected.csv"],
+                   ["{out_subfolder}/merge_filtered.csv"], out_subfolder=out_subfolder),
+        make_stage("distances", stage_distances, ["{out_subfolder}/merge_shift-corrected.csv"], ["distances.csv"],
+                   channels=channels, voxel_size=voxel_size, out_subfolder=out_subfolder),
+    ]
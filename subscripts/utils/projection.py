@@ -1,5 +1,9 @@
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from skimage.io import imsave
 from skimage.exposure import rescale_intensity
 from skimage.transform import resize
 from nd2 import ND2File
@@ -7,6 +11,8 @@ from msr_reader import OBFFile
 
 from calmutils.misc.visualization import get_orthogonal_projections_8bit
 
+from utils.image_access import LazyStack, list_store_images, image_name
+
 def load_multichannel_nd2(file_path):
     with ND2File(file_path) as reader:
         # nice OC name without whitespace
@@ -25,20 +31,290 @@ def load_msr(file):
         imgs = []
         channel_names = []
 
-        for idx in range(0,len(f.sizes)):
+        # metadata (read once, not for every stack)
+        stack_pixel_sizes = f.pixel_sizes # like sizes, but with pixel sizes (unit: meters)
+
+        for idx in range(0,len(stack_pixel_sizes)):
 
             # reading image data
             img = f.read_stack(idx) # read stack with index idx into numpy array
             imgs.append(img)
 
-            # metadata
-            stack_sizes = f.sizes # list of stack sizes/shapes, including stack and dimension names
-            pixel_sizes = f.pixel_sizes # like sizes, but with pixel sizes (unit: meters)
-            channel_names.append(pixel_sizes[idx].name)
-            pixel_sizes = [pixel_sizes[idx].sizes['ExpControl Z'],
-                           pixel_sizes[idx].sizes['ExpControl Y'],
-                           pixel_sizes[idx].sizes['ExpControl X']]
+            channel_names.append(stack_pixel_sizes[idx].name)
+            pixel_sizes = [stack_pixel_sizes[idx].sizes['ExpControl Z'],
+                           stack_pixel_sizes[idx].sizes['ExpControl Y'],
+                           stack_pixel_sizes[idx].sizes['ExpControl X']]
 
         imgs = np.asarray(imgs)
 
         return(imgs, channel_names, pixel_sizes)
+
+
+############# streaming projections: images are projected plane by plane, never fully loaded #################
+
+# projection functions for a single plane (reduce along one axis) and to combine two partial projections
+PROJECTION_TYPES = {
+    'max': (np.max, np.maximum),
+    'min': (np.min, np.minimum),
+    'mean': (np.sum, np.add),
+}
+
+
+# incremental orthogonal (YX, ZX, ZY) projections of a zyx stack
+# add z-planes one by one (in any order), get the projections once all planes were added
+class OrthogonalProjector:
+
+    def __init__(self, shape, projection_type='max'):
+
+        if projection_type not in PROJECTION_TYPES:
+            raise ValueError(f"Unknown projection type '{projection_type}', use one of {list(PROJECTION_TYPES)}.")
+
+        self.shape = tuple(shape)
+        self.projection_type = projection_type
+        self._reduce, self._combine = PROJECTION_TYPES[projection_type]
+
+        n_z, n_y, n_x = self.shape
+        self.yx = None
+        self.zx = np.zeros((n_z, n_x), dtype=np.float64)
+        self.zy = np.zeros((n_z, n_y), dtype=np.float64)
+        self.n_planes = 0
+
+    def add_plane(self, z, plane):
+
+        plane = np.asarray(plane)
+        self.zx[z] = self._reduce(plane, axis=0)
+        self.zy[z] = self._reduce(plane, axis=1)
+
+        if self.yx is None:
+            self.yx = plane.astype(np.float64)
+        else:
+            self._combine(self.yx, plane, out=self.yx)
+
+        self.n_planes += 1
+
+    # YX, ZX, ZY projections (ZY with z as first axis)
+    def projections(self):
+
+        yx, zx, zy = self.yx, self.zx, self.zy
+        if self.projection_type == 'mean':
+            yx = yx / self.n_planes
+            zx = zx / self.shape[1]
+            zy = zy / self.shape[2]
+
+        return yx, zx, zy
+
+
+# combine YX, ZX and ZY projections into one image (YX top left, ZX below, ZY (transposed) on the right)
+# z is scaled to the yx pixel size if pixel_size (zyx) is given
+def assemble_orthogonal_projections(yx, zx, zy, pixel_size=None):
+
+    if pixel_size is not None:
+        n_z = max(1, int(round(zx.shape[0] * pixel_size[0] / pixel_size[1])))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            zx = resize(zx, (n_z, zx.shape[1]), preserve_range=True)
+            zy = resize(zy, (n_z, zy.shape[1]), preserve_range=True)
+
+    n_z = zx.shape[0]
+    n_y, n_x = yx.shape
+
+    # empty corner at minimum intensity so it does not stand out after leveling
+    fill = min(yx.min(), zx.min(), zy.min())
+    out = np.full((n_y + n_z, n_x + n_z), fill, dtype=np.float64)
+    out[:n_y, :n_x] = yx
+    out[n_y:, :n_x] = zx
+    out[:n_y, n_x:] = zy.T
+
+    return out
+
+
+# intensity range for 8-bit conversion from quantiles of (a random sample of) the pixels of img
+def sampled_quantile_range(img, quantiles=(0.02, 0.9995), max_samples=1_000_000, seed=0):
+
+    values = img.ravel()
+    if values.size > max_samples:
+        values = np.random.default_rng(seed).choice(values, max_samples, replace=False)
+
+    low, high = np.quantile(values, quantiles)
+    return (low, high) if high > low else (low, low + 1)
+
+
+# level (rescale) projections to 8 bit, intensity_range: (min, max) or 'auto' (quantile-based)
+def to_8bit(img, intensity_range='auto', auto_range_quantiles=(0.02, 0.9995)):
+
+    if intensity_range == 'auto':
+        intensity_range = sampled_quantile_range(img, auto_range_quantiles)
+
+    return rescale_intensity(img, in_range=tuple(intensity_range), out_range=np.uint8).astype(np.uint8)
+
+
+# nd2: planes of all channels (cyx) with field and z index, read frame by frame
+def iter_nd2_planes(reader):
+
+    n_channels = reader.sizes.get('C', 1)
+    shape = (reader.sizes['Y'], reader.sizes['X'])
+
+    for frame_idx, loop_idx in enumerate(reader.loop_indices):
+        frame = reader.read_frame(frame_idx).reshape((n_channels, ) + shape)
+        yield loop_idx.get('P', 0), loop_idx.get('Z', 0), frame
+
+
+# orthogonal projections of all fields and channels of a nd2 file
+# a field is finished (and its projectors freed) as soon as its last plane was read, so only the fields
+# currently being read are kept in memory (one at a time for files ordered by field)
+# returns list of (field, channel name, 8-bit projection image)
+def project_nd2_streaming(file_path, projection_type='max', intensity_range='auto', auto_range_quantiles=(0.02, 0.9995)):
+
+    results = []
+    projectors = {}
+
+    def finish_field(field):
+        for channel_name, projector in zip(channel_names, projectors.pop(field)):
+            projection = assemble_orthogonal_projections(*projector.projections(), pixel_size)
+            results.append((field, channel_name, to_8bit(projection, intensity_range, auto_range_quantiles)))
+
+    with ND2File(file_path) as reader:
+        channel_names = [c.channel.name.strip().replace(' ', '-') for c in reader.metadata.channels]
+        pixel_size = reader.voxel_size()[::-1]
+        shape = (reader.sizes.get('Z', 1), reader.sizes['Y'], reader.sizes['X'])
+
+        for field, z, frame in iter_nd2_planes(reader):
+            if field not in projectors:
+                projectors[field] = [OrthogonalProjector(shape, projection_type) for _ in channel_names]
+            for projector, plane in zip(projectors[field], frame):
+                projector.add_plane(z, plane)
+
+            if projectors[field][0].n_planes == shape[0]:
+                finish_field(field)
+
+    # fields with missing planes (e.g. aborted acquisitions) are projected from the planes that were read
+    for field in list(projectors):
+        finish_field(field)
+
+    return sorted(results, key=lambda result: result[0])
+
+
+# orthogonal projections of all stacks of a msr file, one stack is read at a time
+# returns list of (channel name, 8-bit projection image)
+def project_msr_streaming(file, projection_type='max', intensity_range='auto', auto_range_quantiles=(0.02, 0.9995)):
+
+    results = []
+    with OBFFile(file) as f:
+
+        # metadata only once
+        pixel_sizes = f.pixel_sizes
+
+        for idx in range(len(pixel_sizes)):
+
+            # zyx pixel size (only for stacks, 2D images have no z size),
+            # sizes can be a list (newer msr_reader) or a dict by dimension name
+            img = f.read_stack(idx)
+            if img.ndim == 2:
+                img = img[np.newaxis]
+                pixel_size = None
+            else:
+                sizes = pixel_sizes[idx].sizes
+                pixel_size = [sizes[f'ExpControl {d}'] for d in 'ZYX'] if isinstance(sizes, dict) else list(sizes[:3])
+
+            projector = OrthogonalProjector(img.shape, projection_type)
+            for z in range(img.shape[0]):
+                projector.add_plane(z, img[z])
+            del img
+
+            projection = assemble_orthogonal_projections(*projector.projections(), pixel_size)
+            results.append((pixel_sizes[idx].name, to_8bit(projection, intensity_range, auto_range_quantiles)))
+
+    return results
+
+
+# orthogonal projections of all images in an image store (see image_store.py), read plane by plane
+# returns list of (image name, 8-bit projection image)
+def project_store_streaming(store_file, projection_type='max', intensity_range='auto', auto_range_quantiles=(0.02, 0.9995)):
+
+    results = []
+    for img in list_store_images(store_file):
+        with LazyStack(img) as stack:
+
+            # 2D images are stored as single plane stacks
+            pixel_size = stack.pixel_size if stack.shape[0] > 1 else None
+
+            projector = OrthogonalProjector(stack.shape, projection_type)
+            for z in range(stack.shape[0]):
+                projector.add_plane(z, stack.plane(z))
+
+        projection = assemble_orthogonal_projections(*projector.projections(), pixel_size)
+        results.append((image_name(img), to_8bit(projection, intensity_range, auto_range_quantiles)))
+
+    return results
+
+
+# project one file and save the results as png, returns the output files
+def save_file_projections(in_file, out_path, file_type='nd2', **kwargs):
+
+    stem = os.path.basename(str(in_file)).rsplit('.', 1)[0]
+
+    if file_type == 'nd2':
+        results = project_nd2_streaming(in_file, **kwargs)
+        # field index only for multi-field files
+        multi_field = len(set(field for field, _, _ in results)) > 1
+        outputs = [(f"{stem}{f'_field{field}' if multi_field else ''}_{channel_name}_projected.png", img)
+                   for field, channel_name, img in results]
+    elif file_type == 'store':
+        results = project_store_streaming(in_file, **kwargs)
+        outputs = [(f"{name}_projected.png", img) for name, img in results]
+    else:
+        results = project_msr_streaming(in_file, **kwargs)
+        outputs = [(f"{stem}_{channel_name}_projected.png", img) for channel_name, img in results]
+
+    out_files = []
+    for name, img in outputs:
+        out_file = os.path.join(str(out_path), name)
+        # catch low contrast warning
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            imsave(out_file, img)
+        out_files.append(out_file)
+
+    return out_files
+
+
+# wrapper for process pool, errors are returned instead of raised so one broken file does not stop the others
+def _save_file_projections(task):
+    in_file, out_path, file_type, kwargs = task
+    try:
+        return save_file_projections(in_file, out_path, file_type, **kwargs), None
+    except Exception as e:
+        return [], e
+
+
+# projections of many nd2 or msr files or image stores (file_type 'nd2' / 'msr' / 'store'), saved as png files in out_path
+# files are processed in parallel if n_workers > 1, files that can not be read are skipped
+def save_projections(in_files, out_path, file_type='nd2', projection_type='max', intensity_range='auto',
+                     auto_range_quantiles=(0.02, 0.9995), n_workers=None):
+
+    if file_type not in ('nd2', 'msr', 'store'):
+        raise ValueError(f"Unknown file type '{file_type}', use 'nd2', 'msr' or 'store'.")
+
+    os.makedirs(str(out_path), exist_ok=True)
+
+    kwargs = dict(projection_type=projection_type, intensity_range=intensity_range, auto_range_quantiles=auto_range_quantiles)
+    tasks = [(in_file, out_path, file_type, kwargs) for in_file in in_files]
+
+    # files are reported as soon as they are done
+    out_files = []
+
+    def collect(results):
+        for in_file, (files, error) in zip(in_files, results):
+            if error is not None:
+                print(f'error loading file {in_file} ({error}), skipping')
+                continue
+            out_files.extend(files)
+            print(f'saved projections of {str(in_file)}.')
+
+    if n_workers is None or n_workers <= 1:
+        collect(map(_save_file_projections, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            collect(executor.map(_save_file_projections, tasks))
+
+    return out_files
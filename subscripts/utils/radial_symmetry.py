@@ -0,0 +1,240 @@
+# in-process spot detection following the RS-FISH approach (DoG detection + radial symmetry localization)
+# pure numpy / scipy, can be used instead of running Fiji with the RS-FISH plugin
+# NOTE: parameters have the same meaning as in RS-FISH, but the implementation is not identical,
+# so results (especially DoG thresholds) can differ slightly from the Fiji plugin
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter, maximum_filter, map_coordinates
+
+
+# ratio of the two sigmas of the Difference of Gaussian (as ImgLib2 DoG with 4 steps per octave)
+DOG_SIGMA_RATIO = 2 ** (1 / 4)
+
+# number of random minimal line sets to try per spot if RANSAC is used
+RANSAC_TRIALS = 100
+
+# columns of RS-FISH result tables
+RESULT_COLUMNS = ['x', 'y', 'z', 't', 'c', 'intensity']
+
+
+# background subtraction methods, by name or index as in RS-FISH logs
+# NOTE: the RANSAC variants are approximated by their plain mean / median counterparts
+BACKGROUND_METHODS = {'0': None, '1': 'mean', '2': 'median', '3': 'mean', '4': 'median'}
+
+
+# convert the (string) parameters parsed by spot_detection.read_parameters to the values used in detection
+def parse_rs_parameters(parameters):
+
+    # RANSAC can be given as GUI option ("RANSAC" / "No RANSAC" / "MULTICONSENSU") or log value ("SIMPLE" / "NONE" / ...)
+    # NOTE: multiconsensus is handled like simple RANSAC
+    ransac = parameters['RANSAC'].strip().upper() not in ('NO RANSAC', 'NONE')
+
+    background = parameters['bsMethod'].strip().lower()
+    if background in BACKGROUND_METHODS:
+        background = BACKGROUND_METHODS[background]
+    else:
+        background = 'median' if 'median' in background else ('mean' if 'mean' in background else None)
+
+    min_intensity, max_intensity = float(parameters['min intensity']), float(parameters['max intensity'])
+    # the image is normalized to (min, max) intensity, an empty range gives inf / NaN DoG values and no spots
+    if max_intensity <= min_intensity:
+        raise ValueError(f"max intensity ({max_intensity}) has to be larger than min intensity ({min_intensity}).")
+
+    return {
+        'anisotropy': float(parameters['anisotropyCoefficient']),
+        'ransac': ransac,
+        'min_intensity': min_intensity,
+        'max_intensity': max_intensity,
+        'sigma': float(parameters['SigmaDoG']),
+        'threshold': float(parameters['ThresholdDoG']),
+        'support_radius': int(float(parameters['supportRadius'])),
+        'inlier_ratio': float(parameters['InlierRatio']),
+        'max_error': float(parameters['MaxError']),
+        'intensity_threshold': float(parameters['intensityThreshold']),
+        'background': background,
+    }
+
+
+# sigmas (zyx, in pixels) of the two Gaussians of the DoG
+# anisotropy: how much wider spots are in z than in xy (in pixels)
+def dog_sigmas(sigma, anisotropy):
+    sigma1 = np.array([sigma * anisotropy, sigma, sigma])
+    return sigma1, sigma1 * DOG_SIGMA_RATIO
+
+
+# radius (zyx, in pixels) of the support region used for localization
+def support_extent(support_radius, anisotropy):
+    return np.array([max(1, int(np.ceil(support_radius * anisotropy))), support_radius, support_radius])
+
+
+# border that has to be added around a block so that detection in the block is the same as in the whole image
+def block_halo(params):
+    _, sigma2 = dog_sigmas(params['sigma'], params['anisotropy'])
+    return np.ceil(4 * sigma2).astype(int) + 1 + support_extent(params['support_radius'], params['anisotropy']) + 1
+
+
+# center (closest point) of a set of lines given by points and unit directions, weighted least squares
+# points, directions: (..., n, 3), weights: (..., n) -> centers: (..., 3)
+def fit_lines_center(points, directions, weights):
+    projectors = np.eye(3) - directions[..., :, np.newaxis] * directions[..., np.newaxis, :]
+    weighted = weights[..., np.newaxis, np.newaxis] * projectors
+    lhs = weighted.sum(axis=-3)
+    rhs = np.einsum('...nij,...nj->...i', weighted, points)
+    with np.errstate(all='ignore'):
+        return np.linalg.solve(lhs + 1e-12 * np.eye(3), rhs[..., np.newaxis])[..., 0]
+
+
+# distances of all lines to (a batch of) centers
+# centers: (..., 3), points, directions: (n, 3) -> (..., n)
+def lines_distance(centers, points, directions):
+    diff = centers[..., np.newaxis, :] - points
+    along = np.sum(diff * directions, axis=-1)
+    return np.sqrt(np.maximum(np.sum(diff**2, axis=-1) - along**2, 0))
+
+
+# radial symmetry center of one spot from the gradients in its support region (isotropic coordinates)
+# returns center or None if the spot is rejected by RANSAC
+def radial_symmetry_center(points, gradients, params, rng):
+
+    magnitudes = np.linalg.norm(gradients, axis=1)
+    valid = magnitudes > 0
+    points, gradients, magnitudes = points[valid], gradients[valid], magnitudes[valid]
+    if len(points) < 3:
+        return None
+
+    directions = gradients / magnitudes[:, np.newaxis]
+    weights = magnitudes**2
+
+    if not params['ransac']:
+        return fit_lines_center(points, directions, weights)
+
+    # all minimal sets (3 lines) at once, score by number of inlier lines
+    subsets = np.argsort(rng.random((RANSAC_TRIALS, len(points))), axis=1)[:, :3]
+    centers = fit_lines_center(points[subsets], directions[subsets], weights[subsets])
+    inliers = lines_distance(centers, points, directions) < params['max_error']
+    best = np.argmax(inliers.sum(axis=1))
+    inliers = inliers[best]
+
+    if inliers.mean() < params['inlier_ratio'] or inliers.sum() < 3:
+        return None
+
+    return fit_lines_center(points[inliers], directions[inliers], weights[inliers])
+
+
+# detect spots in one block (with halo), only peaks inside the core region are kept
+# block: zyx array, origin: global zyx position of block[0,0,0], core: slices of the core region in the block
+def detect_spots_block(block, origin, core, params):
+
+    anisotropy = params['anisotropy']
+    scale = np.array([1 / anisotropy, 1, 1])
+
+    # normalize like RS-FISH (image min / max from settings)
+    img = (block.astype(np.float32) - params['min_intensity']) / (params['max_intensity'] - params['min_intensity'])
+
+    # DoG + local maxima above threshold
+    sigma1, sigma2 = dog_sigmas(params['sigma'], anisotropy)
+    dog = gaussian_filter(img, sigma1) - gaussian_filter(img, sigma2)
+    is_peak = (dog == maximum_filter(dog, size=3)) & (dog > params['threshold'])
+
+    core_mask = np.zeros_like(is_peak)
+    core_mask[core] = True
+    peaks = np.argwhere(is_peak & core_mask)
+
+    # gradients in isotropic coordinates (z spacing scaled by anisotropy)
+    gradients = np.stack(np.gradient(img, *scale), axis=-1)
+
+    extent = support_extent(params['support_radius'], anisotropy)
+    offsets = np.stack(np.meshgrid(*(np.arange(-e, e + 1) for e in extent), indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[np.linalg.norm(offsets * scale, axis=1) <= params['support_radius']]
+
+    # border of the support region for background estimation
+    border = np.linalg.norm(offsets * scale, axis=1) > params['support_radius'] - 1
+
+    spots = []
+    for peak in peaks:
+
+        # support region, clipped to the block
+        coords = peak + offsets
+        inside = np.all((coords >= 0) & (coords < block.shape), axis=1)
+        coords = coords[inside]
+
+        # RANSAC draws are seeded by the global spot position -> same result independent of blocks
+        rng = np.random.default_rng(tuple(int(c) for c in (peak + origin)))
+        center = radial_symmetry_center(coords * scale, gradients[tuple(coords.T)], params, rng)
+        if center is None:
+            continue
+
+        center = center / scale
+
+        # localization should stay close to the DoG peak
+        if np.any(np.abs(center - peak) > extent):
+            continue
+
+        # intensity (interpolated in original image), minus local background
+        intensity = map_coordinates(block.astype(np.float32), center[:, np.newaxis], order=1)[0]
+        if params['background'] in ('mean', 'median'):
+            border_values = block[tuple(coords[border[inside]].T)]
+            if len(border_values) > 0:
+                intensity -= np.mean(border_values) if params['background'] == 'mean' else np.median(border_values)
+
+        if intensity < params['intensity_threshold']:
+            continue
+
+        spots.append(np.concatenate([center + origin, [intensity]]))
+
+    return np.array(spots).reshape(-1, 4)
+
+
+# wrapper for process pool
+def _detect_spots_block(task):
+    return detect_spots_block(*task)
+
+
+# split an image into blocks (with halo) and detect spots in all of them, optionally in parallel
+# image: zyx array, parameters: dict from spot_detection.read_parameters
+# returns DataFrame in the format of RS-FISH result tables (x, y, z, t, c, intensity)
+def detect_spots_array(image, parameters, block_size=(16, 128, 128), n_workers=None):
+
+    params = parse_rs_parameters(parameters)
+
+    # 2D images as single plane
+    if image.ndim == 2:
+        image = image[np.newaxis]
+
+    halo = block_halo(params)
+    block_size = np.array(block_size)
+
+    tasks = []
+    for start in product(*(range(0, s, b) for s, b in zip(image.shape, block_size))):
+        start = np.array(start)
+        end = np.minimum(start + block_size, image.shape)
+
+        # block with halo, clipped to image
+        start_halo = np.maximum(start - halo, 0)
+        end_halo = np.minimum(end + halo, image.shape)
+        block = image[tuple(slice(s, e) for s, e in zip(start_halo, end_halo))]
+        core = tuple(slice(s - sh, e - sh) for s, e, sh in zip(start, end, start_halo))
+
+        tasks.append((block, start_halo, core, params))
+
+    if n_workers is None or n_workers <= 1:
+        results = [_detect_spots_block(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_detect_spots_block, tasks))
+
+    spots = np.concatenate(results) if len(results) > 0 else np.zeros((0, 4))
+
+    # to RS-FISH table layout (xyz, 1-based t & c)
+    return pd.DataFrame({
+        'x': spots[:, 2],
+        'y': spots[:, 1],
+        'z': spots[:, 0],
+        't': 1,
+        'c': 1,
+        'intensity': spots[:, 3]
+    }, columns=RESULT_COLUMNS)
@@ -0,0 +1,205 @@
+# batched RANSAC for 3D point correspondences (channel / bead alignment estimation)
+# same procedure as skimage.measure.ransac (best model: most inliers, ties broken by the sum of squared residuals,
+# final model re-estimated on its inliers), but minimal sets are sampled and solved in batches and the residuals
+# of all models of a batch are computed at once
+# stops once the best consensus set reaches the stop_probability confidence (adaptive number of trials)
+
+import numpy as np
+
+
+# affine transforms (b, 4, 4) mapping src to dst (b, m, 3), least squares for m > 4
+# (solved for centered points, which keeps the normal equations well conditioned)
+# returns matrices and whether the estimate is valid (non-degenerate, e.g. not coplanar point sets)
+def estimate_affine_batch(src, dst):
+
+    src_mean, dst_mean = src.mean(axis=1), dst.mean(axis=1)
+    src_c, dst_c = src - src_mean[:, np.newaxis], dst - dst_mean[:, np.newaxis]
+
+    sts = np.einsum('bmi,bmj->bij', src_c, src_c)
+    std = np.einsum('bmi,bmj->bij', src_c, dst_c)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = np.linalg.cond(sts) < 1 / np.sqrt(np.finfo(float).eps)
+    sts[~valid] = np.eye(3)
+
+    matrices = np.tile(np.eye(4), (len(src), 1, 1))
+    matrices[:, :3, :3] = np.linalg.solve(sts, std).transpose(0, 2, 1)
+    matrices[:, :3, 3] = dst_mean - np.einsum('bij,bj->bi', matrices[:, :3, :3], src_mean)
+
+    return matrices, valid
+
+
+# similarity transforms (rotation, uniform scale, translation) mapping src to dst (b, m, 3), Umeyama's method
+# (as in skimage SimilarityTransform.estimate), returns matrices and validity
+# estimate_scale=False: rigid transforms (as in skimage EuclideanTransform.estimate)
+def estimate_similarity_batch(src, dst, estimate_scale=True):
+
+    src_mean, dst_mean = src.mean(axis=1), dst.mean(axis=1)
+    src_c, dst_c = src - src_mean[:, np.newaxis], dst - dst_mean[:, np.newaxis]
+
+    cov = np.einsum('bmi,bmj->bij', dst_c, src_c) / src.shape[1]
+    u, s, vt = np.linalg.svd(cov)
+
+    # rank of the covariance (degenerate if less than 2), e.g. rank 2 for all minimal sets of 3 points
+    tol = s[:, 0] * np.sqrt(np.finfo(float).eps)
+    rank = (s > tol[:, np.newaxis]).sum(axis=1)
+
+    # reflection correction (as in Umeyama / skimage): full rank -> sign of det(cov),
+    # rank 2 -> det(cov) is only rounding noise, use the orientation of the singular vectors instead
+    reflection = np.where(rank == 3, np.linalg.det(cov) < 0, np.linalg.det(u) * np.linalg.det(vt) < 0)
+    d = np.ones((len(src), 3))
+    d[reflection, 2] = -1
+
+    rotation = np.einsum('bij,bj,bjk->bik', u, d, vt)
+    src_var = (src_c**2).sum(axis=(1, 2)) / src.shape[1]
+
+    valid = (src_var > 0) & (rank >= 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(valid & estimate_scale, (s * d).sum(axis=1) / src_var, 1.0)
+
+    matrices = np.tile(np.eye(4), (len(src), 1, 1))
+    matrices[:, :3, :3] = rotation * scale[:, np.newaxis, np.newaxis]
+    matrices[:, :3, 3] = dst_mean - np.einsum('bij,bj->bi', matrices[:, :3, :3], src_mean)
+
+    return matrices, valid
+
+
+# rigid transforms (rotation, translation), returns matrices and validity
+def estimate_euclidean_batch(src, dst):
+    return estimate_similarity_batch(src, dst, estimate_scale=False)
+
+
+MODEL_ESTIMATORS = {
+    'affine': estimate_affine_batch,
+    'similarity': estimate_similarity_batch,
+    'euclidean': estimate_euclidean_batch,
+}
+
+
+# Euclidean residuals (b, n) of all points for each of b transforms
+# (one batched matrix product of the homogeneous source points, much faster than einsum)
+def residuals_batch(matrices, src, dst):
+    src_h = np.hstack([src, np.ones((len(src), 1))])
+    diff = np.matmul(src_h, matrices[:, :3].transpose(0, 2, 1)) - dst
+    return np.sqrt(np.einsum('bni,bni->bn', diff, diff))
+
+
+# number of trials needed to draw at least one outlier-free minimal set with given probability (like skimage)
+def dynamic_max_trials(n_inliers, n_samples, min_samples, probability):
+
+    if probability >= 1 or n_inliers == 0:
+        return np.inf
+    if n_inliers == n_samples:
+        return 1
+
+    inlier_ratio = n_inliers / n_samples
+    nom = np.log(1 - probability)
+    denom = np.log(1 - inlier_ratio**min_samples)
+    return np.inf if denom == 0 else int(np.ceil(nom / denom))
+
+
+# random minimal sets (b, min_samples) of distinct indices < n_samples
+def sample_minimal_sets(rng, batch_size, n_samples, min_samples):
+
+    # draw with replacement and redraw the (rare, for n_samples >> min_samples) sets with repeated indices
+    sets = rng.integers(0, n_samples, (batch_size, min_samples))
+    while True:
+        sorted_sets = np.sort(sets, axis=1)
+        repeated = (np.diff(sorted_sets, axis=1) == 0).any(axis=1)
+        if not repeated.any():
+            return sets
+        sets[repeated] = rng.integers(0, n_samples, (repeated.sum(), min_samples))
+
+
+# RANSAC for a 3D transform (model: 'affine', 'similarity' or 'euclidean') from point correspondences src -> dst (n, 3)
+# returns the 4x4 matrix of the transform (re-estimated on all inliers) and the inlier mask,
+# (None, None) if no model with inliers was found
+# random_state: seed or generator, results are reproducible for a fixed seed (and batch_size)
+def ransac_transform(src, dst, model='affine', min_samples=4, residual_threshold=0.1, max_trials=5_000,
+                     stop_probability=0.99, random_state=None, batch_size=256):
+
+    if model not in MODEL_ESTIMATORS:
+        raise ValueError(f"Unknown model '{model}', use one of {list(MODEL_ESTIMATORS)}.")
+
+    src, dst = np.asarray(src, dtype=float), np.asarray(dst, dtype=float)
+    n_samples = len(src)
+    if not (0 < min_samples <= n_samples):
+        raise ValueError(f"`min_samples` must be in range (0, {n_samples}]")
+
+    estimate = MODEL_ESTIMATORS[model]
+    rng = np.random.default_rng(random_state)
+
+    best_inliers, best_n_inliers, best_residuals_sum = None, 0, np.inf
+    n_trials = 0
+
+    while n_trials < max_trials:
+
+        n_batch = int(min(batch_size, max_trials - n_trials))
+        sets = sample_minimal_sets(rng, n_batch, n_samples, min_samples)
+        matrices, valid = estimate(src[sets], dst[sets])
+        n_trials += n_batch
+
+        if not valid.any():
+            continue
+        matrices = matrices[valid]
+
+        residuals = residuals_batch(matrices, src, dst)
+        inliers = residuals < residual_threshold
+        n_inliers = inliers.sum(axis=1)
+        residuals_sum = np.einsum('bn,bn->b', residuals, residuals)
+
+        # best of the batch: most inliers, then lowest residual sum (first one on ties, like sequential trials)
+        best = np.lexsort((residuals_sum, -n_inliers))[0]
+        if n_inliers[best] > best_n_inliers or (n_inliers[best] == best_n_inliers and residuals_sum[best] < best_residuals_sum):
+            best_inliers, best_n_inliers, best_residuals_sum = inliers[best], n_inliers[best], residuals_sum[best]
+            max_trials = min(max_trials, dynamic_max_trials(best_n_inliers, n_samples, min_samples, stop_probability))
+
+    if best_inliers is None or best_n_inliers == 0:
+        return None, None
+
+    # final model from all inliers
+    matrices, valid = estimate(src[best_inliers][np.newaxis], dst[best_inliers][np.newaxis])
+    return matrices[0], best_inliers
+
+
+# coordinates of matched spots (columns {d}_micron{suffix}) of a table with FOV info (see alignment estimation notebook)
+# flipped to bottom-to-top z if necessary and moved back up by the FOV (only in z!)
+def bottom_to_top_coordinates(df, suffix):
+
+    coords = df[[f"{d}_micron{suffix}" for d in 'zyx']].to_numpy(dtype=float)
+    fov = df[[f"fov_micron_{d}" for d in 'zyx']].to_numpy(dtype=float)
+    top_to_bottom = ~df["bottom_to_top"].to_numpy(dtype=bool)
+
+    coords[top_to_bottom, 0] = fov[top_to_bottom, 0] - coords[top_to_bottom, 0]
+    return coords
+
+
+# RANSAC transform for each channel pair in a table of matched spots (columns channel1, channel2, coordinates, FOV info)
+# returns transforms dict channel pair -> 4x4 matrix (with inverse for the reversed pair, like in the notebook,
+# ready for corrections.save_transforms) and tables of each pair with added inlier column
+# each pair gets its own random generator spawned from random_state -> reproducible for a fixed seed
+def estimate_channel_transforms(matched_df, model='affine', residual_threshold=0.1, max_trials=5_000,
+                                stop_probability=0.99, random_state=None, channel_columns=('channel1', 'channel2')):
+
+    transforms = {}
+    inlier_dfs = {}
+
+    groups = list(matched_df.groupby(list(channel_columns)))
+    rngs = np.random.default_rng(random_state).spawn(len(groups))
+
+    for ((ch1, ch2), dfi), rng in zip(groups, rngs):
+
+        matrix, inliers = ransac_transform(bottom_to_top_coordinates(dfi, '_ch1'), bottom_to_top_coordinates(dfi, '_ch2'),
+                                           model, 4, residual_threshold, max_trials, stop_probability, rng)
+        if matrix is None:
+            print(f'RANSAC on {ch1}->{ch2} found no inliers, skipping.')
+            continue
+
+        inlier_df = dfi.copy()
+        inlier_df["inlier"] = inliers
+        inlier_dfs[(ch1, ch2)] = inlier_df
+
+        transforms[(ch1, ch2)] = matrix
+        transforms[(ch2, ch1)] = np.linalg.inv(matrix)
+
+    return transforms, inlier_dfs
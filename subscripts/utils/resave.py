@@ -1,6 +1,8 @@
 import os
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore
 from glob import glob
 import numpy as np
 from natsort import natsorted
@@ -60,7 +62,9 @@ def resave_nd2(nd2files):
                 tifffile.imsave(f"{nd2files}/tif/{name}_ch{ch}.tif", img[:, :, :, ch].astype(np.uint16))
                     
 #### updated version
-def resave_auto_nd2(nd2files):
+# streaming: read frames one by one (instead of the whole file) and write stacks through a pool of n_writers threads
+# -> peak memory is about one field (all channels) plus one stack per writer, instead of the whole file
+def resave_auto_nd2(nd2files, streaming=False, n_writers=2):
     
     nd2files_paths = glob(nd2files + "/*nd2")
     
@@ -68,6 +72,12 @@ def resave_auto_nd2(nd2files):
     out = f"{nd2files}/tif/"
     os.makedirs(out, exist_ok=True)
 
+    if streaming:
+        with ThreadPoolExecutor(max_workers=n_writers) as executor:
+            for nd2_file in nd2files_paths:
+                resave_nd2_streaming(nd2_file, out, executor, n_writers)
+        return
+
     for nd2_file in nd2files_paths:
         with ND2File(nd2_file) as reader:
             # NOTE: needs testing for different dimensionality files
@@ -81,6 +91,61 @@ def resave_auto_nd2(nd2files):
                     tifffile.imsave(f"{nd2files}/tif/{name}_ch{ch}.tif", img[field, ch, :, :, :].astype(np.uint16))
 
 
+# read one nd2 file field by field, reading single frames (all channels of one z plane)
+# yields (field, channel stacks) with one uint16 (z, y, x) stack per channel
+# frames are written directly into the stacks (no extra copy if data already is uint16)
+def iter_nd2_fields(reader):
+
+    n_channels = reader.sizes.get('C', 1)
+    n_z = reader.sizes.get('Z', 1)
+    shape = (reader.sizes['Y'], reader.sizes['X'])
+
+    # frame indices of each field, sorted by z
+    fields = {}
+    for frame_idx, loop_idx in enumerate(reader.loop_indices):
+        fields.setdefault(loop_idx.get('P', 0), {})[loop_idx.get('Z', 0)] = frame_idx
+
+    for field, frames in sorted(fields.items()):
+
+        stacks = [np.empty((n_z, ) + shape, dtype=np.uint16) for _ in range(n_channels)]
+        for z, frame_idx in frames.items():
+            frame = reader.read_frame(frame_idx).reshape((n_channels, ) + shape)
+            for ch in range(n_channels):
+                stacks[ch][z] = frame[ch]
+
+        yield field, stacks
+        del stacks
+
+
+# resave one nd2 file field by field
+# finished channel stacks are written by the executor, at most max_pending writes are queued at once
+# -> peak memory: channel stacks of the current field + max_pending stacks waiting to be written
+def resave_nd2_streaming(nd2_file, out, executor, max_pending=2):
+
+    base_name = os.path.basename(nd2_file).rsplit(".", 1)[0]
+    pending = Semaphore(max_pending)
+
+    def _write(path, stack):
+        try:
+            tifffile.imwrite(path, stack)
+        finally:
+            pending.release()
+
+    futures = []
+    with ND2File(nd2_file) as reader:
+        for field, stacks in iter_nd2_fields(reader):
+
+            # hand stacks over to writers, each is freed once it is written
+            for ch in range(len(stacks)):
+                pending.acquire()
+                futures.append(executor.submit(_write, f"{out}/{base_name}_field{field}_ch{ch}.tif", stacks[ch]))
+            del stacks
+
+    # raise errors from writers
+    for future in futures:
+        future.result()
+
+
 ################################################
 # reads all msr files and resaves them as tif 
 def resave_msr(folder,out):
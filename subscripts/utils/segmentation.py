@@ -0,0 +1,191 @@
+# CPU cell segmentation with cellpose (3D), for machines without GPU
+# large volumes are segmented in overlapping yx tiles (sized to a memory budget), labels are stitched across tiles
+# files are distributed over a process pool, each worker loads the model once and uses a fixed number of threads
+#
+# masks are saved like the segmentation notebook does: <name>_seg.npy (dict with 'masks', readable with
+# spot_analysis.load_mask) and <name>_cp_masks.tif
+
+import os
+import numpy as np
+import tifffile
+from concurrent.futures import ProcessPoolExecutor
+
+
+# rough peak memory of cellpose 3D per voxel of a tile (image, flows and cell probabilities of the three
+# orthogonal 2D passes in float32, z upsampling by anisotropy, network activations)
+CELLPOSE_BYTES_PER_VOXEL = 256
+
+
+# start positions of tiles of size tile with (at least) overlap along an axis of given size
+def tile_starts(size, tile, overlap):
+
+    if size <= tile:
+        return [0]
+
+    starts = list(range(0, size - tile, tile - overlap))
+    return starts + [size - tile]
+
+
+# largest yx tile shape (all z planes) whose segmentation fits into max_memory_mb
+def tile_shape_for_memory(shape, max_memory_mb, overlap, bytes_per_voxel=CELLPOSE_BYTES_PER_VOXEL):
+
+    n_z, n_y, n_x = shape
+    tile = int(np.sqrt(max_memory_mb * 2**20 / (n_z * bytes_per_voxel)))
+
+    if tile <= 2 * overlap and tile < max(n_y, n_x):
+        raise ValueError(f"Memory budget of {max_memory_mb} MB is too small for tiles with an overlap of {overlap} pixels.")
+
+    return n_z, min(tile, n_y), min(tile, n_x)
+
+
+# yx tiles (as slices) covering an image of given shape
+def iter_tiles(shape, tile_shape, overlap):
+    for y in tile_starts(shape[1], tile_shape[1], overlap):
+        for x in tile_starts(shape[2], tile_shape[2], overlap):
+            yield (slice(None), slice(y, y + tile_shape[1]), slice(x, x + tile_shape[2]))
+
+
+# add the labels of one tile to the stitched mask (in place), returns the next free label
+# covered: voxels already segmented in previous tiles
+# a tile label is merged with the label it overlaps most in the covered region if they share at least min_overlap
+# of its covered voxels, otherwise it gets a new label; only voxels not covered yet are written
+def stitch_tile(mask, covered, tile_labels, region, next_label, min_overlap=0.5):
+
+    existing = mask[region]
+    previous = covered[region]
+
+    n_local = int(tile_labels.max()) + 1
+    lut = np.zeros(n_local, dtype=mask.dtype)
+
+    # overlap of tile labels with labels of previous tiles
+    in_previous = previous & (tile_labels > 0)
+    n_covered = np.bincount(tile_labels[in_previous], minlength=n_local)
+    both = in_previous & (existing > 0)
+    if both.any():
+        pairs, counts = np.unique(np.stack([tile_labels[both], existing[both]]), axis=1, return_counts=True)
+        # best match for each tile label: sort by count, last one wins
+        order = np.argsort(counts, kind='stable')
+        best_label = np.zeros(n_local, dtype=mask.dtype)
+        best_count = np.zeros(n_local, dtype=np.int64)
+        best_label[pairs[0, order]] = pairs[1, order]
+        best_count[pairs[0, order]] = counts[order]
+
+        matched = (best_count > 0) & (best_count >= min_overlap * n_covered)
+        lut[matched] = best_label[matched]
+
+    # new labels for all other cells of the tile
+    new = np.flatnonzero(lut == 0)[1:] if n_local > 1 else np.zeros(0, dtype=int)
+    new = new[np.isin(new, tile_labels)]
+    lut[new] = np.arange(next_label, next_label + len(new))
+
+    write = ~previous
+    existing[write] = lut[tile_labels[write]]
+    covered[region] = True
+
+    return next_label + len(new)
+
+
+# set labels with less than min_size voxels to background and relabel consecutively
+def remove_small_labels(mask, min_size):
+
+    sizes = np.bincount(mask.ravel())
+    keep = sizes >= min_size
+    keep[0] = False
+
+    lut = np.zeros(len(sizes), dtype=mask.dtype)
+    lut[keep] = np.arange(1, keep.sum() + 1)
+    return lut[mask]
+
+
+# segment a zyx image tile by tile with segment_fn (tile -> labels) and stitch the labels
+def segment_tiled(img, segment_fn, tile_shape, overlap, min_size=0):
+
+    mask = np.zeros(img.shape, dtype=np.uint32)
+    covered = np.zeros(img.shape, dtype=bool)
+    next_label = 1
+
+    for region in iter_tiles(img.shape, tile_shape, overlap):
+        tile_labels = np.asarray(segment_fn(img[region])).astype(np.int64)
+        next_label = stitch_tile(mask, covered, tile_labels, region, next_label)
+
+    return remove_small_labels(mask, max(min_size, 1))
+
+
+# whether the mask of an image exists and is newer than the image (and the model file, if the model is a file)
+def mask_is_up_to_date(image_file, mask_file, model=None):
+
+    if not os.path.exists(mask_file):
+        return False
+
+    sources = [image_file] + ([model] if model is not None and os.path.isfile(str(model)) else [])
+    return all(os.path.getmtime(mask_file) >= os.path.getmtime(source) for source in sources)
+
+
+############# process pool: one cellpose model per worker #################
+
+_worker_model = None
+
+
+def _init_worker(model, n_threads):
+
+    # limit threads before torch is imported
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(n_threads)
+
+    import torch
+    from cellpose import models
+
+    torch.set_num_threads(n_threads)
+
+    global _worker_model
+    _worker_model = models.CellposeModel(model_type=model, device=torch.device('cpu'), gpu=False)
+
+
+# segment one file and save the masks, used as process pool task
+def _segment_file(task):
+
+    filename, out_path, eval_kwargs, min_size, max_memory_mb, overlap = task
+
+    img = tifffile.imread(filename)
+    name = os.path.basename(filename).rsplit(".", 1)[0]
+
+    # min_size is applied after stitching, otherwise cells cut by tile borders would be removed
+    def segment_fn(tile):
+        return _worker_model.eval(tile, do_3D=True, min_size=-1, **eval_kwargs)[0]
+
+    tile_shape = tile_shape_for_memory(img.shape, max_memory_mb, overlap)
+    masks = segment_tiled(img, segment_fn, tile_shape, overlap, min_size=min_size)
+
+    np.save(f"{out_path}/{name}_seg.npy", {'masks': masks, 'filename': filename, 'diameter': eval_kwargs.get('diameter')})
+    tifffile.imwrite(f"{out_path}/{name}_cp_masks.tif", masks)
+
+    return filename
+
+
+# segment all files on CPU, n_workers processes with n_threads threads each
+# max_memory_mb: memory budget per worker, determines the tile size; overlap of tiles in pixels (default: diameter)
+# files whose masks are newer than image and model are skipped unless force
+def segment_files(files, out_path, model, diameter=120, min_size=5000, anisotropy=2.3, channels=(0, 0),
+                  n_workers=1, n_threads=1, max_memory_mb=4000, overlap=None, force=False):
+
+    os.makedirs(out_path, exist_ok=True)
+
+    if overlap is None:
+        overlap = int(diameter)
+
+    todo = []
+    for filename in files:
+        name = os.path.basename(filename).rsplit(".", 1)[0]
+        if not force and mask_is_up_to_date(filename, f"{out_path}/{name}_seg.npy", model):
+            print(f"{filename}: masks up to date, skipping")
+            continue
+        todo.append(filename)
+
+    eval_kwargs = dict(diameter=diameter, anisotropy=anisotropy, channels=list(channels))
+    tasks = [(filename, out_path, eval_kwargs, min_size, max_memory_mb, overlap) for filename in todo]
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(model, n_threads)) as executor:
+        for filename in executor.map(_segment_file, tasks):
+            print(f"{filename}: segmented")
+
+    return todo
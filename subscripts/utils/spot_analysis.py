@@ -7,67 +7,127 @@ import re
 from skimage.io import imsave
 from skimage.morphology import label
 from skimage.segmentation import clear_border
-from skimage.measure import regionprops
 
 import imageio
 import matplotlib.pyplot as plt
 from skimage.io import imread
 from scipy.optimize import linear_sum_assignment
-from itertools import product
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 
+from utils.spot_store import read_spot_table
+
+
+# normalized image key to match spot tables and masks: file name without extension, mask ending and channel
+def image_key(path, mask_ending=""):
+    name = path.split("/")[-1].split(".")[0]
+    if mask_ending:
+        name = name.replace(mask_ending, "")
+    return re.sub(r'_ch\d+', '', name)
+
+
+# positions (rows) of spots for each image key, built once for the whole spot table
+def index_spots_by_image(df, mask_ending=""):
+
+    img_positions = df.groupby('img', sort=False).indices
+
+    key_positions = defaultdict(list)
+    for img, positions in img_positions.items():
+        key_positions[image_key(img)].append(positions)
+
+    key_positions = {key: np.sort(np.concatenate(positions)) for key, positions in key_positions.items()}
+    return img_positions, key_positions
+
+
+# rows of spots belonging to a mask: exact key match, or (as before) substring match in the image names
+def spot_positions_for_mask(name, img_positions, key_positions):
+
+    if name in key_positions:
+        return key_positions[name]
+
+    positions = [pos for img, pos in img_positions.items() if re.search(name, img)]
+    return np.sort(np.concatenate(positions)) if len(positions) > 0 else np.zeros(0, dtype=int)
+
+
+# integer spot coordinates (z)yx, spot tables of 2D images may have no z column
+def spot_pixel_coordinates(df):
+    return df[[col for col in ('z', 'y', 'x') if col in df.columns]].values.astype(int)
+
+
+# index arrays into a mask for (z)yx spot coordinates: the last mask.ndim coordinates (2D masks only use yx)
+def mask_index(mask, coords):
+    if coords.shape[1] < mask.ndim:
+        raise ValueError(f"{mask.ndim}D mask, but spots only have {coords.shape[1]} coordinates.")
+    return tuple(coords[:, -mask.ndim:].T)
+
+
+# load a segmentation mask (cellpose .npy or .png), None for unsupported files
+def load_mask(file):
+
+    file_type = os.path.splitext(file)[1]
+    
+    if file_type == ".npy":
+        return np.load(file,allow_pickle=True).item()['masks']
+    elif file_type == ".png":
+        return imread(file)
+    else:
+        print("Please input valid segmentation masks (.npy and .png supported).")
+        return None
+
+
+# cell label and whether cell touches the border for spot coordinates (zyx) in one mask, used as process pool task
+def _cell_info_for_mask(task):
+
+    file, coords = task
+
+    mask = load_mask(file)
+    if mask is None:
+        return None
+
+    # label all cells and remove cells on edges
+    labelled_mask = label(mask)
+    cleared_mask = clear_border(labelled_mask)
+
+    idx = mask_index(cleared_mask, coords)
+
+    return labelled_mask[idx], cleared_mask[idx] != 0
+
 
 # assigns each spot to a cell and filters spots.csv for spots in cells
-def add_cell_info(masks,path_spots,out,filter=True,mask_ending="_cp_masks"):
+# n_workers: number of processes to load / label masks in parallel, None/1 to run sequentially
+def add_cell_info(masks,path_spots,out,filter=True,mask_ending="_cp_masks",n_workers=None):
     
-    df = pd.read_csv(path_spots)
-        
-    df_list = []
+    df = read_spot_table(path_spots)
+
+    # index spot table once by image
+    img_positions, key_positions = index_spots_by_image(df)
+    coords = spot_pixel_coordinates(df)
+
+    # subset spots for spots in each image
+    positions = [spot_positions_for_mask(image_key(file, mask_ending), img_positions, key_positions) for file in masks]
+    tasks = [(file, coords[pos]) for file, pos in zip(masks, positions)]
+
+    if n_workers is None or n_workers <= 1:
+        results = [_cell_info_for_mask(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_cell_info_for_mask, tasks, chunksize=max(1, len(tasks) // (4 * n_workers))))
     
-    for file in masks:
-        # subset spots for spots in current image
-        name = file.split("/")[-1].split(".")[0]
-        name = name.replace(mask_ending, "")
-        name = re.sub(r'_ch\d+', '', name)
-        subset_df = df[df['img'].str.contains(name)]
-        
-        # load mask
-        file_type = os.path.splitext(file)[1]
-        
-        if file_type == ".npy":
-            mask = np.load(file,allow_pickle=True).item()['masks']
-        elif file_type == ".png":
-            mask = imread(file)
-        else:
-            print("Please input valid segmentation masks (.npy and .png supported).")
-        
-        # label all cells and remove cells on edges
-        labelled_mask = label(mask)
-        cleared_mask = clear_border(labelled_mask)
-
-        
-    # add cell info to spots
-        # for 2d masks
-        if len(cleared_mask.shape) == 2:            
-            cell = labelled_mask[subset_df['y'].astype(int), subset_df['x'].astype(int)]
-            subset_df.insert(1, 'cell', cell)
-
-            # info about whether spot is in cell on border
-            spot_in_cleared_mask = cleared_mask[subset_df['y'].astype(int), subset_df['x'].astype(int)] != 0
-            subset_df.insert(2, 'whole_cell', spot_in_cleared_mask)
-
-            df_list.append(subset_df)
-            
-        # for 3d masks
-        elif len(cleared_mask.shape) == 3:
-            cell = labelled_mask[subset_df['z'].astype(int), subset_df['y'].astype(int), subset_df['x'].astype(int)]
-            subset_df.insert(1, 'cell', cell)
+    df_list = []
+    for pos, result in zip(positions, results):
+        if result is None:
+            continue
 
-            # info about whether spot is in cell touching border
-            spot_in_cleared_mask = cleared_mask[subset_df['z'].astype(int), subset_df['y'].astype(int), subset_df['x'].astype(int)] != 0
-            subset_df.insert(2, 'whole_cell', spot_in_cleared_mask)
+        # add cell info to spots, and info about whether spot is in cell touching border
+        cell, spot_in_cleared_mask = result
+        subset_df = df.iloc[pos].copy()
+        subset_df.insert(1, 'cell', cell)
+        subset_df.insert(2, 'whole_cell', spot_in_cleared_mask)
 
-            df_list.append(subset_df)
+        df_list.append(subset_df)
             
     spots = pd.concat(df_list, ignore_index=True)
     
@@ -77,82 +137,89 @@ def add_cell_info(masks,path_spots,out,filter=True,mask_ending="_cp_masks"):
     
     spots.to_csv(out, index=False)
     
+# per-cell statistics of one mask, used as process pool task in get_sensitivity
+# returns cell sizes (bincount over labels) and number of spots per cell for each image (spot-label histograms)
+def _cell_statistics_for_mask(task):
+
+    file, coords_per_img = task
+
+    mask = load_mask(file)
+    if mask is None:
+        return None
+
+    # label all cells and remove cells on edges
+    cleared_mask = clear_border(label(mask))
+
+    cell_sizes = np.bincount(cleared_mask.ravel())
+    spot_counts = {img: np.bincount(cleared_mask[mask_index(cleared_mask, coords)], minlength=len(cell_sizes))
+                   for img, coords in coords_per_img.items()}
+
+    return cell_sizes, spot_counts
+
+
 # calculates number of spots per cell (sensitivity)
-def get_sensitivity(masks,path_spots,out,tifs,mask_ending="_cp_masks"):
-    
-    df = pd.read_csv(path_spots)
-        
-    df_list = []
-    dapi_ch = re.search(r'ch(\d+)', masks[0]).group() # segmentation channel
-    img_names = list(filter(lambda x: dapi_ch not in x, tifs)) # all images without segmentation ch
+# min_cell_size: cells with fewer pixels / voxels are removed (faulty segmentation)
+# n_workers: number of processes to load / label masks in parallel, None/1 to run sequentially
+# NOTE: tifs is not needed anymore and only kept for compatibility
+def get_sensitivity(masks,path_spots,out,tifs=None,mask_ending="_cp_masks",min_cell_size=50000,n_workers=None):
     
+    df = read_spot_table(path_spots)
+
+    # index spot table once by image
+    img_positions, key_positions = index_spots_by_image(df)
+    coords = spot_pixel_coordinates(df)
+    img_values = df['img'].values
+
+    # subset spots for spots in each image, split by image
+    tasks = []
     for file in masks:
-        # subset spots for spots in current image
-        name = file.split("/")[-1].split(".")[0]
-        name = name.replace(mask_ending, "")
-        name = re.sub(r'_ch\d+', '', name)
-        subset_df = df[df['img'].str.contains(name)]
-        
-        # load mask
-        file_type = os.path.splitext(file)[1]
-        
-        if file_type == ".npy":
-            mask = np.load(file,allow_pickle=True).item()['masks']
-        elif file_type == ".png":
-            mask = imread(file)
-        else:
-            print("Please input valid segmentation masks (.npy and .png supported).")
-        
-        # label all cells and remove cells on edges
-        labelled_mask = label(mask)
-        cleared_mask = clear_border(labelled_mask)
-#         cleared_mask = labelled_mask
-        
-        # add cell info to spots
-        # for 2d masks
-        if len(cleared_mask.shape) == 2:            
-            cell = cleared_mask[subset_df['y'].astype(int), subset_df['x'].astype(int)]
-            subset_df.loc[:, 'cell'] = cell if 'cell' in subset_df.columns else cell
-#             subset_df.insert(1, 'cell', cell)
-            
-        # for 3d masks
-        elif len(cleared_mask.shape) == 3:
-            cell = cleared_mask[subset_df['z'].astype(int), subset_df['y'].astype(int), subset_df['x'].astype(int)]
-            subset_df.loc[:, 'cell'] = cell if 'cell' in subset_df.columns else cell
-#             subset_df.insert(1, 'cell', cell)
-    
-
-        # add number of spots in each cell
-        img_names = pd.DataFrame({'img': subset_df['img'].unique()}) # all unique img names
-        
-        img_names_current = pd.DataFrame({'img': [img for img in img_names['img'] if name in img]}) # get current images
-        cell_df = pd.DataFrame({'cell': np.unique(cleared_mask)}) # all cells
-        cell_df = img_names_current.merge(cell_df,how='cross')
-        cell_df['channel'] = cell_df['img'].str.extract(r'ch(\d+)')
-        spots = subset_df.groupby(['img','cell']).size().reset_index(name='count') # cell id for each spot        
-        cell_df = cell_df.merge(spots, on=['img','cell'], how='outer')
-        cell_df['count'] = cell_df['count'].fillna(0) # all cells without spots get 0
-
-        # measure cell sizes using regionprops
-        region_props = regionprops(cleared_mask)
-        cell_sizes = [[prop.label, prop.area] for prop in region_props]
-        cell_sizes = pd.DataFrame(cell_sizes, columns=['cell', 'cell_size'])
-        cell_df = cell_df.merge(cell_sizes, on='cell', how='outer')
-        
-        df_list.append(cell_df)
-      
+        name = image_key(file, mask_ending)
+        positions = spot_positions_for_mask(name, img_positions, key_positions)
+
+        # current images (in sorted order, as after merging)
+        imgs = sorted(img for img in pd.unique(img_values[positions]) if name in img)
+        tasks.append((file, {img: coords[img_positions[img]] for img in imgs}))
+
+    if n_workers is None or n_workers <= 1:
+        results = [_cell_statistics_for_mask(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_cell_statistics_for_mask, tasks, chunksize=max(1, len(tasks) // (4 * n_workers))))
+
+    # one row per (cell, image) with number of spots and cell size
+    columns = defaultdict(list)
+    has_missing_counts = False
+    for result in results:
+        if result is None:
+            continue
+        if len(result[1]) == 0:
+            has_missing_counts = True
+            continue
+
+        cell_sizes, spot_counts = result
+        cells = np.flatnonzero(cell_sizes) # all cells (incl. background 0)
+        imgs = list(spot_counts.keys())
+
+        columns['img'].append(np.tile(imgs, len(cells)))
+        columns['cell'].append(np.repeat(cells, len(imgs)))
+        columns['count'].append(np.stack([spot_counts[img][cells] for img in imgs], axis=1).ravel())
+        # background has no size
+        columns['cell_size'].append(np.repeat(np.where(cells == 0, np.nan, cell_sizes[cells]), len(imgs)))
+
     # combine all images into 1 df
-    spots_per_cell = pd.concat(df_list, ignore_index=True) 
+    spots_per_cell = pd.DataFrame({col: np.concatenate(values) if len(values) > 0 else [] for col, values in columns.items()},
+                                  columns=['img', 'cell', 'count', 'cell_size'])
+    spots_per_cell.insert(2, 'channel', spots_per_cell['img'].str.extract(r'ch(\d+)', expand=False))
+    # counts are float if a cell or mask had no spots (as the NaN-filled counts of the previous per-mask merges), int otherwise
+    if has_missing_counts or (spots_per_cell['count'] == 0).any():
+        spots_per_cell['count'] = spots_per_cell['count'].astype(float)
     
     # remove too small cells (faulty segmentation)
-    spots_per_cell = spots_per_cell[spots_per_cell['cell_size'] > 50000]
-    
-#     # get sensitivity
-#     spots_per_cell = spots_per_cell[spots_per_cell.cell != 0]
+    spots_per_cell = spots_per_cell[spots_per_cell['cell_size'] > min_cell_size]
 
-    # add metadata
+    # add metadata (one row per image)
     columns_to_drop = ['x', 'y', 'z', 'spot_idx', 'channel', 't', 'c', 'intensity','cell','whole_cell']
-    df = df.drop(columns=[col for col in columns_to_drop if col in df.columns]) # crop spot specific cols
+    df = df.drop(columns=[col for col in columns_to_drop if col in df.columns]).drop_duplicates() # crop spot specific cols
     
     spots_per_cell = spots_per_cell.merge(df,on="img",how="left")
     spots_per_cell = spots_per_cell.dropna(subset=["channel"]).drop_duplicates()
@@ -160,36 +227,108 @@ def get_sensitivity(masks,path_spots,out,tifs,mask_ending="_cp_masks"):
     spots_per_cell.to_csv(out, index=False)
     
 
+# distances between all spots of 2 channels, scaled by voxel size (broadcasted instead of per-pair norm)
+def spot_distance_matrix(spot_coords_ch1, spot_coords_ch2, voxel_size=(300, 130, 130)):
+    # NOTE: einsum gives the same (bitwise) result as np.linalg.norm on each single difference vector
+    diff = (spot_coords_ch1[:, np.newaxis, :] - spot_coords_ch2[np.newaxis, :, :]) * np.asarray(voxel_size)
+    return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+
+# matches spots of 2 channels via linear sum assignment, returns matched indices and distances
+# if max_distance is given, only spot pairs closer than it are considered: candidates are found via KD-tree
+# radius queries and the assignment is solved separately for each connected group of candidate pairs
+def match_spots(spot_coords_ch1, spot_coords_ch2, voxel_size=(300, 130, 130), max_distance=None):
+
+    voxel_size = np.asarray(voxel_size)
+
+    # nothing to match
+    if len(spot_coords_ch1) == 0 or len(spot_coords_ch2) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    # dense assignment over all pairs
+    if max_distance is None:
+        distances = spot_distance_matrix(spot_coords_ch1, spot_coords_ch2, voxel_size)
+        row_ind, col_ind = linear_sum_assignment(distances)
+        return row_ind, col_ind, distances[row_ind, col_ind]
+
+    # candidate pairs within max_distance (in scaled units)
+    tree1 = cKDTree(spot_coords_ch1 * voxel_size)
+    tree2 = cKDTree(spot_coords_ch2 * voxel_size)
+    candidates = tree1.sparse_distance_matrix(tree2, max_distance, output_type='coo_matrix')
+
+    if candidates.nnz == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    # connected groups in the bipartite candidate graph (ch1 spots first, then ch2 spots)
+    n1, n2 = len(spot_coords_ch1), len(spot_coords_ch2)
+    graph = coo_matrix((np.ones(candidates.nnz), (candidates.row, candidates.col + n1)), shape=(n1 + n2, n1 + n2))
+    _, component = connected_components(graph, directed=False)
+
+    rows, cols = [], []
+    for comp in np.unique(component[candidates.row]):
+        idx1 = np.flatnonzero(component[:n1] == comp)
+        idx2 = np.flatnonzero(component[n1:] == comp)
+
+        # pairs outside the gate get a prohibitive cost, so the assignment prefers more valid pairs
+        distances = spot_distance_matrix(spot_coords_ch1[idx1], spot_coords_ch2[idx2], voxel_size)
+        gated = distances > max_distance
+        distances[gated] = max_distance * (len(idx1) + len(idx2) + 1)
+
+        row_ind, col_ind = linear_sum_assignment(distances)
+        keep = ~gated[row_ind, col_ind]
+        rows.append(idx1[row_ind[keep]])
+        cols.append(idx2[col_ind[keep]])
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    # same ordering as dense assignment (sorted by ch1 index)
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+
+    diff = (spot_coords_ch1[rows] - spot_coords_ch2[cols]) * voxel_size
+    return rows, cols, np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+
+# matches spots of one image, used as process pool task in detect_spot_pairs
+def _match_spots_image(task):
+
+    img, spot_coords_ch1, spot_coords_ch2, voxel_size, max_distance = task
+    row_ind, col_ind, distances = match_spots(spot_coords_ch1, spot_coords_ch2, voxel_size, max_distance)
+
+    result = {'img': [img] * len(row_ind), 'distance_um': distances}
+    for dim_i, dim in enumerate('zyx'):
+        result[f'{dim}_1'] = spot_coords_ch1[row_ind, dim_i]
+        result[f'{dim}_2'] = spot_coords_ch2[col_ind, dim_i]
+
+    return pd.DataFrame(result)
+
+
 # tries to match spot pairs in 2 different channels and outputs pairwise distances
-def detect_spot_pairs(path, out, ch, voxel_size=(300, 130, 130)):
-    df = pd.read_csv(path)
+# max_distance: only match spots closer than this (same unit as voxel_size), None matches all spots
+# n_workers: number of processes to match images in parallel, None/1 to run sequentially
+def detect_spot_pairs(path, out, ch, voxel_size=(300, 130, 130), max_distance=None, n_workers=None):
+    df = read_spot_table(path)
     df['img'] = df['img'].apply(lambda x: x.rsplit('_', 1)[0])
     
-    result = defaultdict(list)
     voxel_size = np.array(voxel_size)
+    coord_cols = ['z', 'y', 'x']
     
-    # group the DataFrame by 'img' 
-    grouped = df.groupby(['img'])
-
-    for (img), group_df in grouped:
-        spot_coords_ch1 = group_df.loc[group_df['channel'] == ch[0], ['z', 'y', 'x']].values
-        spot_coords_ch2 = group_df.loc[group_df['channel'] == ch[1], ['z', 'y', 'x']].values
-        distances = np.zeros((len(spot_coords_ch1), len(spot_coords_ch2)))
-
-        for (i1,c1), (i2, c2) in product(enumerate(spot_coords_ch1), enumerate(spot_coords_ch2)):
-            distances[i1, i2] = np.linalg.norm((c1 - c2)*voxel_size) # np.sqrt(np.sum((c1 - c2)**2))
+    # split spots by image and channel once
+    tasks = []
+    for img, group_df in df.groupby('img'):
+        spot_coords_ch1 = group_df.loc[group_df['channel'] == ch[0], coord_cols].values
+        spot_coords_ch2 = group_df.loc[group_df['channel'] == ch[1], coord_cols].values
+        tasks.append((img, spot_coords_ch1, spot_coords_ch2, voxel_size, max_distance))
 
-        row_ind, col_ind = linear_sum_assignment(distances)
-        
-        for ri, ci in zip(row_ind, col_ind):
-            result['img'].append(img)
-            result['distance_um'].append(distances[ri,ci])
-            
-            for dim_i, dim in enumerate('zyx'):
-                result[f'{dim}_1'].append(spot_coords_ch1[ri][dim_i])
-                result[f'{dim}_2'].append(spot_coords_ch2[ci][dim_i])
+    # match all images (in parallel if requested, order is preserved)
+    if n_workers is None or n_workers <= 1:
+        results = [_match_spots_image(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_match_spots_image, tasks, chunksize=max(1, len(tasks) // (4 * n_workers))))
 
-    result_df = pd.DataFrame(result)
+    result_df = pd.concat(results, ignore_index=True) if len(results) > 0 else _match_spots_image(
+        ('', np.zeros((0, 3)), np.zeros((0, 3)), voxel_size, max_distance))
     
     # add acquisition info and reshape
     df = df.drop(columns=['c','t'])
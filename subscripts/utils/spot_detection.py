@@ -1,5 +1,5 @@
 # spot detection fully based on RS-FISH
-# requires fiji with RS-FISH installed to work
+# requires fiji with RS-FISH installed to work (or use the native backend, see radial_symmetry.py)
 
 import os
 import numpy as np
@@ -13,6 +13,11 @@ from glob import glob
 from natsort import natsorted
 import json
 from scipy.optimize import curve_fit
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.image_access import LazyStack, list_store_images, image_name, is_store_file, store_image_path
+from utils.radial_symmetry import detect_spots_array
+from utils.spot_store import read_spot_table, write_spots, update_spots
 
 # creates the output folder if it doesn't yet exist
 def create_folder(folder_path):
@@ -40,19 +45,20 @@ def read_parameters(settings_file_path):
     return(parameters)
                 
 
-# creates a fiji command for the RS-FISH, based on the parameters in the config file    
-def make_fiji_command(images_path,out_path,settings_file_path,macro_path,fiji_path,channel):
+# macro arguments for RS_macro_param.ijm (comma-separated string), based on the parameters in the config file
+# time_file: where the macro appends runtimes, defaults to statsDetectionTime.txt in out_path
+def make_macro_arguments(images_path,out_path,settings_file_path,channel,time_file=None):
     
     parameters = read_parameters(settings_file_path)
+
+    if time_file is None:
+        time_file = f"{out_path}/statsDetectionTime.txt"
     
-    # Construct the Fiji command with the extracted parameters
-    fiji_command = (
-        f"{fiji_path} --headless -macro "
-        f"{macro_path} \""
+    macro_arguments = (
         f"{images_path},"
         f"{out_path},"
 #        f"{images_path.rsplit('/', 2)[0]}/detections/statsDetectionTime.txt,"
-        f"{out_path}/statsDetectionTime.txt,"
+        f"{time_file},"
         f"{parameters['anisotropyCoefficient']},"
         f"{parameters['RANSAC']},"
         f"{parameters['min intensity']},"
@@ -66,45 +72,182 @@ def make_fiji_command(images_path,out_path,settings_file_path,macro_path,fiji_pa
         f"{parameters['bsMethod']},"
         f"{parameters['bsMaxError']},"
         f"{parameters['bsInlierRatio']},"
-        f"{channel}\""
+        f"{channel}"
+    )
+    
+    return(macro_arguments)
+
+
+# creates a fiji command for the RS-FISH, based on the parameters in the config file    
+def make_fiji_command(images_path,out_path,settings_file_path,macro_path,fiji_path,channel):
+    
+    # Construct the Fiji command with the extracted parameters
+    fiji_command = (
+        f"{fiji_path} --headless -macro "
+        f"{macro_path} \""
+        f"{make_macro_arguments(images_path,out_path,settings_file_path,channel)}\""
     )
     
     return(fiji_command)
     
 
+# name of the RS-FISH result table for an image, as written by RS_macro_param.ijm (parsed again in combine_csv)
+def rs_results_file_name(img_name, parameters):
+
+    return (
+        f"RadialSymmetry_results_{img_name}"
+        f"_aniso{parameters['anisotropyCoefficient']}"
+        f"ransac{parameters['RANSAC'].split(' ')[0]}"
+        f"imMin{parameters['min intensity']}"
+        f"imMax{parameters['max intensity']}"
+        f"sig{parameters['SigmaDoG']}"
+        f"thr{parameters['ThresholdDoG']}"
+        f"suppReg{parameters['supportRadius']}"
+        f"inRat{parameters['InlierRatio']}"
+        f"maxErr{parameters['MaxError']}"
+        f"intensThr{parameters['intensityThreshold']}"
+        f"bsMethod{parameters['bsMethod'].split(' ')[0]}"
+        f"bsMaxErr{parameters['bsMaxError']}"
+        f"bsInRat{parameters['bsInlierRatio']}"
+        ".csv"
+    )
+
+
+# detect spots in all images of a channel in-process (no Fiji), see radial_symmetry.py
+# writes one RS-FISH style result table per image into out_path
+# images_path: folder of TIFFs or an image store file (see image_store.py)
+def detect_spots_native(images_path, out_path, settings_file_path, channel, block_size=(16, 128, 128), n_workers=None):
+
+    parameters = read_parameters(settings_file_path)
+
+    # same image selection as the Fiji macro (recursive, ending with _ch<channel>.tif), or store images <name>_ch<channel>
+    if is_store_file(images_path):
+        imgs = [img for img in list_store_images(images_path) if img.endswith(f"_ch{channel}")]
+    else:
+        imgs = natsorted(glob(f"{images_path}/**/*_ch{channel}.tif", recursive=True))
+
+    for img_path in imgs:
+        if is_store_file(images_path):
+            with LazyStack(img_path) as stack:
+                img = stack[:]
+            img_name = image_name(img_path)
+        else:
+            img = imread(img_path)
+            img_name = os.path.basename(img_path)
+        spots = detect_spots_array(img, parameters, block_size=block_size, n_workers=n_workers)
+        spots.to_csv(f"{out_path}/{rs_results_file_name(img_name, parameters)}", index=False)
+
+
 # detect all spots in a imaged using RS-FISH, based on a sepcified detection config for each channel    
+# backend: "fiji" (run RS-FISH in headless Fiji) or "native" (in-process detection, no Fiji needed)
+# fiji: channels are run as jobs of detection_scheduler.run_detection_jobs (n_workers concurrent Fiji processes, default 1),
+# a run manifest is written to <out_subfolder>/detection_manifest.json and failed channels raise a RuntimeError
+# native: n_workers / block_size: blocks of the image are processed in parallel
+# tif_subfolder can also be an image store file (e.g. "images.h5", see image_store.py), only with the native backend
 def detect_spots(images_path, detection_settings, channels,
                  tif_subfolder = "tif",
                  out_subfolder = "detections/",
                  macro_path = "/home/stumberger/fish-pipelines/fish_utils/RS_macro_param.ijm",
-                 fiji_path = "/home/stumberger/tools/Fiji.app/ImageJ-linux64"):
+                 fiji_path = "/home/stumberger/tools/Fiji.app/ImageJ-linux64",
+                 backend = "fiji",
+                 n_workers = None,
+                 block_size = (16, 128, 128)):
     
     # tif path
+    folder = images_path
     out_path = f"{images_path}/{out_subfolder}/"
-    images_path = f"{images_path}/{tif_subfolder}/"
+    images_path = f"{images_path}/{tif_subfolder}" if is_store_file(tif_subfolder) else f"{images_path}/{tif_subfolder}/"
     
     create_folder(out_path)
     
+    if backend not in ("fiji", "native"):
+        raise ValueError(f"Unknown detection backend '{backend}', use 'fiji' or 'native'.")
+    if backend == "fiji" and is_store_file(images_path):
+        raise ValueError("The Fiji backend can only read TIFFs, use the native backend for an image store.")
     
+    if backend == "fiji":
+        # imported here, detection_scheduler imports this module
+        from utils.detection_scheduler import make_detection_jobs, run_detection_jobs
+
+        jobs = make_detection_jobs([folder], detection_settings, channels)
+        manifest = run_detection_jobs(jobs, macro_path, fiji_path, tif_subfolder=tif_subfolder, out_subfolder=out_subfolder,
+                                      n_workers=n_workers or 1, retries=0,
+                                      manifest_path=f"{out_path}/detection_manifest.json")
+
+        failed = [record["channel"] for record in manifest["jobs"] if not record["success"]]
+        if len(failed) > 0:
+            raise RuntimeError(f"RS-FISH detection failed for channel(s) {failed}, see {out_path}/detection_manifest.json")
+        return
+
     # process all channels
     for channel,settings_file in zip(channels,detection_settings):
-    
-        # read all parameters and pass them to fiji command
-        fiji_command = make_fiji_command(images_path,out_path,settings_file,macro_path,fiji_path,channel)
-
-        print(fiji_command)
-        os.system(fiji_command)
+        detect_spots_native(images_path, out_path, settings_file, channel, block_size=block_size, n_workers=n_workers)
         
 
+# (dy, dx) offsets of the pixels of a circle outline (ring) of given radius and thickness
+def ring_offsets(radius, thickness=1):
+    r = int(np.ceil(radius + thickness))
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    distance = np.sqrt(dy**2 + dx**2)
+    ring = (distance <= radius + thickness / 2) & (distance > radius - thickness / 2)
+    return np.stack([dy[ring], dx[ring]], axis=1)
+
+
+# draw rings around all spots (centers: (n, 2) yx) into an RGB image (in place), all spots at once
+def draw_rings(rgb, centers, offsets, color=(255, 0, 0)):
+
+    pixels = np.round(centers).astype(int)[:, np.newaxis, :] + offsets[np.newaxis]
+    pixels = pixels.reshape(-1, 2)
+    inside = np.all((pixels >= 0) & (pixels < rgb.shape[:2]), axis=1)
+    pixels = pixels[inside]
+
+    rgb[pixels[:, 0], pixels[:, 1]] = color
+    return rgb
+
+
+# side by side RGB image: normalized max projection without and with spots (xy coordinates)
+def render_detections(img_norm, spots_xy, radius=7, thickness=1, color=(255, 0, 0), gap=10):
+
+    gray = np.repeat(img_norm[..., np.newaxis], 3, axis=2)
+    overlay = draw_rings(gray.copy(), spots_xy[:, ::-1], ring_offsets(radius, thickness), color)
+    spacer = np.full((img_norm.shape[0], gap, 3), 255, dtype=np.uint8)
+
+    return np.concatenate([gray, spacer, overlay], axis=1)
+
+
+# normalized (8-bit) max projection of an image
+def _max_projection_8bit(img, range_quantiles):
+    with LazyStack(img) as stack:
+        img1 = stack.max_projection()
+    intensity_range = tuple(np.quantile(img1, range_quantiles))
+    return rescale_intensity(img1, in_range=intensity_range, out_range='uint8').astype(np.uint8)
+
+
+# render and save the detections of one image, used as process pool task in plot_detections
+def _render_detections_file(task):
+
+    img, spots_xy, out_file, range_quantiles, radius = task
+    rendered = render_detections(_max_projection_8bit(img, range_quantiles), spots_xy, radius=radius)
+    imageio.imwrite(out_file, rendered)
+
+
 # plots the spot detection on images, to check if the detection works    
-def plot_detections(path, channel, path_spots=None, tif_subfolder="tif", out_folder=None, range_quantiles = (0.02, 0.9999)):
+# store_path: read images from a image store (see image_store.py) instead of the tif subfolder,
+# spots are then matched to images by image name
+# renderer: "matplotlib" (figure with circle patches) or "numpy" (rings drawn directly into the image, much faster),
+# n_workers: number of processes to render images in parallel with the numpy renderer
+def plot_detections(path, channel, path_spots=None, tif_subfolder="tif", out_folder=None, range_quantiles = (0.02, 0.9999),
+                    store_path=None, renderer="matplotlib", radius=7, n_workers=None):
+
+    if renderer not in ("matplotlib", "numpy"):
+        raise ValueError(f"Unknown renderer '{renderer}', use 'matplotlib' or 'numpy'.")
     
     # either the path to the upper folder containing the "detections" folder with merge.csv or the direct path to the merge.csv
+    # (or a spot store, see spot_store.py), only the spots of the channels to plot are read
     try:
         if path_spots is None:
-            spots = pd.read_csv(f"{path}/{out_folder}/merge.csv")
-        else:
-            spots = pd.read_csv(path_spots)
+            path_spots = f"{path}/{out_folder}/merge.csv"
+        spots = read_spot_table(path_spots, columns=['img', 'x', 'y', 'intensity'], channels=channel)
     except FileNotFoundError:
         raise ValueError("Please provide a valid .csv file with spot information.")
         
@@ -116,95 +259,203 @@ def plot_detections(path, channel, path_spots=None, tif_subfolder="tif", out_fol
     create_folder(out)
     
     # get list of images
-    tifs = glob(f"{path}/{tif_subfolder}/*.tif")
-    tifs = [os.path.normpath(filepath) for filepath in tifs] # remove double //
-    tifs = natsorted(tifs)
-    
-    # filter list for channels to visualise
-    ch = ["_ch" + str(num) + "." for num in channel]
-    tifs = [path for path in tifs if any(item in path for item in ch)]
+    if store_path is None:
+        tifs = glob(f"{path}/{tif_subfolder}/*.tif")
+        tifs = [os.path.normpath(filepath) for filepath in tifs] # remove double //
+        tifs = natsorted(tifs)
+    
+        # filter list for channels to visualise
+        ch = ["_ch" + str(num) + "." for num in channel]
+        tifs = [path for path in tifs if any(item in path for item in ch)]
+    else:
+        tifs = [img for img in list_store_images(store_path) if any(img.endswith(f"_ch{num}") for num in channel)]
+
+    # split spots by image once (by image path, or by image name for store images)
+    spot_keys = spots['img'] if store_path is None else spots['img'].map(image_name)
+    spots_by_image = {key: group for key, group in spots.groupby(spot_keys, sort=False)}
+    no_spots = spots.iloc[:0]
+
+    def _out_file(img):
+        return f"{out}/{os.path.basename(img) if store_path is None else image_name(img)}.png"
+
+    if renderer == "numpy":
+        tasks = [(img, spots_by_image.get(img if store_path is None else image_name(img), no_spots)[['x', 'y']].values,
+                  _out_file(img), range_quantiles, radius) for img in tifs]
+        if n_workers is None or n_workers <= 1:
+            for task in tasks:
+                _render_detections_file(task)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(_render_detections_file, tasks))
+        return
     
     # iterate over all images in path
     for img in tifs:
-        current_spots = spots[spots['img'] == img] # get all spots for image
+        current_spots = spots_by_image.get(img if store_path is None else image_name(img), no_spots) # get all spots for image
         
-        img1 = imread(img).max(axis=0)
-        intensity_range = tuple(np.quantile(img1, range_quantiles))
-        img_norm = rescale_intensity(img1, in_range=intensity_range, out_range='uint8').astype(np.uint8)
+        img_norm = _max_projection_8bit(img, range_quantiles)
 
         fig, axes = plt.subplots(1, 2, figsize=(10, 5))
 
         # plot side by side
-        fig.suptitle(os.path.basename(img).rsplit(".", 1)[0])
+        fig.suptitle(image_name(img))
         plt.subplots_adjust(top=1)
         axes[0].imshow(img_norm)
         axes[1].imshow(img_norm)
 
-        for _, row in current_spots.iterrows():
-            x, y, intensity = row['x'], row['y'], row['intensity']
-            c = plt.Circle((x,y),7, edgecolor='r', facecolor = 'None')
+        for x, y in current_spots[['x', 'y']].values:
+            c = plt.Circle((x,y),radius, edgecolor='r', facecolor = 'None')
             axes[1].add_patch(c)
             
         # save image
-        fig.savefig(f"{out}/{os.path.basename(img)}.png",dpi=300)
+        fig.savefig(_out_file(img),dpi=300)
         
         plt.close(fig)
 
+# image path and channel of a RS-FISH result table from its file name (see rs_results_file_name)
+# tif_subfolder can be an image store file, the image is then a store image reference
+def parse_results_file_name(file_name, path, tif_subfolder):
+
+    name = os.path.basename(file_name)
+    if '_results_' not in name or '_aniso' not in name:
+        raise ValueError("file name does not match RadialSymmetry_results_<image>_aniso...")
+
+    img_name = name.split('_results_', 1)[1].split('_aniso', 1)[0]
+    if is_store_file(tif_subfolder):
+        img = store_image_path(os.path.normpath(f"{path}/{tif_subfolder}"), img_name)
+    else:
+        img = os.path.normpath(f"{path}/{tif_subfolder}/{img_name}")
+
+    # channel number from the image name (<name>_ch<channel>.tif)
+    try:
+        channel = int(img_name.rsplit('_ch', 1)[1].split('.tif', 1)[0])
+    except (IndexError, ValueError):
+        raise ValueError(f"no channel in image name {img_name}")
+
+    return img, channel
+
+
+# read one RS-FISH result table and add image and channel columns
+def read_results_file(file_name, path, tif_subfolder):
+
+    img, channel = parse_results_file_name(file_name, path, tif_subfolder)
+    df = pd.read_csv(file_name)
+
+    df.insert(0, 'img', img)
+    df.insert(1, 'channel', channel)
+
+    return df
+
+
+# size and modification time of a file, to detect changed result tables
+def _file_state(file_name):
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# spots of all unchanged result tables of a previous combine_csv run (file -> DataFrame), from merge.csv and its manifest
+# and the manifest entries of the previous run (both empty if there is no previous run or merge.csv does not match the manifest)
+def _previous_merge_blocks(merge_file, manifest_file, current_states):
+
+    if not (os.path.exists(merge_file) and os.path.exists(manifest_file)):
+        return {}, []
+
+    with open(manifest_file) as fd:
+        manifest = json.load(fd)
+
+    # only the combined columns (merge.csv can have additional columns, e.g. from add_sample_info)
+    try:
+        merged = pd.read_csv(merge_file, usecols=manifest['columns'])
+    except ValueError:
+        return {}, []
+    if len(merged) != sum(entry['n_rows'] for entry in manifest['files']):
+        return {}, []
+
+    # rows of merge.csv are the result tables in manifest order
+    blocks = {}
+    offsets = np.cumsum([0] + [entry['n_rows'] for entry in manifest['files']])
+    for entry, start, end in zip(manifest['files'], offsets[:-1], offsets[1:]):
+        state = current_states.get(entry['file'])
+        if state is not None and state['size'] == entry['size'] and state['mtime_ns'] == entry['mtime_ns']:
+            blocks[entry['file']] = merged.iloc[start:end]
+
+    return blocks, manifest['files']
+
+
 # combines all spot csvs from all images
-def combine_csv(path,tif_subfolder,out_subpath):
+# a manifest of the combined result tables (size, modification time, number of spots) is written next to merge.csv
+# incremental: only read new or changed result tables, spots of unchanged tables are taken from the previous merge.csv
+# (the result is the same as combining all tables again)
+# result tables that can not be read are skipped and reported
+# store_file: additionally write the combined spots to a spot store (see spot_store.py)
+def combine_csv(path,tif_subfolder,out_subpath,store_file=None,incremental=False):
 
     folder_path = f"{path}/{out_subpath}/"
+    merge_file = f"{folder_path}/merge.csv"
+    manifest_file = f"{folder_path}/merge_manifest.json"
+
+    # skip merge files to prevent self-merging
     files = glob(f"{folder_path}*.csv")
-    files = natsorted(files)
+    files = natsorted(file_name for file_name in files if "merge" not in os.path.basename(file_name))
+    states = {file_name: _file_state(file_name) for file_name in files}
+
+    previous_blocks, previous_entries = _previous_merge_blocks(merge_file, manifest_file, states) if incremental else ({}, [])
 
     dataframes = []
+    entries = []
+    skipped = []
+    affected_groups = set()
 
     for file_name in files:
-        
-        try:
-            
-            # skip merge files to prevent self-merging
-            if "merge" in file_name:
-                continue
-            
-            df = pd.read_csv(file_name)
 
-            # Extract the image name from the file name
-            img = os.path.normpath(f"{path}/{tif_subfolder}/{file_name.split('_results_', 1)[1].split('_aniso', 1)[0]}")
+        try:
+            img, channel = parse_results_file_name(file_name, path, tif_subfolder)
+            if file_name in previous_blocks:
+                df = previous_blocks[file_name]
+            else:
+                df = read_results_file(file_name, path, tif_subfolder)
+                affected_groups.add((img, channel))
+        except (ValueError, pd.errors.EmptyDataError, pd.errors.ParserError) as e:
+            skipped.append({'file': file_name, 'reason': str(e) or type(e).__name__})
+            continue
 
-            # Extract the channel number from the file name
-            channel = int(file_name.split('_ch', 1)[1].split('.tif', 1)[0])
+        dataframes.append(df)
+        entries.append(dict(file=file_name, img=img, channel=channel, n_rows=len(df), **states[file_name]))
 
-            # Add the 'img name' and 'channel' columns to the DataFrame
-            df.insert(0, 'img', img)
-            df.insert(1, 'channel', channel)
+    # groups of result tables that were removed since the last run
+    for entry in previous_entries:
+        if entry['file'] not in previous_blocks:
+            affected_groups.add((entry['img'], entry['channel']))
 
-            dataframes.append(df)
+    for entry in skipped:
+        print(f"skipped {entry['file']}: {entry['reason']}")
 
-        # exception for empty datafarmes
-        except: 
-                pass
+    if len(dataframes) == 0:
+        raise ValueError(f"No spot tables to combine in {folder_path}.")
 
     # Merge all DataFrames into a single DataFrame and save
     merged_df = pd.concat(dataframes, ignore_index=True)
     
-    # add spot number
-    merged_df['spot_idx'] = merged_df.groupby(['img', 'channel']).cumcount() + 1
-    merged_df.to_csv(f"{folder_path}/merge.csv", index=False)
+    # add spot number (only recomputed for images with new / changed / removed tables)
+    if len(previous_blocks) == 0:
+        merged_df['spot_idx'] = merged_df.groupby(['img', 'channel']).cumcount() + 1
+    else:
+        affected = pd.MultiIndex.from_frame(merged_df[['img', 'channel']]).isin(list(affected_groups))
+        merged_df.loc[affected, 'spot_idx'] = merged_df[affected].groupby(['img', 'channel']).cumcount() + 1
+        merged_df['spot_idx'] = merged_df['spot_idx'].astype(int)
+
+    merged_df.to_csv(merge_file, index=False)
+    if store_file is not None:
+        write_spots(store_file, merged_df)
+
+    with open(manifest_file, 'w') as fd:
+        json.dump({'columns': list(merged_df.columns), 'files': entries, 'skipped': skipped}, fd, indent=1)
 
     return(merged_df)    
         
         
-# add acquisition info to spots
-def add_sample_info(path,out_subfolder="detections",info=None):
-    
-    spots = pd.read_csv(f"{path}/{out_subfolder}/merge.csv")
-    
-    # get metadata
-    if info == None:
-        info = f"{path}/acquisition_info.json"
-    else:
-        pass
+# acquisition info (json) as table with one row per channel
+def load_sample_info(info):
     
     with open(info, 'r') as file:
         metadata = json.load(file)
@@ -220,9 +471,28 @@ def add_sample_info(path,out_subfolder="detections",info=None):
     # unfiy channel names in acquisition info and the spots df
     channel_mapping = dict(zip(channels, list(range(0,len(channels)))))
     metadata['acquisition.channels'] = metadata['acquisition.channels'].map(channel_mapping)
+
+    return metadata
+
+
+# add acquisition info to spots
+# store_file: update the spots in a spot store (see spot_store.py) instead of rewriting merge.csv
+def add_sample_info(path,out_subfolder="detections",info=None,store_file=None):
+    
+    # get metadata
+    if info == None:
+        info = f"{path}/acquisition_info.json"
+    else:
+        pass
     
+    metadata = load_sample_info(info)
     
     # combine metadata with spots
+    if store_file is not None:
+        update_spots(store_file, lambda spots: spots.merge(metadata, right_on="acquisition.channels", left_on="channel", how='left'))
+        return
+
+    spots = pd.read_csv(f"{path}/{out_subfolder}/merge.csv")
     df = spots.merge(metadata, right_on="acquisition.channels", left_on="channel", how='left')
     
     df.to_csv(f"{path}/{out_subfolder}/merge.csv", index=False)
@@ -236,72 +506,268 @@ def gaussian_3d(coords, x0, y0, z0, sigma_x, sigma_y, sigma_z, A, B):
         + ((z - z0)**2) / (2 * sigma_z**2))
     ) + B).ravel()
 
-def refine_subpixel(in_path, in_file,out_path,roi_radius = 5):
-    # --- Load data ---
-    spots_df_all = pd.read_csv(f'{in_path}/{in_file}')  # Columns: x, y, z
-    
+# analytic Jacobian of gaussian_3d for a batch of parameter sets
+# params: (n, 8) in the order of gaussian_3d, x, y, z: (m,) flat coordinates shared by all fits
+# returns model values (n, m) and Jacobian (n, m, 8)
+def gaussian_3d_jacobian(params, x, y, z):
+    x0, y0, z0, sigma_x, sigma_y, sigma_z, A, B = (params[:, i:i+1] for i in range(8))
+
+    dx, dy, dz = x - x0, y - y0, z - z0
+    g = np.exp(-(dx**2 / (2 * sigma_x**2) + dy**2 / (2 * sigma_y**2) + dz**2 / (2 * sigma_z**2)))
+    Ag = A * g
+
+    jac = np.stack([
+        Ag * dx / sigma_x**2,
+        Ag * dy / sigma_y**2,
+        Ag * dz / sigma_z**2,
+        Ag * dx**2 / sigma_x**3,
+        Ag * dy**2 / sigma_y**3,
+        Ag * dz**2 / sigma_z**3,
+        g,
+        np.ones_like(g)
+    ], axis=-1)
+
+    return Ag + B, jac
+
+
+# fits gaussian_3d to a stack of equally sized ROIs at once using a vectorized Levenberg-Marquardt
+# rois: (n, z, y, x), p0: (n, 8) initial guesses in ROI-local pixel coordinates
+# returns fitted parameters (n, 8) and a boolean array of which fits converged
+def fit_gaussian_3d_batch(rois, p0, max_iter=200, ftol=1e-8, xtol=1e-8):
+
+    n = len(rois)
+    z, y, x = (c.ravel().astype(float) for c in np.mgrid[tuple(slice(0, s) for s in rois.shape[1:])])
+    data = rois.reshape(n, -1).astype(float)
+
+    params = np.array(p0, dtype=float)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    failed = np.zeros(n, dtype=bool)
+
+    model, _ = gaussian_3d_jacobian(params, x, y, z)
+    cost = np.sum((model - data)**2, axis=1)
+
+    for _ in range(max_iter):
+
+        # only iterate fits that are still running
+        active = np.flatnonzero(~(converged | failed))
+        if len(active) == 0:
+            break
+
+        p = params[active]
+        model, jac = gaussian_3d_jacobian(p, x, y, z)
+        residuals = model - data[active]
+
+        # damped normal equations (Marquardt scaling by the diagonal)
+        jtj = np.einsum('nmi,nmj->nij', jac, jac)
+        jtr = np.einsum('nmi,nm->ni', jac, residuals)
+        diag = np.einsum('nii->ni', jtj)
+        lhs = jtj + (damping[active, np.newaxis] * np.maximum(diag, 1e-12))[:, :, np.newaxis] * np.eye(8)
+
+        with np.errstate(all='ignore'):
+            try:
+                step = np.linalg.solve(lhs, -jtr[:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.stack([np.linalg.lstsq(l, -r, rcond=None)[0] for l, r in zip(lhs, jtr)])
+
+            p_new = p + step
+            model_new, _ = gaussian_3d_jacobian(p_new, x, y, z)
+            cost_new = np.sum((model_new - data[active])**2, axis=1)
+
+        # diverged / degenerate fits
+        not_finite = ~(np.isfinite(cost_new) & np.all(np.isfinite(step), axis=1))
+        failed[active[not_finite]] = True
+
+        # accept improving steps, adjust damping
+        improved = (cost_new <= cost[active]) & ~not_finite
+        accepted = active[improved]
+        params[accepted] = p_new[improved]
+        damping[accepted] /= 10
+        damping[active[~improved]] *= 10
+
+        # convergence: small relative change in cost or parameters
+        small_cost_change = (cost[active] - cost_new) <= ftol * cost[active]
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(p) + xtol), axis=1)
+        converged[active[improved & (small_cost_change | small_step)]] = True
+        cost[accepted] = cost_new[improved]
+
+        # damping grew without finding a better step -> stuck at minimum
+        converged[active[~improved & ~not_finite & (damping[active] > 1e10)]] = True
+
+    return params, converged & ~failed
+
+
+# integer ROI centers of spots and whether the full ROI is inside the image
+def _roi_centers(spots_df, shape, roi_radius):
+    centers = np.rint(spots_df[['z', 'y', 'x']].values).astype(int)
+    valid = np.all((centers - roi_radius >= 0) & (centers + roi_radius + 1 <= np.array(shape[:3])), axis=1)
+    return centers, valid
+
+
+# refines all spots of one image with one curve_fit call per spot
+def _refine_image_curve_fit(image, spots_df, roi_radius):
+
     refined_coords = []
+    fit_status = pd.Series('ok', index=spots_df.index)
+
+    # --- Loop through spots ---
+    for idx, row in spots_df.iterrows():
+        
+        x0, y0, z0 = row['x'], row['y'], row['z']
+        x0i, y0i, z0i = int(round(x0)), int(round(y0)), int(round(z0))
+    
+        # Crop ROI
+        zmin, zmax = z0i - roi_radius, z0i + roi_radius + 1
+        ymin, ymax = y0i - roi_radius, y0i + roi_radius + 1
+        xmin, xmax = x0i - roi_radius, x0i + roi_radius + 1
+    
+        if (zmin < 0 or ymin < 0 or xmin < 0 or 
+            zmax > image.shape[0] or ymax > image.shape[1] or xmax > image.shape[2]):
+            fit_status[idx] = 'boundary'
+            continue  # Skip boundary cases
+    
+        roi = image[zmin:zmax, ymin:ymax, xmin:xmax]
+    
+        # Generate coordinate grid
+        z_range, y_range, x_range = np.mgrid[
+            zmin:zmax,
+            ymin:ymax,
+            xmin:xmax
+        ]
+        
+        # Flatten for curve fitting
+        coords = (x_range, y_range, z_range)
+        roi_flat = roi.ravel()
     
-    for img_path in spots_df_all['img'].unique():
-    
-        # Read image
-        image = imread(img_path)
-    
-        # Subset df
-        spots_df = spots_df_all[spots_df_all['img'] == img_path]
+        # Initial guess
+        guess = (x0, y0, z0, 1.0, 1.0, 1.5, np.max(roi), np.min(roi))
     
-        # --- Loop through spots ---
-        for idx, row in spots_df.iterrows():
+        try:
+            # gaussian fit
+            popt, _ = curve_fit(gaussian_3d, coords, roi_flat, p0=guess)
             
-            x0, y0, z0 = row['x'], row['y'], row['z']
-            x0i, y0i, z0i = int(round(x0)), int(round(y0)), int(round(z0))
-        
-            # Crop ROI
-            zmin, zmax = z0i - roi_radius, z0i + roi_radius + 1
-            ymin, ymax = y0i - roi_radius, y0i + roi_radius + 1
-            xmin, xmax = x0i - roi_radius, x0i + roi_radius + 1
-        
-            if (zmin < 0 or ymin < 0 or xmin < 0 or 
-                zmax > image.shape[0] or ymax > image.shape[1] or xmax > image.shape[2]):
-                continue  # Skip boundary cases
-        
-            roi = image[zmin:zmax, ymin:ymax, xmin:xmax]
-        
-            # Generate coordinate grid
-            z_range, y_range, x_range = np.mgrid[
-                zmin:zmax,
-                ymin:ymax,
-                xmin:xmax
-            ]
+            # Copy full original row and update it
+            refined_row = row.copy()
+            refined_row['x'] = popt[0]
+            refined_row['y'] = popt[1]
+            refined_row['z'] = popt[2]
+            refined_row['sigma_x'] = popt[3]
+            refined_row['sigma_y'] = popt[4]
+            refined_row['sigma_z'] = popt[5]
+            refined_row['amplitude'] = popt[6]
+            refined_row['background'] = popt[7]
+
+            refined_coords.append(refined_row)
             
-            # Flatten for curve fitting
-            coords = (x_range, y_range, z_range)
-            roi_flat = roi.ravel()
-        
-            # Initial guess
-            guess = (x0, y0, z0, 1.0, 1.0, 1.5, np.max(roi), np.min(roi))
-        
-            try:
-                # gaussian fit
-                popt, _ = curve_fit(gaussian_3d, coords, roi_flat, p0=guess)
-                
-                # Copy full original row and update it
-                refined_row = row.copy()
-                refined_row['x'] = popt[0]
-                refined_row['y'] = popt[1]
-                refined_row['z'] = popt[2]
-                refined_row['sigma_x'] = popt[3]
-                refined_row['sigma_y'] = popt[4]
-                refined_row['sigma_z'] = popt[5]
-                refined_row['amplitude'] = popt[6]
-                refined_row['background'] = popt[7]
-    
-                refined_coords.append(refined_row)
-                
-            except RuntimeError:
-                continue  # Fit failed
-    
+        except RuntimeError:
+            fit_status[idx] = 'failed'
+            continue  # Fit failed
+
+    return pd.DataFrame(refined_coords), fit_status
+
+
+# number of spots fitted at once by the batch method (bounds the memory of the ROI stack and Jacobian)
+BATCH_FIT_CHUNK_SIZE = 1024
+
+
+# refines all spots of one image with fit_gaussian_3d_batch, in chunks of chunk_size spots
+# spots are processed sorted by z, so consecutive chunks re-use cached planes
+def _refine_image_batch(image, spots_df, roi_radius, chunk_size=BATCH_FIT_CHUNK_SIZE):
+
+    fit_status = pd.Series('ok', index=spots_df.index)
+    centers, valid = _roi_centers(spots_df, image.shape, roi_radius)
+    fit_status[~valid] = 'boundary'
+
+    spots_valid = spots_df[valid]
+    if len(spots_valid) == 0:
+        return spots_valid.iloc[:0], fit_status
+    centers = centers[valid]
+    origin = centers - roi_radius
+    spots_xyz = spots_valid[['x', 'y', 'z']].values
+
+    params = np.empty((len(centers), 8))
+    converged = np.zeros(len(centers), dtype=bool)
+
+    order = np.argsort(centers[:, 0], kind='stable')
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start+chunk_size]
+
+        # stack the ROIs of the chunk into one (n, z, y, x) array
+        rois = image.rois(centers[chunk], roi_radius)
+
+        # initial guess (same as per-spot fit), in ROI-local coordinates
+        rois_flat = rois.reshape(len(rois), -1)
+        p0 = np.column_stack([
+            spots_xyz[chunk] - origin[chunk, ::-1],
+            np.full(len(rois), 1.0),
+            np.full(len(rois), 1.0),
+            np.full(len(rois), 1.5),
+            rois_flat.max(axis=1),
+            rois_flat.min(axis=1)
+        ])
+
+        params[chunk], converged[chunk] = fit_gaussian_3d_batch(rois, p0)
+
+    # back to image coordinates
+    params[:, 0] += origin[:, 2]
+    params[:, 1] += origin[:, 1]
+    params[:, 2] += origin[:, 0]
+
+    fit_status[spots_valid.index[~converged]] = 'not_converged'
+
+    refined_df = spots_valid[converged].copy()
+    for i, col in enumerate(['x', 'y', 'z', 'sigma_x', 'sigma_y', 'sigma_z', 'amplitude', 'background']):
+        refined_df[col] = params[converged, i]
+
+    return refined_df, fit_status
+
+
+# refines all spots of one image, used as process pool task in refine_subpixel
+def _refine_image(task):
+
+    img_path, spots_df, roi_radius, method = task
+
+    # open image lazily, only planes around spots are read
+    with LazyStack(img_path) as image:
+        if method == "batch":
+            refined_df, fit_status = _refine_image_batch(image, spots_df, roi_radius)
+        else:
+            refined_df, fit_status = _refine_image_curve_fit(image, spots_df, roi_radius)
+
+    # spots that could not be refined, with reason
+    failed_df = spots_df[fit_status != 'ok'].copy()
+    failed_df['fit_status'] = fit_status[fit_status != 'ok']
+
+    return refined_df, failed_df
+
+
+# method: "curve_fit" (one fit per spot) or "batch" (vectorized fit of all spots of an image at once)
+# n_workers: number of processes to refine images in parallel, None/1 to run sequentially
+# spots that could not be refined are saved with their reason (boundary / failed / not_converged) to *_failed.csv
+def refine_subpixel(in_path, in_file, out_path, roi_radius = 5, method = "curve_fit", n_workers = None):
+    # --- Load data ---
+    spots_df_all = pd.read_csv(f'{in_path}/{in_file}')  # Columns: x, y, z
     
-    # add new spots to dataframe
-    refined_df = pd.DataFrame(refined_coords)
+    if method not in ("curve_fit", "batch"):
+        raise ValueError(f"Unknown fitting method '{method}', use 'curve_fit' or 'batch'.")
+
+    # Subset df per image
+    tasks = [(img_path, spots_df, roi_radius, method) for img_path, spots_df in spots_df_all.groupby('img', sort=False)]
+
+    if n_workers is None or n_workers <= 1:
+        results = [_refine_image(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_refine_image, tasks))
+
+    # add new spots to dataframe (empty table with the input columns if there are no spots)
+    refined_df = pd.concat([refined for refined, _ in results]) if len(results) > 0 else spots_df_all.iloc[:0]
     refined_df.to_csv(f"{in_path}/{out_path}", index=False)
+
+    # report spots that were dropped
+    failed_df = pd.concat([failed for _, failed in results]) if len(results) > 0 else spots_df_all.iloc[:0]
+    if len(failed_df) > 0:
+        failed_file = f"{in_path}/{os.path.splitext(out_path)[0]}_failed.csv"
+        failed_df.to_csv(failed_file, index=False)
+        print(f"{len(failed_df)} of {len(spots_df_all)} spots could not be refined "
+              f"({failed_df['fit_status'].value_counts().to_dict()}), saved to {failed_file}")
@@ -0,0 +1,379 @@
+# columnar spot table store (HDF5), replaces repeatedly parsing / rewriting merge.csv
+# spots are partitioned by image and channel: one group per partition (<image name>_<hash of img>/ch<channel>, the
+# full img value is stored as attribute) containing one typed, chunked, compressed dataset per column
+# -> stages can read only the images, channels and columns they need
+#
+# partitions keep the order in which they were written, so reading everything gives the same row order as merge.csv
+# (which is ordered by image and channel)
+# min / max of numeric columns are stored per partition, so filters can skip whole partitions without reading them
+
+import os
+import json
+import hashlib
+import operator
+
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+from utils.image_access import image_name
+
+
+# comparison operators that can be used in filters: (column, op, value)
+FILTER_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda values, allowed: np.isin(values, list(allowed)),
+}
+
+
+# whether a file is a spot store (by extension), everything else is handled as csv
+def is_spot_store(path):
+    return str(path).lower().endswith(('.h5', '.hdf5'))
+
+
+# group name of the partition of spots in image img and channel
+# keyed by the full img value (hash), so images with the same file name in different folders get separate partitions
+def partition_name(img, channel):
+    img_hash = hashlib.sha1(str(img).encode()).hexdigest()[:16]
+    return f"{image_name(img)}_{img_hash}/ch{channel}"
+
+
+# string columns are dictionary encoded: int32 codes (-1: missing) + list of categories (in group _categories)
+def _encode_strings(group, column, values):
+
+    categories_group = group.require_group('_categories')
+    categories = list(categories_group[column].asstr()[()]) if column in categories_group else []
+
+    strings = values.astype(object)
+    missing = values.isna().to_numpy()
+    strings[~missing] = strings[~missing].astype(str)
+    codes, uniques = pd.factorize(strings)
+
+    # map codes of the new values to (extended) categories of the partition
+    lookup = {c: i for i, c in enumerate(categories)}
+    for u in uniques:
+        if u not in lookup:
+            lookup[u] = len(categories)
+            categories.append(u)
+    mapping = np.array([lookup[u] for u in uniques] + [-1], dtype=np.int32)
+
+    if column in categories_group:
+        del categories_group[column]
+    categories_group.create_dataset(column, data=np.array(categories, dtype=object), dtype=h5.string_dtype())
+
+    return mapping[codes]
+
+
+# whether all values are equal to value (NaN equal to NaN)
+def _all_equal(data, value):
+    if data.dtype.kind == 'f' and np.isnan(value):
+        return bool(np.isnan(data).all())
+    return bool((data == value).all())
+
+
+# raise if values can not be appended to an existing column without losing information
+def _check_column(existing, column, values):
+
+    if existing is None or existing.attrs.get('encoding') == 'dictionary':
+        return
+    if values.dtype.kind not in 'biuf':
+        raise ValueError(f"Can not append non-numeric values to numeric column '{column}'.")
+    # no silent truncation (e.g. float values appended to an integer column)
+    if not np.can_cast(values.dtype, existing.dtype, 'same_kind'):
+        raise ValueError(f"Can not append {values.dtype} values to {existing.dtype} column '{column}'.")
+
+
+# write (or append) one column to a partition group that already contains n_old spots
+# columns that are constant in a partition (e.g. img, channel) are stored as a single value
+# numeric columns store min / max for filtering
+def _write_column(group, column, values, n_old, compression):
+
+    # e.g. numbers in object columns after exploding lists
+    values = values.infer_objects()
+
+    existing = group.get(column)
+    is_string = values.dtype.kind not in 'biuf' if existing is None else existing.attrs.get('encoding') == 'dictionary'
+
+    _check_column(existing, column, values)
+    data = _encode_strings(group, column, values) if is_string else values.to_numpy()
+
+    # previous values are a single (constant) value: stored scalar or missing if the column is new in the partition
+    old_value = None
+    if existing is not None and existing.shape == ():
+        old_value = existing[()]
+    elif existing is None and n_old > 0:
+        old_value = -1 if is_string else np.nan
+
+    if existing is not None and existing.shape != ():
+        # append to full column
+        n = existing.shape[0]
+        existing.resize((n + len(data), ))
+        existing[n:] = data
+        dataset = existing
+
+    elif old_value is not None and _all_equal(data, old_value) and existing is not None:
+        # still constant
+        dataset = existing
+
+    elif old_value is None and len(data) > 0 and _all_equal(data, data[0]):
+        # new constant column
+        dataset = group.create_dataset(column, data=data[0])
+
+    else:
+        # new full column (previous constant values are expanded)
+        if old_value is not None:
+            data = np.concatenate([np.full(n_old, old_value, dtype=np.result_type(data, np.asarray(old_value))), data])
+        if existing is not None:
+            del group[column]
+        dataset = group.create_dataset(column, data=data, maxshape=(None, ), chunks=(min(max(len(data), 1), 65536), ),
+                                       shuffle=compression is not None, compression=compression)
+
+    if is_string:
+        dataset.attrs['encoding'] = 'dictionary'
+    elif len(data) > 0 and data.dtype.kind != 'b':
+        with np.errstate(invalid='ignore'):
+            low, high = np.nanmin(data), np.nanmax(data)
+        if not np.isnan(low):
+            dataset.attrs['min'] = min(low, dataset.attrs.get('min', low))
+            dataset.attrs['max'] = max(high, dataset.attrs.get('max', high))
+
+
+# read one column of a partition with n spots
+def _read_column(group, column, n):
+
+    dataset = group[column]
+    values = dataset[()]
+
+    if dataset.attrs.get('encoding') == 'dictionary':
+        categories = np.array(list(group['_categories'][column].asstr()[()]) + [np.nan], dtype=object)
+        values = categories[values]
+
+    if dataset.shape == ():
+        values = np.full(n, values, dtype=object if isinstance(values, str) else np.asarray(values).dtype)
+
+    return values
+
+
+# attribute value as python object (h5py returns numpy scalars)
+def _attr(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# column names in store order
+def store_columns(store_file):
+    with h5.File(store_file, 'r') as fd:
+        return json.loads(fd.attrs.get('columns', '[]'))
+
+
+# table of all partitions: img, channel, group name and number of spots
+def list_partitions(store_file):
+    with h5.File(store_file, 'r') as fd:
+        rows = [(_attr(group.attrs['img']), _attr(group.attrs['channel']), name, _attr(group.attrs['n_spots']))
+                for name, group in _iter_partitions(fd)]
+    return pd.DataFrame(rows, columns=['img', 'channel', 'partition', 'n_spots'])
+
+
+# partition group (image group and channel group are created in write order)
+def _require_partition(fd, img, channel):
+    img_group_name, channel_group_name = partition_name(img, channel).split('/')
+    img_group = fd[img_group_name] if img_group_name in fd else fd.create_group(img_group_name, track_order=True)
+    return img_group[channel_group_name] if channel_group_name in img_group else img_group.create_group(channel_group_name, track_order=True)
+
+
+def _iter_partitions(fd):
+    for img_group in fd.values():
+        for group in img_group.values():
+            yield group.name.lstrip('/'), group
+
+
+# write spots (DataFrame with img and channel columns) to the store
+# mode 'w': replace the whole store, 'a': append spots (to existing or new partitions)
+def write_spots(store_file, df, mode='w', img_column='img', channel_column='channel', compression='gzip'):
+
+    if mode not in ('w', 'a'):
+        raise ValueError(f"Unknown mode '{mode}', use 'w' or 'a'.")
+    if mode == 'a' and not os.path.exists(store_file):
+        mode = 'w'
+
+    # track_order: partitions and columns are read back in the order they were written
+    with h5.File(store_file, mode, track_order=True) as fd:
+
+        columns = json.loads(fd.attrs.get('columns', '[]'))
+        if len(columns) > 0 and set(columns) != set(df.columns):
+            raise ValueError(f"Columns of spots {list(df.columns)} do not match columns of store {columns}.")
+        if len(columns) == 0:
+            columns = list(df.columns)
+            fd.attrs['columns'] = json.dumps(columns)
+            fd.attrs['img_column'] = img_column
+            fd.attrs['channel_column'] = channel_column
+
+        partitions = list(df.groupby([img_column, channel_column], sort=False))
+
+        # check all partitions before writing, so a failed append does not leave the store half-written
+        for (img, channel), partition in partitions:
+            if partition_name(img, channel) in fd:
+                for column in columns:
+                    _check_column(fd[partition_name(img, channel)].get(column), column, partition[column])
+
+        for (img, channel), partition in partitions:
+            group = _require_partition(fd, img, channel)
+            group.attrs['img'] = img
+            group.attrs['channel'] = channel
+            n_old = _attr(group.attrs.get('n_spots', 0))
+            for column in columns:
+                _write_column(group, column, partition[column], n_old, compression)
+            group.attrs['n_spots'] = n_old + len(partition)
+
+
+# append spots to the store (creates it if it does not exist)
+def append_spots(store_file, df, compression='gzip'):
+    with h5.File(store_file, 'a') as fd:
+        img_column = fd.attrs.get('img_column', 'img')
+        channel_column = fd.attrs.get('channel_column', 'channel')
+    write_spots(store_file, df, mode='a', img_column=img_column, channel_column=channel_column, compression=compression)
+
+
+# whether a partition can contain rows matching the filters (from stored min / max)
+def _may_match(group, filters):
+
+    for column, op, value in filters:
+        if column not in group:
+            continue
+        if group[column].attrs.get('encoding') == 'dictionary' and op in ('==', 'in'):
+            values = _read_column(group, column, 1) if group[column].shape == () else group['_categories'][column].asstr()[()]
+            if not np.any(np.isin(list(values), [value] if op == '==' else list(value))):
+                return False
+            continue
+        if 'min' not in group[column].attrs:
+            continue
+        low, high = group[column].attrs['min'], group[column].attrs['max']
+        if op == '==' and not low <= value <= high:
+            return False
+        if (op == '<' and not low < value) or (op == '<=' and not low <= value):
+            return False
+        if (op == '>' and not high > value) or (op == '>=' and not high >= value):
+            return False
+        if op == 'in' and not any(low <= v <= high for v in value):
+            return False
+
+    return True
+
+
+# read spots from the store
+# columns: columns to read (None: all), images: images to read (full img values, None: all),
+# channels: channels to read (None: all)
+# filters: list of (column, op, value), op in FILTER_OPERATORS; partitions that can not match are not read,
+# filter columns that are not in columns are read for filtering only
+def read_spots(store_file, columns=None, images=None, channels=None, filters=None):
+
+    filters = [] if filters is None else list(filters)
+    images = None if images is None else set(str(img) for img in images)
+    channels = None if channels is None else set(channels)
+
+    with h5.File(store_file, 'r') as fd:
+
+        all_columns = json.loads(fd.attrs.get('columns', '[]'))
+        columns = all_columns if columns is None else list(columns)
+        read_columns = columns + [c for c, _, _ in filters if c not in columns]
+
+        # column arrays of all partitions, combined in one DataFrame at the end
+        data = {column: [] for column in read_columns}
+        for _, group in _iter_partitions(fd):
+
+            # partition pruning
+            if images is not None and str(_attr(group.attrs['img'])) not in images:
+                continue
+            if channels is not None and group.attrs['channel'] not in channels:
+                continue
+            if not _may_match(group, filters):
+                continue
+
+            n = _attr(group.attrs['n_spots'])
+            partition = {column: _read_column(group, column, n) if column in group else np.full(n, np.nan)
+                         for column in read_columns}
+
+            selected = np.ones(n, dtype=bool)
+            for column, op, value in filters:
+                selected &= FILTER_OPERATORS[op](partition[column], value)
+
+            for column in read_columns:
+                data[column].append(partition[column] if selected.all() else partition[column][selected])
+
+    if any(len(values) == 0 for values in data.values()):
+        return pd.DataFrame(columns=columns)
+
+    return pd.DataFrame({column: np.concatenate(data[column]) for column in columns}, columns=columns)
+
+
+# update partitions of the store in place
+# func: DataFrame of one partition -> updated DataFrame (can add columns / remove rows, img and channel must stay the same)
+# images / channels: only update these partitions (None: all)
+def update_spots(store_file, func, images=None, channels=None, compression='gzip'):
+
+    images = None if images is None else set(str(img) for img in images)
+    channels = None if channels is None else set(channels)
+
+    with h5.File(store_file, 'a', track_order=True) as fd:
+
+        columns = json.loads(fd.attrs.get('columns', '[]'))
+
+        for name, group in list(_iter_partitions(fd)):
+
+            if images is not None and str(_attr(group.attrs['img'])) not in images:
+                continue
+            if channels is not None and group.attrs['channel'] not in channels:
+                continue
+
+            n = _attr(group.attrs['n_spots'])
+            df = func(pd.DataFrame({column: _read_column(group, column, n) for column in columns if column in group}))
+
+            # rewrite all columns of the partition
+            for column in list(group.keys()):
+                del group[column]
+            for column in df.columns:
+                _write_column(group, column, df[column], 0, compression)
+            group.attrs['n_spots'] = len(df)
+
+            columns += [c for c in df.columns if c not in columns]
+
+        fd.attrs['columns'] = json.dumps(columns)
+
+
+# read a spot table from a store or csv file (only the requested columns / images / channels)
+def read_spot_table(path, columns=None, images=None, channels=None, filters=None):
+
+    if is_spot_store(path):
+        return read_spots(path, columns=columns, images=images, channels=channels, filters=filters)
+
+    filters = [] if filters is None else list(filters)
+
+    # columns needed for selecting rows are read, but only the requested ones returned
+    usecols = None
+    if columns is not None:
+        needed = (['img'] if images is not None else []) + (['channel'] if channels is not None else []) + [c for c, _, _ in filters]
+        usecols = list(columns) + [c for c in needed if c not in columns]
+
+    df = pd.read_csv(path, usecols=usecols)
+    if images is not None:
+        df = df[df['img'].astype(str).isin(set(str(img) for img in images))]
+    if channels is not None:
+        df = df[df['channel'].isin(channels)]
+    for column, op, value in filters:
+        df = df[FILTER_OPERATORS[op](df[column].values, value)]
+    if columns is not None:
+        df = df[list(columns)]
+
+    return df.reset_index(drop=True)
+
+
+# convert an existing csv spot table (e.g. merge.csv) to a store
+def csv_to_spot_store(csv_file, store_file=None, compression='gzip'):
+    if store_file is None:
+        store_file = str(csv_file).rsplit('.', 1)[0] + '.h5'
+    write_spots(store_file, pd.read_csv(csv_file), mode='w', compression=compression)
+    return store_file
@@ -0,0 +1,314 @@
+# cross-round registration of STED bead detections (see find_transformations_sted.ipynb)
+# pixel size / stage position -> coverslip alignment -> global registration -> per-image (tile) registration,
+# written as global / local transformation JSONs plus the alignment accuracy summary in one pass
+#
+# descriptors of bead coordinates are saved in a cache folder, keyed by a hash of the coordinates and the
+# descriptor parameters -> re-running with other matching / RANSAC parameters does not recompute them
+# pairs of overlapping images are registered in parallel processes, RANSAC is the batched one from utils.ransac
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import distance_matrix
+from skimage.transform import EuclideanTransform
+
+from calmutils.descriptors import descriptor_local_qr, match_descriptors_kd
+from calmutils.stitching.registration import register_iterative
+from calmutils.stitching.transform_helpers import translation_matrix
+
+from utils.ransac import ransac_transform
+from utils.transform_chain import apply_matrices, compose_matrices
+
+
+# default cache folder name (next to the output JSONs)
+DESCRIPTOR_CACHE_DIR_NAME = "descriptor_cache"
+
+# names of the transforms in the JSON files, in the order they are applied
+TRANSFORM_NAMES_GLOBAL = ["pixel_size", "stage_position", "coverslip_align", "global_registration"]
+TRANSFORM_NAMES_LOCAL = TRANSFORM_NAMES_GLOBAL + ["tile_registration_round1"]
+
+
+############# descriptors #################
+
+# hash of a coordinate array and descriptor parameters (key of the descriptor cache)
+def descriptor_key(coords, **params):
+    h = hashlib.sha256()
+    coords = np.ascontiguousarray(coords, dtype=float)
+    h.update(repr(coords.shape).encode())
+    h.update(coords.tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+# descriptors and point indices (see calmutils descriptor_local_qr), loaded from cache_dir if they were computed before
+# cache_dir=None: no caching
+def cached_descriptors(coords, n_neighbors, redundancy, scale_invariant=False, cache_dir=None):
+
+    if cache_dir is None:
+        return descriptor_local_qr(coords, n_neighbors, redundancy, scale_invariant=scale_invariant)
+
+    key = descriptor_key(coords, n_neighbors=n_neighbors, redundancy=redundancy, scale_invariant=scale_invariant)
+    cache_file = os.path.join(cache_dir, f"{key}.npz")
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return cached["desc"], cached["idx"]
+
+    desc, idx = descriptor_local_qr(coords, n_neighbors, redundancy, scale_invariant=scale_invariant)
+
+    # written to a temporary file first (parallel workers may compute the same descriptors)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_file, desc=desc, idx=idx)
+    os.replace(tmp_file, cache_file)
+
+    return desc, idx
+
+
+# coordinates of descriptor matches between two point sets, (m, 3) each
+# descriptor_coords1/2: compute (and cache) descriptors on other coordinates of the same points, e.g. before a rigid
+# transform (descriptors are rotation invariant) -> the cache does not depend on the transform, default: coords1/2
+def match_coordinates(coords1, coords2, n_neighbors, redundancy, match_ratio, scale_invariant=False, cache_dir=None,
+                      descriptor_coords1=None, descriptor_coords2=None):
+
+    descriptor_coords1 = coords1 if descriptor_coords1 is None else descriptor_coords1
+    descriptor_coords2 = coords2 if descriptor_coords2 is None else descriptor_coords2
+
+    desc1, idx1 = cached_descriptors(descriptor_coords1, n_neighbors, redundancy, scale_invariant, cache_dir)
+    desc2, idx2 = cached_descriptors(descriptor_coords2, n_neighbors, redundancy, scale_invariant, cache_dir)
+    matches = match_descriptors_kd(desc1, desc2, max_ratio=1/match_ratio)
+
+    if len(matches) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3))
+    return coords1[idx1[matches[:, 0]]], coords2[idx2[matches[:, 1]]]
+
+
+############# per-image transforms #################
+
+# pixel size (diagonal) and stage position (translation) matrices per image id from pixel and world coordinates
+# (least squares affine pixel -> world transform of each image)
+def pixel_size_and_stage_matrices(df, pixel_columns, world_columns, image_id_column):
+
+    pixel_size_matrices, stage_matrices = {}, {}
+    for image_id, dfi in df.groupby(image_id_column):
+
+        pixel_coords = dfi[pixel_columns].to_numpy(dtype=float)
+        world_coords = dfi[world_columns].to_numpy(dtype=float)
+
+        params = np.linalg.lstsq(np.hstack([pixel_coords, np.ones((len(dfi), 1))]), world_coords, rcond=None)[0].T
+        pixel_size_matrices[image_id] = np.diag(np.append(np.diag(params), 1.0))
+        stage_matrices[image_id] = translation_matrix(params[:, -1])
+
+    return pixel_size_matrices, stage_matrices
+
+
+# translation (-z_cs, 0, 0) per image id, z_cs: low quantile of z (beads on the coverslip)
+def coverslip_matrices(df, z_column, image_id_column, z_bottom_quantile=0.1):
+    z_cs = df.groupby(image_id_column)[z_column].quantile(z_bottom_quantile)
+    return {image_id: translation_matrix([-z, 0, 0]) for image_id, z in z_cs.items()}
+
+
+# points (n, 3) transformed by one 4x4 matrix
+def transform_points(matrix, coords):
+    return coords @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+# coordinates (n, 3) of all rows of a table transformed by the matrix of their image id (row order is kept)
+# matrices: dict image id -> 4x4 matrix or list of such dicts (applied one after the other)
+def transformed_coordinates(df, matrices, coordinate_columns, image_id_column):
+
+    if isinstance(matrices, dict):
+        matrices = [matrices]
+
+    codes, image_ids = pd.factorize(df[image_id_column])
+    composed = np.array([compose_matrices(m[image_id] for m in matrices) for image_id in image_ids]).reshape(-1, 4, 4)
+
+    return apply_matrices(df[coordinate_columns].to_numpy(dtype=float), composed, codes)
+
+
+############# registration #################
+
+# pairs of image ids (dataset 1, dataset 2) with mean coordinates closer than cutoff
+def overlapping_fields(coords1, image_ids1, coords2, image_ids2, overlap_mean_distance_cutoff=50):
+
+    mean_coords_1 = pd.DataFrame(coords1).groupby(np.asarray(image_ids1)).mean()
+    mean_coords_2 = pd.DataFrame(coords2).groupby(np.asarray(image_ids2)).mean()
+
+    close = np.argwhere(distance_matrix(mean_coords_1.values, mean_coords_2.values) < overlap_mean_distance_cutoff)
+    return [(mean_coords_1.index[i], mean_coords_2.index[j]) for i, j in close]
+
+
+# match descriptors of two images and estimate rigid transform via RANSAC
+# returns inlier coordinates of both images or None if there are less than min_matches (before and after RANSAC)
+# descriptor_coords1/2: coordinates to compute descriptors on (see match_coordinates)
+def register_pair(coords1, coords2, n_neighbors=4, redundancy=1, match_ratio=2.0, scale_invariant=True,
+                  max_error=2.0, min_samples=3, max_trials=1_000, min_matches=12, random_state=None, cache_dir=None,
+                  descriptor_coords1=None, descriptor_coords2=None):
+
+    coords_match_1, coords_match_2 = match_coordinates(coords1, coords2, n_neighbors, redundancy, match_ratio,
+                                                       scale_invariant, cache_dir, descriptor_coords1, descriptor_coords2)
+    if len(coords_match_1) < max(min_matches, min_samples):
+        return None
+
+    _, inliers = ransac_transform(coords_match_1, coords_match_2, 'euclidean', min_samples, max_error, max_trials,
+                                  random_state=random_state)
+    if inliers is None or inliers.sum() < min_matches:
+        return None
+
+    return coords_match_1[inliers], coords_match_2[inliers]
+
+
+# wrapper for process pool
+def _register_pair_task(task):
+    pair, coords1, coords2, descriptor_coords1, descriptor_coords2, kwargs = task
+    return pair, register_pair(coords1, coords2, descriptor_coords1=descriptor_coords1,
+                               descriptor_coords2=descriptor_coords2, **kwargs)
+
+
+# register all pairs of images (image id in dataset 1, image id in dataset 2), n_workers pairs in parallel
+# coords_by_image1/2: dict image id -> coordinates (n, 3)
+# descriptor_coords_by_image1/2: dict image id -> coordinates to compute descriptors on (default: coords_by_image1/2)
+# returns dict pair -> (inlier coordinates 1, inlier coordinates 2) of the successfully registered pairs
+# each pair gets its own random generator spawned from random_state -> independent of n_workers
+def register_pairs(coords_by_image1, coords_by_image2, pairs, n_workers=None, random_state=None,
+                   descriptor_coords_by_image1=None, descriptor_coords_by_image2=None, **kwargs):
+
+    descriptor_coords_by_image1 = descriptor_coords_by_image1 or coords_by_image1
+    descriptor_coords_by_image2 = descriptor_coords_by_image2 or coords_by_image2
+
+    rngs = np.random.default_rng(random_state).spawn(len(pairs))
+    tasks = [((id1, id2), coords_by_image1[id1], coords_by_image2[id2], descriptor_coords_by_image1[id1],
+              descriptor_coords_by_image2[id2], kwargs | {"random_state": rng})
+             for (id1, id2), rng in zip(pairs, rngs)]
+
+    if n_workers is None or n_workers <= 1:
+        results = list(map(_register_pair_task, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_register_pair_task, tasks))
+
+    return {pair: result for pair, result in results if result is not None}
+
+
+# coordinate differences of inliers after tile registration for all registered pairs
+# (image_id_1, image_id_2, diff_mean, diff_max, n_inliers)
+def alignment_summary(registered_pairs, tile_matrices):
+
+    summary_df = defaultdict(list)
+
+    for (id1, id2), (coords1, coords2) in registered_pairs.items():
+        coord_diff = transform_points(tile_matrices[id1], coords1) - transform_points(tile_matrices[id2], coords2)
+        diff_norm = np.linalg.norm(coord_diff, axis=1)
+
+        summary_df["image_id_1"].append(id1)
+        summary_df["image_id_2"].append(id2)
+        summary_df["diff_mean"].append(diff_norm.mean())
+        summary_df["diff_max"].append(diff_norm.max())
+        summary_df["n_inliers"].append(len(coord_diff))
+
+    return pd.DataFrame(summary_df, columns=["image_id_1", "image_id_2", "diff_mean", "diff_max", "n_inliers"])
+
+
+# save transforms JSON: image id -> list of (name, flat 4x4 parameters)
+# transforms: dict name -> dict image id -> matrix, saved in the order of names
+def save_transforms_json(out_file, transforms, names, image_ids):
+
+    dict_to_save = {img_id: [(name, np.asarray(transforms[name][img_id]).ravel().tolist()) for name in names]
+                    for img_id in image_ids}
+
+    with open(out_file, "w") as fd:
+        json.dump(dict_to_save, fd, indent=1)
+
+
+# full registration of dataset 1 (moving) to dataset 2 (target), see find_transformations_sted.ipynb
+# writes global and local transformation JSONs and the alignment accuracy summary (if paths are given)
+# returns dict transform name -> dict image id -> 4x4 matrix, registered pairs and summary table
+def register_sted_rounds(df1, df2, json_save_path_g=None, json_save_path_l=None, summary_df_save_path=None,
+                         coordinate_columns=("z_global_um", "y_global_um", "x_global_um"),
+                         coordinate_columns_pixel=("z", "y", "x"), image_id_column="image_id",
+                         z_bottom_quantile=0.1, n_neighbors=4, redundancy=0, descriptor_match_ratio=2,
+                         ransac_max_error=4.0, ransac_max_trials=100_000,
+                         overlap_mean_distance_cutoff=50, min_matches_local=12, redundancy_local=1,
+                         match_ratio_local=2.0, max_error_local=2.0, max_trials_local=1_000, max_iterations=500,
+                         cache_dir=None, n_workers=None, random_state=0, verbose=True):
+
+    coordinate_columns, coordinate_columns_pixel = list(coordinate_columns), list(coordinate_columns_pixel)
+    rng_global, rng_local = np.random.default_rng(random_state).spawn(2)
+
+    df_all = pd.concat([df1, df2])
+    image_ids_all = df_all[image_id_column].unique()
+    transforms = {}
+
+    # 0) pixel size and stage position, 1) coverslip alignment
+    transforms["pixel_size"], transforms["stage_position"] = pixel_size_and_stage_matrices(
+        df_all, coordinate_columns_pixel, coordinate_columns, image_id_column)
+    transforms["coverslip_align"] = coverslip_matrices(df_all, coordinate_columns[0], image_id_column, z_bottom_quantile)
+
+    # 2) global registration of the coverslip-aligned datasets
+    coords1 = transformed_coordinates(df1, transforms["coverslip_align"], coordinate_columns, image_id_column)
+    coords2 = transformed_coordinates(df2, transforms["coverslip_align"], coordinate_columns, image_id_column)
+
+    matched_coords1, matched_coords2 = match_coordinates(coords1, coords2, n_neighbors, redundancy,
+                                                         descriptor_match_ratio, cache_dir=cache_dir)
+    transform_global, inliers_global = ransac_transform(matched_coords1, matched_coords2, 'euclidean', 4,
+                                                        ransac_max_error, ransac_max_trials, random_state=rng_global)
+    if transform_global is None:
+        raise ValueError("Global registration failed: no RANSAC inliers.")
+
+    if verbose:
+        residuals = np.linalg.norm(transform_points(transform_global, matched_coords1[inliers_global]) - matched_coords2[inliers_global], axis=1)
+        print(f"RANSAC inliers: {inliers_global.sum()} / {len(matched_coords1)}")
+        print(f"Residual error (mean, max): {residuals.mean() :.3f}, {residuals.max() :.3f}")
+
+    # global transform for each image in dataset1 (moving), identity for dataset2 (target)
+    transforms["global_registration"] = {image_id: transform_global for image_id in df1[image_id_column].unique()}
+    transforms["global_registration"] |= {image_id: np.eye(4) for image_id in df2[image_id_column].unique()}
+
+    if json_save_path_g is not None:
+        save_transforms_json(json_save_path_g, transforms, TRANSFORM_NAMES_GLOBAL, image_ids_all)
+
+    # 3) local registration of overlapping images
+    stages = [transforms["coverslip_align"], transforms["global_registration"]]
+    coords_tr_1 = transformed_coordinates(df1, stages, coordinate_columns, image_id_column)
+    coords_tr_2 = transformed_coordinates(df2, stages, coordinate_columns, image_id_column)
+
+    pairs = overlapping_fields(coords_tr_1, df1[image_id_column], coords_tr_2, df2[image_id_column],
+                               overlap_mean_distance_cutoff)
+
+    rows_by_image1 = df1.reset_index(drop=True).groupby(image_id_column).indices
+    rows_by_image2 = df2.reset_index(drop=True).groupby(image_id_column).indices
+    coords_by_image1 = {k: coords_tr_1[v] for k, v in rows_by_image1.items()}
+    coords_by_image2 = {k: coords_tr_2[v] for k, v in rows_by_image2.items()}
+
+    # descriptors on the coverslip-aligned coordinates (before the rigid global transform, which depends on the
+    # RANSAC parameters) -> cached descriptors stay valid when re-tuning RANSAC
+    descriptor_coords_by_image1 = {k: coords1[v] for k, v in rows_by_image1.items()}
+    descriptor_coords_by_image2 = {k: coords2[v] for k, v in rows_by_image2.items()}
+
+    registered_pairs = register_pairs(coords_by_image1, coords_by_image2, pairs, n_workers, rng_local,
+                                      descriptor_coords_by_image1, descriptor_coords_by_image2,
+                                      n_neighbors=n_neighbors, redundancy=redundancy_local, match_ratio=match_ratio_local,
+                                      max_error=max_error_local, max_trials=max_trials_local,
+                                      min_matches=min_matches_local, cache_dir=cache_dir)
+
+    tile_transforms = register_iterative(registered_pairs, transform_type=EuclideanTransform, max_iterations=max_iterations) if registered_pairs else {}
+    if verbose:
+        print(f"Per-tile transforms estimated for {len(tile_transforms)} images")
+
+    # identity transforms for the images for which we did not find transform
+    transforms["tile_registration_round1"] = {image_id: tile_transforms[image_id].params if image_id in tile_transforms else np.eye(4)
+                                              for image_id in image_ids_all}
+
+    if json_save_path_l is not None:
+        save_transforms_json(json_save_path_l, transforms, TRANSFORM_NAMES_LOCAL, image_ids_all)
+
+    summary_df = alignment_summary(registered_pairs, transforms["tile_registration_round1"])
+    if summary_df_save_path is not None:
+        summary_df.to_csv(summary_df_save_path, index=None)
+
+    return transforms, registered_pairs, summary_df
@@ -0,0 +1,122 @@
+# fused coordinate transforms for whole spot tables
+# a chain is a list of stages (e.g. pixel -> world, chromatic shift, cross-round alignment), each stage gives a
+# homogeneous 4x4 (zyx) matrix for the key of a spot (values of the key columns, e.g. image and channel)
+# the stages are composed into one matrix per unique key (cached in the chain) and applied to all spots at once
+# -> one pass over the table instead of one per stage and image / channel group
+#
+# NOTE: composing first and applying once is mathematically the same as applying the stages one after the other,
+# results can differ in the last digits (floating point rounding)
+
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from utils.transform_helpers import pixel_to_world_matrix
+
+
+# product of matrices given in the order they are applied (first one is applied first)
+def compose_matrices(matrices):
+    return reduce(lambda composed, mat: np.asarray(mat, dtype=float) @ composed, matrices, np.eye(4))
+
+
+# world transform of one image from the list of (name, flat parameters) in alignment JSON files:
+# all except the first two (pixel size, stage coords), concatenated in reverse order
+# (same as the loop over transform_list[:1:-1] in apply_alignment_to_images.ipynb)
+def alignment_matrix(transform_list, n_skip=2):
+    matrices = [np.array(tr, dtype=float).reshape(4, 4) for _, tr in transform_list[n_skip:]]
+    return compose_matrices(matrices)
+
+
+# transform coordinates (n, 3) with matrices (k, 4, 4), matrix_idx: (n, ) index of the matrix of each coordinate
+# matrices are gathered in chunks to bound memory (one 4x4 matrix per spot would be 128 bytes per spot)
+def apply_matrices(coords, matrices, matrix_idx, chunk_size=2**18):
+
+    out = np.empty_like(coords, dtype=float)
+    for start in range(0, len(coords), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        gathered = matrices[matrix_idx[chunk], :3]
+        out[chunk] = np.einsum('nij,nj->ni', gathered[:, :, :3], coords[chunk]) + gathered[:, :, 3]
+
+    return out
+
+
+############# stages: functions key (dict key column -> value) -> 4x4 matrix #################
+
+# the same matrix for all spots
+def constant_stage(matrix):
+    matrix = np.asarray(matrix, dtype=float)
+    return lambda key: matrix
+
+
+# scaling of pixel coordinates by pixel size (zyx)
+def pixel_size_stage(pixel_size):
+    return constant_stage(np.diag(np.append(np.asarray(pixel_size, dtype=float), 1.0)))
+
+
+# pixel -> world coordinates from scan field metadata (see transform_helpers.get_scan_field_metadata)
+# metadata_for_image: function image (value of image_column) -> ScanFieldMetadata
+# unit_scale: 1e6 for world coordinates in µm
+def pixel_to_world_stage(metadata_for_image, image_column='img', unit_scale=1e6):
+    return lambda key: pixel_to_world_matrix(metadata_for_image(key[image_column]), unit_scale)
+
+
+# chromatic shift correction: transforms channel pair -> 4x4 matrix (see corrections.load_transforms)
+# spots in the reference channel are not transformed if there is no transform to itself
+def chromatic_stage(transforms, reference_channel, channel_column='channel'):
+
+    def stage(key):
+        channel = key[channel_column]
+        if (channel, reference_channel) not in transforms and channel == reference_channel:
+            return np.eye(4)
+        return transforms[(channel, reference_channel)]
+
+    return stage
+
+
+# per-image matrices (e.g. cross-round alignment, see alignment_matrix)
+# image_id: function image (value of image_column) -> key in matrices, default: use image as is
+def image_stage(matrices, image_column='img', image_id=None):
+    if image_id is None:
+        image_id = lambda img: img
+    return lambda key: matrices[image_id(key[image_column])]
+
+
+class TransformChain:
+
+    def __init__(self, stages, key_columns=('img', 'channel')):
+        self.stages = list(stages)
+        self.key_columns = list(key_columns)
+        self._cache = {}
+
+    # composed matrix for a key (tuple of key column values), cached
+    def matrix(self, key):
+        key = tuple(key)
+        if key not in self._cache:
+            key_dict = dict(zip(self.key_columns, key))
+            self._cache[key] = compose_matrices(stage(key_dict) for stage in self.stages)
+        return self._cache[key]
+
+    # transform the coordinate columns of a whole table, returns a copy with out_columns added / replaced
+    # (default: overwrite coordinate_columns), rows with missing keys are dropped
+    def apply(self, df, coordinate_columns, out_columns=None):
+
+        if out_columns is None:
+            out_columns = coordinate_columns
+
+        df = df.dropna(subset=self.key_columns).copy()
+
+        # index of the unique key of each spot: factorize columns separately, then combine the integer codes
+        # (much faster than factorizing tuples), the matrix chain is composed once per unique key
+        codes, uniques = zip(*(pd.factorize(df[column]) for column in self.key_columns))
+        combined = np.ravel_multi_index(codes, [len(u) for u in uniques])
+        unique_combined, key_idx = np.unique(combined, return_inverse=True)
+        unique_keys = zip(*(u[c] for u, c in zip(uniques, np.unravel_index(unique_combined, [len(u) for u in uniques]))))
+        matrices = np.array([self.matrix(key) for key in unique_keys]).reshape(-1, 4, 4)
+
+        coords = df[list(coordinate_columns)].to_numpy(dtype=float)
+        coords_transformed = apply_matrices(coords, matrices, key_idx.reshape(-1))
+        for i, column in enumerate(out_columns):
+            df[column] = coords_transformed[:, i]
+
+        return df
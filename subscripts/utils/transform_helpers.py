@@ -1,6 +1,10 @@
 from xml.etree import ElementTree
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from glob import glob
 import json
+import os
 
 from h5py import File
 import numpy as np
@@ -66,12 +70,23 @@ def load_scan_directions(hardware_parameter_dict):
     return (1 if z_flipped else -1, -1 if y_flipped else 1, -1 if x_flipped else 1)
 
 
-def get_scan_field_metadata(msr_path, stack_idx=0):
+def get_scan_field_metadata(msr_path, stack_idx=0, use_index=True):
+
+    # O(1) lookup in the metadata index of the raw folder, if there is an up-to-date one
+    if use_index:
+        meta = lookup_scan_field_index(msr_path, str(stack_idx))
+        if meta is not None:
+            return meta
 
     with OBFFile(msr_path) as reader:
         # imspector metadata (including stage position)
         xml_imspector_metadata = reader.get_imspector_xml_metadata(stack_idx)
 
+    return scan_field_metadata_from_xml(xml_imspector_metadata)
+
+
+def scan_field_metadata_from_xml(xml_imspector_metadata):
+
     # parse XML string, get scan range element
     et_root = ElementTree.fromstring(xml_imspector_metadata)
     range_elem = et_root.find("doc/ExpControl/scan/range")
@@ -106,20 +121,24 @@ def get_scan_field_metadata(msr_path, stack_idx=0):
     return ScanFieldMetadata(*ret)
 
 
-def get_scan_field_metadata_h5(h5_file, acquisition_path, configuration_idx=0):
+def get_scan_field_metadata_h5(h5_file, acquisition_path, configuration_idx=0, use_index=True):
+
+    # O(1) lookup in the metadata index of the raw folder, if there is an up-to-date one
+    if use_index:
+        meta = lookup_scan_field_index(h5_file, f"{acquisition_path}/{configuration_idx}")
+        if meta is not None:
+            return meta
 
     # open h5 file, get attributes (measurement / hardware metadata) for given acquisition
-    with File(h5_file) as fd:
-        measurement_metadata = json.loads(
-            fd[f"experiment/{acquisition_path}/{configuration_idx}"].attrs[
-                "measurement_meta"
-            ]
-        )
-        hardware_metadata = json.loads(
-            fd[f"experiment/{acquisition_path}/{configuration_idx}"].attrs[
-                "global_meta"
-            ]
-        )
+    with File(h5_file, "r") as fd:
+        attrs = fd[f"experiment/{acquisition_path}/{configuration_idx}"].attrs
+        return scan_field_metadata_from_h5_attrs(attrs["measurement_meta"], attrs["global_meta"])
+
+
+def scan_field_metadata_from_h5_attrs(measurement_meta, global_meta):
+
+    measurement_metadata = json.loads(measurement_meta)
+    hardware_metadata = json.loads(global_meta)
 
     # get scan range subdirectory
     attrs_scan = recursive_dict_query(measurement_metadata, "ExpControl/scan/range")
@@ -178,6 +197,17 @@ def world_coords_for_pixel_spots(
     return spots_world
 
 
+def pixel_to_world_matrix(field_metadata: ScanFieldMetadata, unit_scale=1.0):
+    """
+    homogeneous 4x4 (zyx) matrix equivalent to world_coords_for_pixel_spots,
+    world coordinates are multiplied by unit_scale (e.g. 1e6 for µm)
+    """
+    origin = world_coords_for_pixel_spots([0, 0, 0], field_metadata)[0]
+    mat = np.diag(np.append(np.asarray(field_metadata.pixel_size, dtype=float) * unit_scale, 1.0))
+    mat[:3, 3] = origin * unit_scale
+    return mat
+
+
 def world_transform_to_pixel_transform(
     transform, origin_ref, origin_moving, pixel_size_ref, pixel_size_moving
 ):
@@ -208,3 +238,135 @@ def affine_transform_nd(dimensionality):
     return AffineTransform constructor with specified dimensionality, would default to 2 otherwise
     """
     return lambda: AffineTransform(dimensionality=dimensionality)
+
+
+############# scan field metadata index #################
+# sidecar table (<raw folder>/scan_field_metadata.json) with the ScanFieldMetadata of every acquisition
+# of all MSR / HDF5 files in a raw folder: built once (files in parallel), entries of a file are invalidated
+# when its size or modification time changes
+# get_scan_field_metadata(_h5) look up acquisitions there first and only parse the raw file if there is no
+# up-to-date entry, keys are the stack index (MSR) or "<acquisition>/<configuration>" (HDF5)
+
+SCAN_FIELD_INDEX_FILE_NAME = "scan_field_metadata.json"
+
+
+def _file_state(file):
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# metadata of all acquisitions in one raw file as dict key -> {field: list}
+# acquisitions without (complete) scan field metadata are left out
+def index_raw_file(file):
+
+    entries = {}
+
+    if file.endswith(".msr"):
+        with OBFFile(file) as reader:
+            for stack_idx in range(len(reader.shapes)):
+                try:
+                    meta = scan_field_metadata_from_xml(reader.get_imspector_xml_metadata(stack_idx))
+                except (AttributeError, ValueError, ElementTree.ParseError):
+                    continue
+                entries[str(stack_idx)] = {k: v.tolist() for k, v in meta._asdict().items()}
+
+    else:
+        with File(file, "r") as fd:
+            for acquisition_path, acquisition in fd["experiment"].items():
+                for configuration_idx, configuration in acquisition.items():
+                    attrs = configuration.attrs
+                    if "measurement_meta" not in attrs or "global_meta" not in attrs:
+                        continue
+                    try:
+                        meta = scan_field_metadata_from_h5_attrs(attrs["measurement_meta"], attrs["global_meta"])
+                    except (TypeError, ValueError):
+                        continue
+                    entries[f"{acquisition_path}/{configuration_idx}"] = {k: v.tolist() for k, v in meta._asdict().items()}
+
+    return entries
+
+
+# wrapper for process pool, returns (state, entries, error)
+def _index_raw_file(file):
+    try:
+        return _file_state(file), index_raw_file(file), None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+
+# build / update the metadata index of a raw folder, only new or changed files are (re-)read
+# returns the index as dict file name -> {"state": [size, mtime_ns], "acquisitions": {key: {field: list}}}
+def build_scan_field_index(raw_folder, n_workers=None, patterns=("*.msr", "*.h5")):
+
+    raw_folder = os.fspath(raw_folder)
+    index_file = os.path.join(raw_folder, SCAN_FIELD_INDEX_FILE_NAME)
+
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as fd:
+            index = json.load(fd)["files"]
+
+    files = sorted(f for pattern in patterns for f in glob(os.path.join(raw_folder, pattern)))
+    names = [os.path.basename(f) for f in files]
+
+    # keep entries of unchanged files, drop removed ones
+    index = {name: entry for name, entry in index.items() if name in names}
+    todo = [f for f, name in zip(files, names) if name not in index or index[name]["state"] != _file_state(f)]
+
+    if n_workers is None or n_workers <= 1:
+        results = list(map(_index_raw_file, todo))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_index_raw_file, todo))
+
+    for file, (state, entries, error) in zip(todo, results):
+        name = os.path.basename(file)
+        if error is not None:
+            print(f"{file}: could not read metadata ({error})")
+            index.pop(name, None)
+            continue
+        index[name] = {"state": state, "acquisitions": entries}
+
+    # written to a temporary file first so an interrupted run does not leave a broken index
+    with open(index_file + ".tmp", "w") as fd:
+        json.dump({"fields": list(ScanFieldMetadata._fields), "files": index}, fd)
+    os.replace(index_file + ".tmp", index_file)
+
+    return index
+
+
+# index of a folder as dict file name -> (state, dict key -> ScanFieldMetadata), cached per index file version
+@lru_cache(maxsize=16)
+def _load_scan_field_index(index_file, index_mtime_ns):
+
+    with open(index_file) as fd:
+        index = json.load(fd)["files"]
+
+    return {
+        name: (entry["state"], {key: ScanFieldMetadata(**{k: np.array(v) for k, v in fields.items()})
+                                for key, fields in entry["acquisitions"].items()})
+        for name, entry in index.items()
+    }
+
+
+# metadata of one acquisition from the index next to the raw file
+# None if there is no index, the file changed since it was indexed or the acquisition is not in the index
+def lookup_scan_field_index(raw_file, key):
+
+    raw_file = os.fspath(raw_file)
+    index_file = os.path.join(os.path.dirname(raw_file), SCAN_FIELD_INDEX_FILE_NAME)
+
+    try:
+        index = _load_scan_field_index(index_file, os.stat(index_file).st_mtime_ns)
+        state, acquisitions = index[os.path.basename(raw_file)]
+        if state != _file_state(raw_file):
+            return None
+    except (OSError, KeyError, ValueError):
+        return None
+
+    meta = acquisitions.get(key)
+    if meta is None:
+        return None
+
+    # copies, the cached arrays must not be modified by callers
+    return ScanFieldMetadata(*(np.array(v) for v in meta))
@@ -0,0 +1,149 @@
+# block-wise affine warping of (multichannel) stacks, replaces dask_image / full-volume scipy affine_transform
+# the output volume is split into blocks, for each block only the input region mapping into it (plus an interpolation
+# halo) is read and resampled with scipy.ndimage.affine_transform, blocks are written directly into the output array
+# (numpy array, memmap, HDF5 dataset, ...), e.g. a chunked HDF5 dataset with chunks = blocks
+# blocks are resampled in parallel threads or processes, with at most max_pending blocks in flight (bounded memory)
+#
+# matrices map output pixel coordinates to input pixel coordinates (like scipy affine_transform), e.g.
+# world_coordinate_transform_to_pixel(transforms[(reference, channel)], pixel_size) for a transforms JSON
+# (see pixel_matrices_from_transforms)
+# or the inverse of world_transform_to_pixel_transform (which maps moving to reference pixels)
+# only nearest (order=0) and linear (order=1) interpolation: higher orders need a spline prefilter of the whole image
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import h5py as h5
+import numpy as np
+from scipy.ndimage import affine_transform
+
+from utils.image_access import iter_blocks
+
+
+# matrices (output -> input pixels) to warp every channel into the reference channel from a dict channel pair -> world
+# transform (e.g. corrections.load_transforms): the transform reference -> channel in pixel units
+def pixel_matrices_from_transforms(transforms, reference_channel, channels, pixel_size):
+    pixel_scale_mat = np.diag(list(pixel_size) + [1])
+    return {ch: np.linalg.inv(pixel_scale_mat) @ transforms[(reference_channel, ch)] @ pixel_scale_mat
+            for ch in channels if ch != reference_channel}
+
+
+# input region (tuple of slices) needed to resample an output block, None if the block maps outside the input
+def source_region(matrix, block, input_shape, order=1):
+
+    block_start = np.array([s.start for s in block])
+    block_stop = np.array([s.stop for s in block]) - 1
+
+    # the affine image of the block is the convex hull of its transformed corners
+    corners = np.array(np.meshgrid(*zip(block_start, block_stop), indexing='ij')).reshape(len(block), -1).T
+    source = corners @ matrix[:-1, :-1].T + matrix[:-1, -1]
+
+    # halo: neighbors for linear interpolation (+ one voxel for rounding)
+    lo = np.clip(np.floor(source.min(axis=0)).astype(int) - order, 0, input_shape)
+    hi = np.clip(np.ceil(source.max(axis=0)).astype(int) + order + 1, 0, input_shape)
+    if not all(lo < hi):
+        return None
+
+    return tuple(slice(l, h) for l, h in zip(lo, hi))
+
+
+# resample one output block from an input crop (starting at crop_start)
+def warp_block(crop, crop_start, matrix, block, order=1, cval=0, dtype=None):
+
+    block_start = np.array([s.start for s in block])
+    block_shape = tuple(s.stop - s.start for s in block)
+
+    # output voxel o (relative to block) -> input voxel matrix @ (o + block start), relative to crop
+    offset = matrix[:-1, :-1] @ block_start + matrix[:-1, -1] - crop_start
+    return affine_transform(crop, matrix[:-1, :-1], offset, output_shape=block_shape, order=order,
+                            mode='constant', cval=cval, output=dtype or crop.dtype)
+
+
+# wrapper for executors
+def _warp_block_task(task):
+    block, crop, crop_start, matrix, order, cval, dtype = task
+    return block, warp_block(crop, crop_start, matrix, block, order, cval, dtype)
+
+
+# warp img (zyx or yx; numpy array, memmap or HDF5 dataset) with matrix (output -> input pixels) into out
+# (array-like of output_shape, default: new array of img shape), n_workers blocks in parallel
+# executor: 'process' or 'thread', blocks outside the input are filled with cval
+def warp_affine(img, matrix, out=None, output_shape=None, block_shape=(32, 256, 256), order=1, cval=0,
+                n_workers=None, executor='process', max_pending=None):
+
+    if order not in (0, 1):
+        raise ValueError('only nearest (order=0) and linear (order=1) interpolation are supported')
+
+    matrix = np.asarray(matrix, dtype=float)
+    if output_shape is None:
+        output_shape = img.shape if out is None else out.shape
+    if out is None:
+        out = np.empty(output_shape, dtype=img.dtype)
+
+    block_shape = tuple(block_shape)[-len(output_shape):]
+    dtype = out.dtype
+
+    def tasks():
+        for block in iter_blocks(output_shape, block_shape):
+            region = source_region(matrix, block, img.shape, order)
+            if region is None:
+                out[block] = cval
+                continue
+            crop_start = np.array([s.start for s in region])
+            yield block, np.asarray(img[region]), crop_start, matrix, order, cval, dtype
+
+    if n_workers is None or n_workers <= 1:
+        for block, warped in map(_warp_block_task, tasks()):
+            out[block] = warped
+        return out
+
+    # submit blocks as results are written -> at most max_pending crops / blocks in memory
+    max_pending = 2 * n_workers if max_pending is None else max_pending
+    executor_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+
+    with executor_class(max_workers=n_workers) as pool:
+        pending = set()
+        for task in tasks():
+            pending.add(pool.submit(_warp_block_task, task))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    block, warped = future.result()
+                    out[block] = warped
+        for future in pending:
+            block, warped = future.result()
+            out[block] = warped
+
+    return out
+
+
+# warp all channels (dict channel -> image) into a reference frame, matrices: dict channel -> matrix
+# (output -> input pixels), channels without matrix are copied (e.g. the reference)
+# out_file: write to chunked HDF5 datasets (one per channel, chunks = blocks) instead of returning numpy arrays
+def warp_channels(images, matrices, out_file=None, block_shape=(32, 256, 256), order=1, cval=0,
+                  n_workers=None, executor='process', compression=None):
+
+    fd = h5.File(out_file, 'w') if out_file is not None else None
+    warped = {}
+
+    try:
+        for ch, img in images.items():
+
+            if fd is not None:
+                chunks = tuple(min(b, s) for b, s in zip(tuple(block_shape)[-img.ndim:], img.shape))
+                out = fd.create_dataset(str(ch), shape=img.shape, dtype=img.dtype, chunks=chunks, compression=compression)
+            else:
+                out = np.empty(img.shape, dtype=img.dtype)
+
+            if ch not in matrices:
+                for block in iter_blocks(img.shape, tuple(block_shape)[-img.ndim:]):
+                    out[block] = img[block]
+            else:
+                warp_affine(img, matrices[ch], out, block_shape=block_shape, order=order, cval=cval,
+                            n_workers=n_workers, executor=executor)
+
+            warped[ch] = out if fd is None else str(ch)
+    finally:
+        if fd is not None:
+            fd.close()
+
+    return warped